@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+from time import perf_counter
+
+from huhu import archive
+from huhu import formats
+from huhu import utils
+
+
+def timed(label, function, *args, **kwargs):
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = perf_counter() - start
+    print(f"{label:<40} {elapsed:>8,.2f} seconds")
+    return result, elapsed
+
+
+def parse(path, format_):
+    "Parse the log file again, the slow way"
+    mode = 'rb' if format_.binary else 'rt'
+    with utils.magic_open(path, mode) as fp:
+        return sum(1 for _ in format_.parse_stream(fp))
+
+
+def read(path, output):
+    with archive.ArchiveReader(path) as reader:
+        if output == 'batches':
+            return sum(
+                len(batch) for batch in reader.iter_requests(output=output))
+        return sum(1 for _ in reader.iter_requests(output=output))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'usage: {sys.argv[0]} LOG ARCHIVE', file=sys.stderr)
+        sys.exit(1)
+    log, path = sys.argv[1:]
+    format_ = formats.detect_format(log, binary=True)
+    timed("Archive log file", archive.archive_logs, [log], path, format_)
+    print(
+        f"{os.path.getsize(log):,} bytes of log, "
+        f"{os.path.getsize(path):,} bytes of archive.")
+
+    count, parsing = timed("Parse log file", parse, log, format_)
+    print(f"{count:,} requests.")
+    for output in ('tuples', 'batches', 'requests'):
+        _, reading = timed(f"Read archive, {output}", read, path, output)
+        print(f"{parsing / reading:.1f} times faster than parsing.")
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import sys
+from time import perf_counter
+
+import numpy
+
+from huhu.columns import export_columns, load_columns
+from huhu.request import RequestDB
+
+
+def timed(label, function, *args, **kwargs):
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = perf_counter() - start
+    print(f"{label:<50} {elapsed * 1000:>10,.1f} ms")
+    return result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'usage: {sys.argv[0]} DATABASE CACHE_FOLDER', file=sys.stderr)
+        sys.exit(1)
+    db = RequestDB(sys.argv[1])
+    print(f"{db.count():,} requests in database.")
+    timed("Export columns", export_columns, db)
+    timed("Load columns, exporting to cache", load_columns, db, sys.argv[2])
+    columns = timed(
+        "Load columns, memory-mapped", load_columns, db, sys.argv[2])
+
+    # Time ranges not on whole hours are answered from requests_base, not
+    # the rollup tables.
+    timestamps = columns.timestamp[columns.timestamp >= 0]
+    if not len(timestamps):
+        print("No requests with a timestamp to report on.", file=sys.stderr)
+        sys.exit(1)
+    first, last = int(timestamps.min()), int(timestamps.max())
+
+    # Busiest domain, or every domain if none are known
+    ids = columns.domain_id[columns.domain_id > 0]
+    domain = None
+    if len(ids):
+        domain = columns.domains[numpy.bincount(ids).argmax()]
+    reports = [
+        ("Requests per hour, all", 'requests_per_period', 'hour',
+         None, first + 1, last + 1),
+        ("Requests per hour, domain", 'requests_per_period', 'hour',
+         domain, first + 1, last + 1),
+        ("Top paths, domain", 'top_paths', 10, domain, first + 1, last + 1),
+        ("Status counts, all", 'status_counts', None, first + 1, last + 1),
+        ("Bytes served, status 404", 'bytes_served',
+         None, first + 1, last + 1, 404),
+    ]
+    for label, method, *args in reports:
+        timed(f"{label}, SQL", getattr(db, method), *args)
+        timed(f"{label}, NumPy", getattr(columns, method), *args)
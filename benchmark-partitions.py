@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import sys
+from time import perf_counter
+
+from huhu.partitions import PartitionedRequestDB
+from huhu.request import RequestDB
+
+
+# Synthetic requests, spread evenly over a year
+START = 1546300800
+YEAR = 365 * 86400
+DOMAINS = [f'site{index}.co.nz' for index in range(20)]
+PATHS = [f'/page/{index}.html' for index in range(10_000)]
+STATUSES = [200] * 90 + [304] * 5 + [404] * 4 + [500]
+AGENTS = [f'Mozilla/5.0 (Agent {index})' for index in range(500)]
+
+
+def requests(count):
+    rng = random.Random(42)
+    choice = rng.choice
+    step = YEAR / count
+    for index in range(count):
+        yield (
+            choice(DOMAINS), rng.getrandbits(32), None,
+            START + int(index * step), choice(PATHS), choice(STATUSES),
+            rng.randrange(100_000), None, choice(AGENTS))
+
+
+def load(label, db, count):
+    start = perf_counter()
+    with db.bulk_import():
+        db.load_requests(requests(count), chunk_size=100_000)
+    elapsed = perf_counter() - start
+    print(f"{label:<55} {count / elapsed:>10,.0f} rows/s")
+
+
+def timed(label, function, *args, **kwargs):
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = perf_counter() - start
+    print(f"{label:<55} {elapsed * 1000:>10,.1f} ms")
+    return result
+
+
+def delete_before(db, before):
+    "Retention the old way, deleting rows.  Rollups are left as they were."
+    with db._connection as con:
+        con.execute("DELETE FROM requests_base WHERE timestamp<?;", (before,))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'usage: {sys.argv[0]} FOLDER NUM_REQUESTS', file=sys.stderr)
+        sys.exit(1)
+    folder = sys.argv[1]
+    count = int(sys.argv[2])
+    os.makedirs(folder, exist_ok=True)
+    single = RequestDB(os.path.join(folder, 'single.db'))
+    partitioned = PartitionedRequestDB(os.path.join(folder, 'months'))
+    if not single.count():
+        load("Load, single file", single, count)
+        load("Load, partitioned by month", partitioned, count)
+    print(f"{single.count():,} requests in database.")
+
+    domain = DOMAINS[0]
+    month = (START + 31 * 86400, START + 59 * 86400)
+    week = (START + 31 * 86400 + 1, START + 38 * 86400)
+    reports = [
+        ("Requests per day, all", 'requests_per_period', 'day'),
+        ("Requests per hour, domain, part of a week",
+         'requests_per_period', 'hour', domain, *week),
+        ("Top paths, domain, one month", 'top_paths', 10, domain, *month),
+        ("Top paths, domain, part of a week", 'top_paths', 10, domain, *week),
+        ("Top paths, domain, one year", 'top_paths', 10, domain),
+        ("Status counts, domain, part of a week",
+         'status_counts', domain, *week),
+        ("Bytes served, part of a week", 'bytes_served', None, *week),
+    ]
+    for label, method, *args in reports:
+        timed(f"{label}, single", getattr(single, method), *args)
+        timed(f"{label}, partitioned", getattr(partitioned, method), *args)
+    partitioned.close()
+
+    expire = START + 90 * 86400
+    timed("Drop first quarter, single", delete_before, single, expire)
+    timed("Drop first quarter, partitioned", partitioned.expire, expire)
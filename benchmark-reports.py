@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import sys
+from time import perf_counter
+
+from huhu.request import RequestDB
+
+
+# Synthetic requests, spread evenly over a year
+START = 1546300800
+YEAR = 365 * 86400
+DOMAINS = [f'site{index}.co.nz' for index in range(20)]
+PATHS = [f'/page/{index}.html' for index in range(10_000)]
+STATUSES = [200] * 90 + [304] * 5 + [404] * 4 + [500]
+AGENTS = [f'Mozilla/5.0 (Agent {index})' for index in range(500)]
+
+
+def requests(count):
+    rng = random.Random(42)
+    choice = rng.choice
+    step = YEAR / count
+    for index in range(count):
+        yield (
+            choice(DOMAINS), rng.getrandbits(32), None,
+            START + int(index * step), choice(PATHS), choice(STATUSES),
+            rng.randrange(100_000), None, choice(AGENTS))
+
+
+def create(path, count):
+    db = RequestDB(path)
+    start = perf_counter()
+    with db.bulk_import():
+        db.load_requests(requests(count), chunk_size=100_000)
+    elapsed = perf_counter() - start
+    print(f"Loaded {count:,} requests in {elapsed:.2f} seconds.")
+    return db
+
+
+def timed(label, function, *args, **kwargs):
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = perf_counter() - start
+    print(f"{label:<45} {elapsed * 1000:>10,.1f} ms")
+    return result
+
+
+def view_query(db, sql, *params):
+    "Report the old way, through the view"
+    return db._connection.execute(sql, params).fetchall()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f'usage: {sys.argv[0]} PATH NUM_REQUESTS', file=sys.stderr)
+        sys.exit(1)
+    path = sys.argv[1]
+    count = int(sys.argv[2])
+    db = RequestDB(path) if os.path.exists(path) else create(path, count)
+    print(f"{db.count():,} requests in database.")
+
+    domain = DOMAINS[0]
+    month = (START + 31 * 86400, START + 59 * 86400)
+    year = (START, START + YEAR)
+    timed("Requests per day, all", db.requests_per_period, 'day')
+    timed("Requests per month, domain, one year",
+          db.requests_per_period, 'month', domain, *year)
+    timed("Requests per month, not whole days",
+          db.requests_per_period, 'month', domain, year[0] + 1, year[1])
+    timed("Requests per hour, domain, one month",
+          db.requests_per_period, 'hour', domain, *month)
+    timed("Top paths, all", db.top_paths)
+    timed("Top paths, domain, one month", db.top_paths, 10, domain, *month)
+    timed("Top 404 paths, one month", db.top_paths, 10, None, *month, 404)
+    timed("Status counts, domain", db.status_counts, domain)
+    timed("Bytes served, domain, one month", db.bytes_served, domain, *month)
+    timed("Top paths, domain, one month, via view", view_query, db,
+          "SELECT path, count(*) AS hits FROM requests WHERE domain=? AND "
+          "timestamp>=? AND timestamp<? GROUP BY path "
+          "ORDER BY hits DESC LIMIT 10;", domain, *month)
+    timed("Status counts, domain, via view", view_query, db,
+          "SELECT status, count(*) FROM requests WHERE domain=? "
+          "GROUP BY status;", domain)
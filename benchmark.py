@@ -6,35 +6,36 @@ from pprint import pprint as dump
 import sys
 from time import perf_counter
 
-from huhu.parser import ApacheLogParser, ApacheLogParserError
+from huhu.parser import ApacheLogParser
 from huhu.utils import magic_open
 
 
 log_format = "%{Host}i %h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\" %D"
 
 
-def parse(path):
-    parser = ApacheLogParser(log_format)
+def parse(path, fields=None):
+    parser = ApacheLogParser(log_format, fields=fields)
+    numlines = 0
     for path in glob.glob(path):
         with magic_open(path) as fp:
-            for linenum, line in enumerate(fp, 1):
-                try:
-                    data = parser.parse(line)
-                except ApacheLogParserError:
-                    print(line.strip())
-                    print(parser.regex.pattern)
-                    print()
-        return linenum
+            stream = parser.parse_stream(fp, quarantine=sys.stderr, limit=10)
+            for data in stream:
+                pass
+        numlines += stream.lines
+        if stream.failed:
+            print(f"{stream.failed:,} bad lines in {path}: {stream.totals()}")
+    return numlines
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f'usage: {sys.argv[0]} PATH', file=sys.stderr)
+    if len(sys.argv) not in (2, 3):
+        print(f'usage: {sys.argv[0]} PATH [FIELD,...]', file=sys.stderr)
         sys.exit(1)
     path = sys.argv[1]
+    fields = sys.argv[2].split(',') if len(sys.argv) == 3 else None
 
     start = perf_counter()
-    numlines = parse(path)
+    numlines = parse(path, fields)
     elapsed = perf_counter() - start
     lines_per_sec = round(numlines / elapsed)
     print(f"Parsed {numlines:,} lines in {elapsed:.2f} seconds.", end=' ')
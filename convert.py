@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import sys
+from time import perf_counter
+
+from huhu import formats
+
+
+# Output formats, by name
+output_formats = {
+    'common': formats.ApacheCommon,
+    'combined': formats.ApacheCombined,
+    'vcommon': formats.ApacheVCommon,
+    'vcombined': formats.ApacheVCombined,
+    'custom': formats.ApacheCustom,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5) or sys.argv[3] not in output_formats:
+        names = '|'.join(output_formats)
+        print(
+            f'usage: {sys.argv[0]} SOURCE DESTINATION {names} [DOMAIN]',
+            file=sys.stderr)
+        sys.exit(1)
+    source, destination, name = sys.argv[1:4]
+    domain = sys.argv[4] if len(sys.argv) == 5 else None
+
+    # Input format is detected, output compressed by file extension
+    input_format = formats.detect_format(source, domain, binary=True)
+    class_ = output_formats[name]
+    if issubclass(class_, formats.ApacheCommon):
+        output_format = class_(domain)
+    else:
+        output_format = class_()
+
+    start = perf_counter()
+    stream = formats.convert(
+        source, destination, output_format, input_format,
+        quarantine=sys.stderr)
+    elapsed = perf_counter() - start
+    print(
+        f"Converted {stream.parsed:,} lines from "
+        f"{type(input_format).__name__} in {elapsed:.2f} seconds.", end=' ')
+    print(f"{round(stream.lines / elapsed):,} lines per second.")
+    if stream.failed:
+        print(f"{stream.failed:,} bad lines skipped: {stream.totals()}")
@@ -52,7 +52,7 @@ class DNSCacheReader:
         """
         try:
             timestamp, ip, hostname = line.split()
-            ip = utils.ip4_quad2int(ip)
+            ip = utils.ip2int(ip)
             timestamp = int(timestamp) * 60
             hostname = None if hostname == '*' else hostname.lower()
         except (ValueError, socket.error):
@@ -91,7 +91,7 @@ class DNSCacheWriter:
         "Write a dns Record object to output"
         assert isinstance(record, dns.Record)
         timestamp = record.timestamp//60
-        ip = utils.ip4_int2quad(record.ip)
+        ip = utils.int2ip(record.ip)
         hostname = record.hostname
         if hostname is None:
             hostname = '*'
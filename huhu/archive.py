@@ -0,0 +1,561 @@
+"""
+Columnar archive of parsed requests, read back by memory-mapping the file.
+
+Parsing compressed log files again, every time a report is run, is slow.
+An archive holds the requests already parsed, column by column, in blocks
+of up to `DEFAULT_BLOCK_SIZE` requests each:
+
+timestamp
+    Differences from the previous request, as 32-bit integers.  The first
+    timestamp of each block is kept in the index.
+ip
+    64-bit integers, -1 if missing.  IPv6 addresses are stored as -2 minus
+    their position in a table of IPv6 addresses.
+status
+    16-bit integers, -1 if missing.
+size
+    64-bit integers, -1 if missing.
+domain, host, path, referrer, user_agent
+    32-bit codes into a table of strings shared by the whole file.  Zero is
+    None.
+
+The index records the smallest and largest timestamps of every block, so
+that readers skip blocks outside of a time range.  Columns are read through
+`memoryview` objects on the memory-mapped file, without copying.
+
+The file starts with `MAGIC`, followed by the blocks, the string table, and
+the table of IPv6 addresses.  The index, in JSON, comes last, followed by
+its offset and length, and `MAGIC` again.
+"""
+
+from array import array
+import collections
+import contextlib
+import itertools
+import json
+import mmap
+import operator
+import os
+import struct
+import sys
+
+from . import formats
+from . import utils
+from .request import (
+    DEFAULT_LOAD_CHUNK, RequestBatch, _request_from_values)
+
+
+# First and last bytes of every archive
+MAGIC = b'HUHUARC1'
+
+# Maximum number of requests in each block
+DEFAULT_BLOCK_SIZE = 65_536
+
+# Array typecode of every column, in the same order as the fields of `Request`
+TYPECODES = {
+    'domain': 'I',
+    'ip': 'q',
+    'host': 'I',
+    'timestamp': 'i',
+    'path': 'I',
+    'status': 'h',
+    'size': 'q',
+    'referrer': 'I',
+    'user_agent': 'I',
+}
+
+STRING_FIELDS = ('domain', 'host', 'path', 'referrer', 'user_agent')
+
+# Offset and length of the index, and magic bytes, at the end of the file
+_FOOTER = struct.Struct('<QQ8s')
+
+# Columns are aligned to this many bytes
+_ALIGNMENT = 8
+
+
+Block = collections.namedtuple('Block', 'count min_timestamp max_timestamp')
+
+
+class ArchiveWriter:
+    """
+    Write requests to a new archive file.
+
+    For example::
+
+        >>> with ArchiveWriter('access.huhu') as writer:
+        ...     writer.write(requests)
+
+    Every request must have a timestamp.  The file is incomplete until the
+    writer is closed, and is deleted if the `with` block raises an exception.
+    """
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Initialise object.
+
+        Args:
+            path (str): Path of archive file, which is overwritten.
+            block_size (int): Maximum number of requests in each block.
+        """
+        self.path = path
+        self.block_size = block_size
+        self.count = 0
+        self._blocks = []
+        self._codes = {None: 0}
+        self._ip6 = {}
+        # Timestamps are kept whole until their block is written
+        self._columns = {
+            name: array('q' if name == 'timestamp' else typecode)
+            for name, typecode in TYPECODES.items()}
+        self._fp = open(path, 'wb')
+        self._fp.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, requests):
+        """
+        Add requests to the archive.
+
+        Args:
+            requests: Iterable of `Request` objects or 9-tuples, or a
+                `RequestBatch`.
+
+        Raises:
+            ValueError: If a request has no timestamp.
+        """
+        if isinstance(requests, RequestBatch):
+            requests = requests.rows()
+        columns = self._columns
+        domains = columns['domain'].append
+        ips = columns['ip'].append
+        hosts = columns['host'].append
+        timestamps = columns['timestamp']
+        add_timestamp = timestamps.append
+        paths = columns['path'].append
+        statuses = columns['status'].append
+        sizes = columns['size'].append
+        referrers = columns['referrer'].append
+        user_agents = columns['user_agent'].append
+        code = self._codes.get
+        new_code = self._new_code
+        ip4_max = utils.IP4_MAX
+        block_size = self.block_size
+
+        for (domain, ip, host, timestamp, path, status, size, referrer,
+                user_agent) in requests:
+            if timestamp is None:
+                raise ValueError(
+                    "Request without a timestamp cannot be archived")
+            domains(code(domain) or new_code(domain))
+            if ip is None:
+                ip = -1
+            elif ip > ip4_max:
+                ip = self._ip6.setdefault(ip, -2 - len(self._ip6))
+            ips(ip)
+            hosts(code(host) or new_code(host))
+            add_timestamp(timestamp)
+            paths(code(path) or new_code(path))
+            statuses(-1 if status is None else status)
+            sizes(-1 if size is None else size)
+            referrers(code(referrer) or new_code(referrer))
+            user_agents(code(user_agent) or new_code(user_agent))
+            if len(timestamps) >= block_size:
+                self._write_block()
+
+    def close(self):
+        "Write the last block, the tables, and the index, then close the file"
+        if self._fp.closed:
+            return
+        self._write_block()
+        fp = self._fp
+
+        strings = list(self._codes)[1:]
+        text = ''.join(strings).encode('utf-8', 'surrogatepass')
+        ends = array('Q', itertools.accumulate(map(len, strings)))
+        strings_offset = self._align()
+        fp.write(ends.tobytes())
+        fp.write(text)
+
+        ip6_offset = fp.tell()
+        for ip in self._ip6:
+            fp.write(ip.to_bytes(16, 'big'))
+
+        index = json.dumps({
+            'version': 1,
+            'byteorder': sys.byteorder,
+            'count': self.count,
+            'blocks': self._blocks,
+            'strings': [strings_offset, len(strings), len(text)],
+            'ip6': [ip6_offset, len(self._ip6)],
+        }).encode('ascii')
+        index_offset = fp.tell()
+        fp.write(index)
+        fp.write(_FOOTER.pack(index_offset, len(index), MAGIC))
+        fp.close()
+
+    def abort(self):
+        "Close and delete the unfinished file, so that it cannot be read"
+        if self._fp.closed:
+            return
+        self._fp.close()
+        os.remove(self.path)
+
+    def _new_code(self, string):
+        "Give string a new code.  None is zero."
+        if string is None:
+            return 0
+        code = self._codes[string] = len(self._codes)
+        return code
+
+    def _align(self):
+        "Pad file to start a column, and return the offset"
+        fp = self._fp
+        offset = fp.tell()
+        padding = -offset % _ALIGNMENT
+        fp.write(b'\0' * padding)
+        return offset + padding
+
+    def _write_block(self):
+        "Write the requests buffered so far as a block"
+        columns = self._columns
+        timestamps = columns['timestamp']
+        count = len(timestamps)
+        if not count:
+            return
+        first = timestamps[0]
+        differences = array('q', itertools.chain(
+            (0,), map(operator.sub, timestamps[1:], timestamps)))
+        try:
+            columns['timestamp'] = array('i', differences)
+            typecode = 'i'
+        except OverflowError:
+            # Requests too far apart in time for 32 bits
+            columns['timestamp'] = differences
+            typecode = 'q'
+
+        offsets = {}
+        for name, column in columns.items():
+            offsets[name] = self._align()
+            self._fp.write(column.tobytes())
+        self._blocks.append({
+            'count': count,
+            'first': first,
+            'min': min(timestamps),
+            'max': max(timestamps),
+            'timestamp_typecode': typecode,
+            'offsets': offsets,
+            # Columns with missing values, or IPv6 addresses
+            'negative': [
+                name for name in ('ip', 'status', 'size')
+                if min(columns[name]) < 0],
+        })
+        self.count += count
+
+        columns['timestamp'] = timestamps
+        for column in columns.values():
+            del column[:]
+
+
+class ArchiveReader:
+    """
+    Read requests from an archive file, by memory-mapping it.
+
+    For example::
+
+        >>> with ArchiveReader('access.huhu') as reader:
+        ...     for req in reader.iter_requests(start=1551398400):
+        ...         print(req)
+
+    blocks
+        List of `Block` tuples, with the number of requests and the range of
+        timestamps in each block.
+    strings
+        List of the strings in the string table, indexed by code.
+    """
+    def __init__(self, path):
+        """
+        Open archive.
+
+        Args:
+            path (str): Path to archive file.
+
+        Raises:
+            ValueError: If file is not a complete archive, or was written on
+                a computer of a different byte order.
+        """
+        self.path = path
+        with open(path, 'rb') as fp:
+            try:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f"Not a huhu archive: {path!r}") from None
+        view = memoryview(self._mmap)
+        try:
+            if (len(view) < len(MAGIC) + _FOOTER.size or
+                    view[:len(MAGIC)] != MAGIC):
+                raise ValueError(f"Not a huhu archive: {path!r}")
+            offset, length, magic = _FOOTER.unpack(view[-_FOOTER.size:])
+            if magic != MAGIC:
+                raise ValueError(f"Incomplete huhu archive: {path!r}")
+            index = json.loads(bytes(view[offset:offset + length]))
+        except BaseException:
+            view.release()
+            self._mmap.close()
+            raise
+        self._view = view
+        if index['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError(
+                f"Archive has {index['byteorder']} endian byte order: "
+                f"{path!r}")
+
+        self._blocks = index['blocks']
+        self.blocks = [
+            Block(block['count'], block['min'], block['max'])
+            for block in self._blocks]
+        self.count = index['count']
+
+        offset, count, length = index['strings']
+        ends = view[offset:offset + count * 8].cast('Q')
+        text = str(
+            view[offset + count * 8:offset + count * 8 + length],
+            'utf-8', 'surrogatepass')
+        self.strings = [None]
+        self.strings.extend(map(
+            text.__getitem__,
+            map(slice, itertools.chain((0,), ends), ends)))
+        ends.release()
+
+        offset, count = index['ip6']
+        self._ip6 = [
+            int.from_bytes(view[start:start + 16], 'big')
+            for start in range(offset, offset + count * 16, 16)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        """
+        Unmap the file.
+
+        Raises:
+            BufferError: If views from `columns()` have not been released.
+        """
+        if not self._mmap.closed:
+            self._view.release()
+            self._mmap.close()
+
+    def columns(self, index):
+        """
+        The raw columns of a block, without copying.
+
+        Timestamps are differences from the previous request, and strings
+        are codes into `strings`.  The views must be released before the
+        reader is closed.
+
+        Args:
+            index (int): Block number.
+
+        Returns:
+            Dictionary of `memoryview` objects, keyed by field name.
+        """
+        block = self._blocks[index]
+        count = block['count']
+        views = {}
+        for name, typecode in TYPECODES.items():
+            if name == 'timestamp':
+                typecode = block['timestamp_typecode']
+            start = block['offsets'][name]
+            length = count * array(typecode).itemsize
+            views[name] = self._view[start:start + length].cast(typecode)
+        return views
+
+    def iter_requests(
+            self, domain=None, start=None, end=None, status=None,
+            output='requests'):
+        """
+        Read requests from the archive, in the order they were written.
+
+        Blocks outside of the time range are skipped without being read.
+
+        Args:
+            domain (str): Only read requests for this domain.
+            start (int): Only read requests at or after this timestamp.
+            end (int): Only read requests before this timestamp.
+            status (int): Only read requests with this status.
+            output (str): What to yield, as per
+                `request.RequestDB.iter_requests()`.  Batches are whole
+                blocks, less any requests filtered out.
+
+        Raises:
+            ValueError: If output is not known.
+
+        Returns:
+            Generator.
+        """
+        if output not in ('requests', 'tuples', 'batches'):
+            raise ValueError(f"Unknown output: {output!r}")
+        batches = self._iter_blocks(domain, start, end, status)
+        if output == 'batches':
+            return (RequestBatch(columns) for columns in batches)
+        rows = itertools.chain.from_iterable(
+            zip(*(columns[name] for name in TYPECODES))
+            for columns in map(_nulls, batches))
+        if output == 'tuples':
+            return rows
+        return map(_request_from_values, rows)
+
+    def _iter_blocks(self, domain, start, end, status):
+        """
+        Generate the columns of each block, for `iter_requests()`.
+
+        Integer columns are arrays, with missing values stored as -1, as per
+        `RequestBatch`, and the others are lists.
+        """
+        code = None
+        if domain is not None:
+            try:
+                code = self.strings.index(domain, 1)
+            except ValueError:
+                return
+
+        for index, block in enumerate(self._blocks):
+            if start is not None and block['max'] < start:
+                continue
+            if end is not None and block['min'] >= end:
+                continue
+            views = self.columns(index)
+            try:
+                columns = self._decode(block, views)
+                selectors = []
+                if code is not None:
+                    selectors.append(map(code.__eq__, views['domain']))
+                if status is not None:
+                    selectors.append(map(status.__eq__, views['status']))
+                if start is not None and block['min'] < start:
+                    selectors.append(
+                        map(start.__le__, columns['timestamp']))
+                if end is not None and block['max'] >= end:
+                    selectors.append(map(end.__gt__, columns['timestamp']))
+                if len(selectors) == 1:
+                    selectors = list(selectors[0])
+                elif selectors:
+                    selectors = list(map(all, zip(*selectors)))
+            finally:
+                for view in views.values():
+                    view.release()
+            if selectors:
+                columns = _select(columns, selectors)
+                if not len(columns['timestamp']):
+                    continue
+            yield columns
+
+    def _decode(self, block, views):
+        "Copy columns out of the views of a block"
+        strings = self.strings.__getitem__
+        columns = {}
+        for name in STRING_FIELDS:
+            columns[name] = list(map(strings, views[name]))
+        columns['timestamp'] = array('q', itertools.islice(
+            itertools.accumulate(views['timestamp'], initial=block['first']),
+            1, None))
+        columns['status'] = array('q', views['status'])
+        columns['size'] = array('q', views['size'])
+        ips = views['ip'].tolist()
+        if 'ip' in block['negative']:
+            ip6 = self._ip6
+            ips = [
+                ip if ip >= 0 else None if ip == -1 else ip6[-2 - ip]
+                for ip in ips]
+        columns['ip'] = ips
+        return columns
+
+
+def _select(columns, selectors):
+    "Keep only the values of columns where selectors are true"
+    selected = {}
+    for name, column in columns.items():
+        values = itertools.compress(column, selectors)
+        selected[name] = (
+            array(column.typecode, values) if isinstance(column, array)
+            else list(values))
+    return selected
+
+
+def _nulls(columns):
+    "Replace -1 in integer columns with None, for plain tuples"
+    for name in RequestBatch.INTEGER_FIELDS:
+        column = columns[name]
+        if min(column, default=0) < 0:
+            columns[name] = [None if value < 0 else value for value in column]
+    return columns
+
+
+def archive_logs(
+        paths, destination, format_=None, block_size=DEFAULT_BLOCK_SIZE,
+        quarantine=None):
+    """
+    Parse log files into a new archive.
+
+    Args:
+        paths: Iterable of paths to log files, which may be compressed.
+        destination (str): Path to archive file, which is overwritten.
+        format_: Format object, or None to use `formats.detect_format()` on
+            each file.
+        block_size (int): Maximum number of requests in each block.
+        quarantine: Optional path, or open file, to write the bad lines of
+            every file to.
+
+    Returns:
+        Dictionary of the exhausted `parser.ParseStream` of every file, by
+        path, for their counts of lines.
+    """
+    streams = {}
+    with contextlib.ExitStack() as stack:
+        if isinstance(quarantine, (str, os.PathLike)):
+            # Opened just once, as every stream would overwrite it
+            quarantine = stack.enter_context(open(quarantine, 'wb'))
+        writer = stack.enter_context(ArchiveWriter(destination, block_size))
+        for path in paths:
+            input_format = format_
+            if input_format is None:
+                input_format = formats.detect_format(path, binary=True)
+            mode = 'rb' if input_format.binary else 'rt'
+            with utils.magic_open(path, mode, errors='replace') as fp:
+                stream = input_format.parse_stream(fp, quarantine)
+                try:
+                    writer.write(stream)
+                finally:
+                    stream.close()
+            streams[path] = stream
+    return streams
+
+
+def load_archive(
+        db, path, start=None, end=None, chunk_size=DEFAULT_LOAD_CHUNK):
+    """
+    Add the requests in an archive to a database.
+
+    Args:
+        db: `request.RequestDB` object, or anything else with a
+            `load_requests()` method.
+        path (str): Path to archive file.
+        start, end (int): Only add requests within this time range.
+        chunk_size (int): Maximum number of requests in each transaction.
+    """
+    with ArchiveReader(path) as reader:
+        db.load_requests(
+            reader.iter_requests(start=start, end=end, output='tuples'),
+            chunk_size)
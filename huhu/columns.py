@@ -0,0 +1,296 @@
+"""
+Export requests from a `request.RequestDB` as NumPy arrays.
+
+Requires NumPy, which is otherwise not needed by huhu.
+
+The integer columns of 'requests_base' are read without creating a Python
+object for every request.  SQLite joins each column of a range of rows into
+a single string, using `group_concat()`, which NumPy then parses.  The
+domains and paths are given as ids, along with arrays to look them up in,
+so that reports run as vectorised operations over whole columns.
+
+Arrays may be cached as '.npy' files, and are memory-mapped from them,
+rather than read into memory, on the next run.
+"""
+
+import json
+import logging
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .request import PERIODS
+
+
+logger = logging.getLogger(__name__)
+
+
+# Columns exported, and the SQL used to read each from 'requests_base'.
+# Missing integers are -1, as per `request.RequestBatch`, while missing ids
+# are zero, as per the rollup tables.  IPv6 addresses are -1 too, as they
+# need more than 64 bits.
+COLUMNS = {
+    'timestamp': "coalesce(timestamp, -1)",
+    'ip': "CASE WHEN typeof(ip)='integer' THEN ip ELSE -1 END",
+    'status': "coalesce(status, -1)",
+    'size': "coalesce(size, -1)",
+    'domain_id': "coalesce(domain_id, 0)",
+    'path_id': "coalesce(path_id, 0)",
+}
+
+# Number of rows of 'requests_base' read by each query
+DEFAULT_EXPORT_CHUNK = 1_000_000
+
+# Name of file holding details of the cached arrays
+CACHE_INFO = 'columns.json'
+
+
+def _require_numpy():
+    "Raise ImportError if NumPy is not installed"
+    if numpy is None:
+        raise ImportError(
+            "NumPy is required to export columns, try: pip install numpy")
+
+
+class RequestColumns:
+    """
+    Requests held as NumPy arrays, one for each column of 'requests_base'.
+
+    Every array in `COLUMNS` is an attribute, eg. `columns.status`, all of
+    type int64 and of the same length.  The 'domains' and 'paths' attributes
+    are arrays of strings indexed by id, with None for id zero, so that
+    `columns.paths[columns.path_id]` is the path of every request.
+
+    The reports take the same arguments, and give the same results, as
+    those of `request.RequestDB`.
+    """
+    def __init__(self, arrays, domains, paths):
+        """
+        Initialise object.
+
+        Args:
+            arrays (dict): NumPy array for each column, by name.
+            domains, paths: Object arrays of strings, indexed by id.
+        """
+        for name in COLUMNS:
+            setattr(self, name, arrays[name])
+        self.domains = domains
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def select(self, domain=None, start=None, end=None, status=None):
+        """
+        Boolean mask of the requests matching the given filters.
+
+        Requests without a timestamp never match, as per the reports of
+        `request.RequestDB`.
+
+        Args:
+            domain, start, end, status: Filters, as per
+                `request.RequestDB.requests_per_period()`.
+
+        Returns:
+            NumPy array of bool.
+        """
+        mask = self.timestamp >= 0
+        if domain is not None:
+            ids = numpy.flatnonzero(self.domains == domain)
+            mask &= self.domain_id == (ids[0] if len(ids) else -1)
+        if status is not None:
+            mask &= self.status == status
+        if start is not None:
+            mask &= self.timestamp >= start
+        if end is not None:
+            mask &= self.timestamp < end
+        return mask
+
+    def requests_per_period(
+            self, period='day', domain=None, start=None, end=None,
+            status=None):
+        """
+        Count requests, and bytes served, in every period of time.
+
+        Args:
+            period: One of 'hour', 'day', or 'month', or a number of seconds.
+            domain, start, end, status: Filters, as per `select()`.
+
+        Raises:
+            ValueError: If period is not known.
+
+        Returns:
+            List of (period, requests, bytes) 3-tuples, in order of period.
+            Requests without a timestamp are left out.
+        """
+        if period != 'month':
+            seconds = PERIODS.get(period, period)
+            if not isinstance(seconds, int) or seconds <= 0:
+                raise ValueError(f"Unknown period: {period!r}")
+        mask = self.select(domain, start, end, status)
+        timestamps = self.timestamp[mask]
+        if period == 'month':
+            # Calendar months are not a fixed number of seconds
+            buckets = timestamps.astype('datetime64[s]').astype(
+                'datetime64[M]').astype('datetime64[s]').astype(numpy.int64)
+        else:
+            buckets = timestamps // seconds * seconds
+        sizes = self.size[mask]
+        periods, inverse = numpy.unique(buckets, return_inverse=True)
+        requests = numpy.bincount(inverse, minlength=len(periods))
+        served = numpy.bincount(
+            inverse, weights=numpy.maximum(sizes, 0), minlength=len(periods))
+        return list(zip(
+            periods.tolist(), requests.tolist(),
+            served.astype(numpy.int64).tolist()))
+
+    def top_paths(
+            self, limit=10, domain=None, start=None, end=None, status=None):
+        """
+        Find the most requested paths.
+
+        Args:
+            limit (int): Maximum number of paths to return, or None for
+                every path.
+            domain, start, end, status: Filters, as per `select()`.
+
+        Returns:
+            List of 2-tuples of path and number of requests, most first.
+            Requests without a path are left out.
+        """
+        path_ids = self.path_id[self.select(domain, start, end, status)]
+        # Requests without a path are left out, as per SQL
+        path_ids = path_ids[path_ids != 0]
+        hits = numpy.bincount(path_ids, minlength=len(self.paths))
+        ids = numpy.flatnonzero(hits)
+        # Most hits first, then lowest id, as per SQL
+        ids = ids[numpy.lexsort((ids, -hits[ids]))][:limit]
+        return list(zip(self.paths[ids].tolist(), hits[ids].tolist()))
+
+    def status_counts(self, domain=None, start=None, end=None):
+        """
+        Count requests by their status.
+
+        Returns:
+            Dictionary of number of requests, keyed by status, eg. 200.
+            Requests without a status are counted under None.
+        """
+        statuses = self.status[self.select(domain, start, end)]
+        values, counts = numpy.unique(statuses, return_counts=True)
+        return {
+            (None if status == -1 else status): count
+            for status, count in zip(values.tolist(), counts.tolist())}
+
+    def bytes_served(self, domain=None, start=None, end=None, status=None):
+        "Total bytes served, as an int"
+        sizes = self.size[self.select(domain, start, end, status)]
+        return int(numpy.maximum(sizes, 0).sum())
+
+
+def export_columns(db, chunk_size=DEFAULT_EXPORT_CHUNK):
+    """
+    Read every request in database into NumPy arrays.
+
+    Args:
+        db: `request.RequestDB` object.
+        chunk_size (int): Number of rows read by each query.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+
+    Returns:
+        `RequestColumns` object.
+    """
+    _require_numpy()
+    con = db._connection
+    first, last = con.execute(
+        "SELECT min(id), max(id) FROM requests_base;").fetchone()
+    select = ', '.join(
+        f"group_concat({expression})" for expression in COLUMNS.values())
+    parts = {name: [] for name in COLUMNS}
+    if first is not None:
+        for low in range(first, last + 1, chunk_size):
+            row = con.execute(
+                f"SELECT {select} FROM requests_base "
+                "WHERE id>=? AND id<?;", (low, low + chunk_size)).fetchone()
+            if row[0] is None:
+                continue
+            for name, text in zip(COLUMNS, row):
+                parts[name].append(
+                    numpy.fromstring(text, dtype=numpy.int64, sep=','))
+    arrays = {
+        name: numpy.concatenate(chunks) if chunks else numpy.empty(
+            0, dtype=numpy.int64)
+        for name, chunks in parts.items()}
+    return RequestColumns(arrays, *_lookups(db))
+
+
+def load_columns(db, folder, chunk_size=DEFAULT_EXPORT_CHUNK):
+    """
+    Memory-map arrays cached in folder, exporting them first if need be.
+
+    Arrays are exported again if requests have been added to, or removed
+    from, the database since they were cached.  The domains and paths are
+    always read from the database.  The cache is only checked against the
+    number of requests, and their largest id, so requests updated in place
+    are not noticed: delete the folder to export them again.
+
+    Args:
+        db: `request.RequestDB` object.
+        folder (str): Folder of '.npy' files, created if need be.
+        chunk_size (int): Number of rows read by each query.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+
+    Returns:
+        `RequestColumns` object, with read-only arrays.
+    """
+    _require_numpy()
+    count, last = db._connection.execute(
+        "SELECT count(*), max(id) FROM requests_base;").fetchone()
+    info_path = os.path.join(folder, CACHE_INFO)
+    try:
+        with open(info_path) as fp:
+            info = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        info = None
+
+    if info != {'count': count, 'last_id': last}:
+        logger.info("Exporting %s requests to %r", count, folder)
+        columns = export_columns(db, chunk_size)
+        os.makedirs(folder, exist_ok=True)
+        for name in COLUMNS:
+            numpy.save(os.path.join(folder, f"{name}.npy"),
+                       getattr(columns, name))
+        with open(info_path, 'w') as fp:
+            json.dump({'count': count, 'last_id': last}, fp)
+
+    arrays = {
+        name: numpy.load(os.path.join(folder, f"{name}.npy"), mmap_mode='r')
+        for name in COLUMNS}
+    return RequestColumns(arrays, *_lookups(db))
+
+
+def _lookups(db):
+    """
+    Read domains and paths into arrays indexed by their ids.
+
+    Returns:
+        2-tuple of object arrays.
+    """
+    con = db._connection
+    lookups = []
+    for table, column in (
+            ('requests_hostnames', 'hostname'), ('requests_paths', 'path')):
+        rows = con.execute(f"SELECT id, {column} FROM {table};").fetchall()
+        array = numpy.full(
+            max((id_ for id_, _ in rows), default=0) + 1, None, dtype=object)
+        if rows:
+            ids, values = zip(*rows)
+            array[list(ids)] = values
+        lookups.append(array)
+    return lookups
@@ -5,7 +5,7 @@ DNS services module.
 import sqlite3
 import time
 
-from . import utils
+from . import request, utils
 
 
 class Record:
@@ -16,7 +16,7 @@ class Record:
 
     ip
         IP address of the requesting host as an integer, eg. 3221226219
-        The util module contains functions to convert the format.
+        IPv4 or IPv6, as per `utils.ip2int()`.
     hostname
         Human-readable hostname of IP address, eg. 'lost.co.nz'
     timestamp
@@ -37,8 +37,8 @@ class Record:
 
     def __repr__(self):
         date = time.strftime('%Y-%m-%d', time.gmtime(self.timestamp))
-        ip4 = utils.ip4_int2quad(self.ip)
-        return f"{date} {ip4:<15} {self.hostname}"
+        ip = utils.int2ip(self.ip)
+        return f"{date} {ip:<15} {self.hostname}"
 
     def __getitem__(self, index):
         # TODO Is this being used?
@@ -72,6 +72,10 @@ class DNSCache:
         records are useful to avoid re-checking bad address over and over again.
         The flush_bad() method can be used to periodically re-check bad IPs.
         """
+        ip2sql = utils.ip2sql
+        records = (
+            (ip2sql(ip), timestamp, hostname)
+            for ip, timestamp, hostname in records)
         with self._connection as con:
             query = (
                 "INSERT OR REPLACE INTO "
@@ -79,6 +83,18 @@ class DNSCache:
                 "    VALUES (?, ?, ?);")
             con.executemany(query, records)
 
+    def bulk_import(self, **kwargs):
+        """
+        Context manager to speed up adding lots of records.
+
+        Args:
+            kwargs: Passed to `request.bulk_import()`.
+
+        Return:
+            Context manager.
+        """
+        return request.bulk_import(self._connection, **kwargs)
+
     def count(self):
         """
         Count the total number of DNS records in cache.
@@ -134,12 +150,12 @@ class DNSCache:
 
     def ip2hostname(self, ip):
         """
-        Return a single hostname for given IP address.
+        Return a single hostname for given IPv4 or IPv6 address.
         """
-        ip32 = utils.ip4_quad2int(ip)
+        ip = utils.ip2sql(utils.ip2int(ip))
         with self._connection as con:
             query = "SELECT hostname FROM dns_cache WHERE ip=?"
-            cur = con.execute(query, (ip32,))
+            cur = con.execute(query, (ip,))
             (hostname,) = cur.fetchone()
             return hostname
 
@@ -155,20 +171,55 @@ class DNSCache:
                 "type='table' and name='dns_cache'")
             name = cur.fetchone()
             if name is not None:
+                self._upgrade_schema()
                 return
 
             schema = """
 
 BEGIN;
 
+-- Addresses are integers for IPv4, but 16-byte BLOBs for IPv6
 CREATE TABLE dns_cache
 (
-    ip        INTEGER PRIMARY KEY,
+    ip        NOT NULL PRIMARY KEY,
     timestamp INTEGER,
     hostname  TEXT
-);
+) WITHOUT ROWID;
 
 COMMIT;
 
         """
         con.executescript(schema)
+
+    def _upgrade_schema(self):
+        """
+        Upgrade caches created when only IPv4 addresses were supported.
+
+        Their 'ip' column is an alias for the row id, so cannot hold IPv6
+        addresses.
+        """
+        with self._connection as con:
+            columns = con.execute("PRAGMA table_info(dns_cache);").fetchall()
+        types = {column[1]: column[2] for column in columns}
+        if types.get('ip') != 'INTEGER':
+            return
+
+        self._connection.executescript("""
+
+BEGIN;
+
+ALTER TABLE dns_cache RENAME TO dns_cache_ip4;
+
+CREATE TABLE dns_cache
+(
+    ip        NOT NULL PRIMARY KEY,
+    timestamp INTEGER,
+    hostname  TEXT
+) WITHOUT ROWID;
+
+INSERT INTO dns_cache SELECT ip, timestamp, hostname FROM dns_cache_ip4;
+DROP TABLE dns_cache_ip4;
+
+COMMIT;
+
+        """)
@@ -15,19 +15,491 @@ format(request)
     differ.
 """
 
+import array
+import functools
 import re
 
+from . import interning
 from . import parser
 from . import request
 from . import utils
 
 
+# Number of lines written at once by `convert()`
+DEFAULT_WRITE_BATCH = 10_000
+
+
+def compile_parse(
+        log_format, domain=None, as_tuple=False, binary=False, errors=None,
+        fields=None, strict=True, interners=None):
+    """
+    Build a function to go straight from a raw line to a request.
+
+    The function is generated as Python source specialised for the given log
+    format, so that tokenising and canonicalising a line happen together, with
+    no per-field dispatch.  Its results are the same as those from
+    `ApacheCustom.cannonise()`.  The generated code is cached by format.
+
+    In binary mode lines are bytes, straight from a file opened with
+    `utils.magic_open(path, 'rb')`.  Only the fields that are kept are
+    decoded, so a stray invalid byte elsewhere in the line is harmless.
+
+    Args:
+        log_format (str): Apache log format string.
+        domain (str): Use for every request, rather than the log's own.
+        as_tuple (bool): Return plain 9-tuples rather than Request objects.
+        binary (bool): Parse lines of bytes, rather than str.
+        errors (dict): Binary mode only.  How to handle UTF-8 decoding errors
+            for each text field, eg. {'user_agent': 'strict'}.  Overrides
+            those in `DECODE_ERRORS`.
+        fields (iterable): Names of the only request fields to fill in, eg.
+            ['status'].  The others are left as None, and the parts of the
+            line they come from are never extracted or converted.
+        strict (bool): If false, return None for lines that do not match the
+            log format, rather than raising an exception.
+        interners (dict): `interning.Interner` objects to pass the value of
+            text fields through, keyed by field name, eg. from
+            `interning.make_interners()`.
+
+    Returns:
+        Function taking a line of text.  If strict, it raises `ValueError` if
+        the line cannot be parsed, including values that match the log format
+        but cannot be converted, with the original exception chained.  If
+        not strict, such values still raise their own `KeyError` or
+        `OSError`, so that they can be told apart from unmatched lines.
+    """
+    result = 'tuple' if as_tuple else 'request'
+    return _compile(
+        log_format, domain, result, binary, errors, fields, strict, interners)
+
+
+def compile_parse_batch(
+        log_format, domain=None, binary=False, errors=None, fields=None,
+        interners=None):
+    """
+    Build a function to go straight from many raw lines to a request batch.
+
+    As per `compile_parse()`, but the generated function takes an iterable of
+    lines and returns a single `request.RequestBatch`, with no per-line
+    function calls or request objects.  Equal strings in each text column
+    are shared.  Lines that cannot be parsed are skipped, and counted in
+    the batch's `skipped` attribute.
+
+    Args:
+        log_format (str): Apache log format string.
+        domain (str): Use for every request, rather than the log's own.
+        binary (bool): Parse lines of bytes, rather than str.
+        errors (dict): Binary mode only.  See `compile_parse()`.
+        fields (iterable): Names of the only request fields to fill in.
+        interners (dict): See `compile_parse()`.
+
+    Returns:
+        Function taking an iterable of lines.
+    """
+    return _compile(
+        log_format, domain, 'batch', binary, errors, fields, False, interners)
+
+
+def _compile(
+        log_format, domain, result, binary, errors, fields, strict, interners):
+    "Shared implementation of `compile_parse()` and `compile_parse_batch()`"
+    errors = {**DECODE_ERRORS, **(errors or {})}
+    if fields is None:
+        fields = request.Request.__slots__
+    unknown = set(fields).difference(request.Request.__slots__)
+    if unknown:
+        raise ValueError(
+            f"Unknown request fields: {', '.join(sorted(unknown))}")
+    interners = interners or {}
+    unknown = set(interners).difference(_INTERNABLE_FIELDS)
+    if unknown:
+        raise ValueError(f"Cannot intern fields: {', '.join(sorted(unknown))}")
+    code, line_parser = _compile_parse_code(
+        log_format, domain is not None, result, binary,
+        tuple(sorted(errors.items())), frozenset(fields), strict,
+        frozenset(interners))
+    namespace = {
+        **{f'_intern_{field}': intern for field, intern in interners.items()},
+        **{f'_get_{field}': intern.get for field, intern in interners.items()},
+        **parser.CONVERTERS,
+        '_array': array.array,
+        '_convert': line_parser.convert,
+        '_domain': domain,
+        '_ip2int': utils.ip2int,
+        '_new': object.__new__,
+        '_NULL': request.RequestBatch.NULL,
+        '_regex_match': line_parser.regex.match,
+        '_Request': request.Request,
+        '_RequestBatch': request.RequestBatch,
+    }
+    exec(code, namespace)
+    return namespace['parse']
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_parse_code(
+        log_format, fixed_domain, result, binary, errors, fields, strict,
+        interned):
+    """
+    Generate and compile the source code for `compile_parse()`.
+
+    Args:
+        result (str): One of 'request', 'tuple', or 'batch'.
+        interned (frozenset): Names of fields to pass through an interner.
+
+    Returns:
+        2-tuple of code object and the `parser.ApacheLogParser` it was
+        generated from.
+    """
+    # Only extract the parser fields that are needed
+    needed = set()
+    for field in fields:
+        if not (field == 'domain' and fixed_domain):
+            needed.update(_CANNONISE_FIELDS[field])
+    identifiers = parser.ApacheLogParser(log_format).namedtuple._fields
+    line_parser = parser.ApacheLogParser(
+        log_format, binary=binary, fields=needed.intersection(identifiers),
+        typed=True)
+    literal = line_parser.literal
+    identifiers = line_parser.namedtuple._fields
+    statements, expressions = line_parser.tokenizer_source()
+    expressions = line_parser.typed_source(expressions)
+    errors = dict(errors)
+
+    def text(expression, attribute):
+        "Source to decode text field, if needed"
+        if binary:
+            return f"{expression}.decode('utf-8', {errors[attribute]!r})"
+        return expression
+
+    def intern(attribute):
+        "Source to intern text field, trying the interner's `get()` first"
+        return [
+            f"    if {attribute} is not None:",
+            f"        _v = _get_{attribute}({attribute})",
+            f"        {attribute} = _intern_{attribute}({attribute}) "
+            "if _v is None else _v",
+        ]
+
+    # Local variable for each field
+    names = {}
+    for identifier in identifiers:
+        names[identifier] = f'_f{len(names)}'
+
+    # Tokenise, falling back to the regex.  Source for the body of the
+    # function that handles a single line is built first.
+    source = ['    line = line.strip()']
+    source.extend(f'    {statement}' for statement in statements)
+    source.append('    if _ok:')
+    for identifier, expression in zip(identifiers, expressions):
+        source.append(f'        {names[identifier]} = {expression}')
+    if not names:
+        source.append('        pass')
+    source.append('    else:')
+    source.append('        match = _regex_match(line)')
+    source.append('        if match is None:')
+    if strict:
+        source.append(
+            '            raise ValueError(f"Bogus line found: \'{line}\'")')
+    elif result == 'batch':
+        source.append('            _skipped += 1')
+        source.append('            continue')
+    else:
+        source.append('            return None')
+    if names:
+        source.append(
+            f"        {', '.join(names.values())}, = _convert(match.groups())")
+
+    # Cannonise
+    domain = [names[name] for name in ('request_header_host', 'server_name')
+              if name in names]
+    if 'domain' not in fields:
+        source.append('    domain = None')
+    elif fixed_domain:
+        source.append('    domain = _domain')
+    elif domain:
+        source.append(f"    domain = {' or '.join(domain)}")
+        source.append(f"    if not domain or domain == {literal('-')}:")
+        source.append('        domain = None')
+        source.append('    else:')
+        source.append(
+            f"        domain = {text('domain', 'domain')}"
+            ".lower().replace('www.', '')")
+    else:
+        source.append('    domain = None')
+    if 'domain' in interned and 'domain' in fields and not fixed_domain:
+        source.extend(intern('domain'))
+
+    # Numbers and times are already converted by the typed parser, as are
+    # IP addresses.  Anything else left in the remote host is an error.
+    if 'remote_host' in names:
+        source.append(f"    ip = {names['remote_host']}")
+        source.append("    if ip.__class__ is str:")
+        source.append("        ip = _ip2int(ip)")
+    else:
+        source.append('    ip = None')
+
+    timestamp = names.get('time_received', 'None')
+    source.append(f"    timestamp = {timestamp}")
+
+    if 'request' in names:
+        source.append(f"    path = {names['request']}.split()")
+        source.append(
+            f"    path = {text('path[1]', 'path')}.partition('?')[0] "
+            "if len(path) > 1 else None")
+        source.append("    if not path or path == '*':")
+        source.append('        path = None')
+    else:
+        source.append('    path = None')
+    if 'path' in interned and 'request' in names:
+        source.extend(intern('path'))
+
+    source.append(f"    status = {names.get('status', 'None')}")
+    source.append(f"    size = {names.get('response_size', 'None')}")
+
+    for attribute, identifier in (
+            ('referrer', 'request_header_referer'),
+            ('user_agent', 'request_header_user_agent')):
+        if identifier in names:
+            value = names[identifier]
+            source.append(
+                f"    {attribute} = None if {value} == {literal('-')} "
+                f"else {text(value, attribute)}")
+            if attribute in interned:
+                source.extend(intern(attribute))
+        else:
+            source.append(f'    {attribute} = None')
+
+    # Conversion errors, eg. KeyError from a bad month, are ValueErrors too
+    if strict and result != 'batch':
+        source = [
+            '    try:',
+            *(f'    {line}' for line in source),
+            '    except (KeyError, OSError) as e:',
+            '        raise ValueError(',
+            '            f"Bad value in line: \'{line}\'") from e',
+        ]
+
+    # Build result
+    if result == 'tuple':
+        source.insert(0, 'def parse(line):')
+        source.append(
+            '    return (domain, ip, None, timestamp, path, '
+            'status, size, referrer, user_agent)')
+    elif result == 'request':
+        source.insert(0, 'def parse(line):')
+        source.append('    req = _new(_Request)')
+        for attribute in request.Request.__slots__:
+            value = 'None' if attribute == 'host' else attribute
+            source.append(f'    req.{attribute} = {value}')
+        source.append('    return req')
+    else:
+        source = _batch_source(source)
+
+    code = compile('\n'.join(source), f'<parse {log_format!r}>', 'exec')
+    return code, line_parser
+
+
+def _batch_source(body):
+    """
+    Wrap source for parsing a single line into a loop building columns.
+
+    Args:
+        body (list): Source lines for the body of a single line function,
+            which leaves its results in local variables named after the
+            fields of `request.Request`.
+
+    Returns:
+        List of source lines.
+    """
+    attributes = [
+        attribute for attribute in request.Request.__slots__
+        if attribute != 'host']
+    source = ['def parse(lines):', '    _intern = {}.setdefault']
+    for attribute in attributes:
+        if attribute in request.RequestBatch.INTEGER_FIELDS:
+            source.append(f"    _col_{attribute} = _array('q')")
+        else:
+            source.append(f"    _col_{attribute} = []")
+        source.append(f"    _add_{attribute} = _col_{attribute}.append")
+    source.append('    _skipped = 0')
+    source.append('    for line in lines:')
+    source.append('        try:')
+    source.extend(f'        {line}' for line in body)
+    source.append('        except (KeyError, OSError, ValueError):')
+    source.append('            _skipped += 1')
+    source.append('            continue')
+    for attribute in attributes:
+        if attribute in request.RequestBatch.INTEGER_FIELDS:
+            source.append(
+                f"        _add_{attribute}(_NULL if {attribute} is None "
+                f"else {attribute})")
+        else:
+            source.append(
+                f"        _add_{attribute}(_intern({attribute}, {attribute}))")
+    columns = ', '.join(
+        f"{attribute!r}: _col_{attribute}" for attribute in attributes)
+    source.append(f'    return _RequestBatch({{{columns}}}, _skipped)')
+    return source
+
+
+def compile_format(log_format):
+    """
+    Build a function to go straight from a request to a raw line.
+
+    The complement of `compile_parse()`, generated and cached in the same
+    way.  Fields missing from the request, and directives that have no
+    request field, are written as '-'.  Text fields are written just as they
+    are stored, which is as they were logged, escapes and all.  Requests are
+    always written as GET requests using HTTP/1.1, and timestamps in UTC.
+
+    Args:
+        log_format (str): Apache log format string.
+
+    Returns:
+        Function taking a `request.Request`, and returning a line of text
+        without a trailing newline.
+    """
+    code = _compile_format_code(log_format)
+    namespace = {
+        '_epoch2date': utils.epoch2date,
+        '_int2ip': utils.int2ip,
+    }
+    exec(code, namespace)
+    return namespace['format']
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_format_code(log_format):
+    "Generate and compile the source code for `compile_format()`"
+    line_parser = parser.ApacheLogParser(log_format)
+    elements = log_format.split()
+    identifiers = line_parser.translate_directives(elements)
+    source = ['def format(req):']
+    template = []
+    names = 0
+    for element, identifier in zip(elements, identifiers):
+        if element == '%B':
+            attribute, expression = 'size', '0 if {0} is None else {0}'
+        elif identifier in _FORMAT_SOURCES:
+            attribute, expression = _FORMAT_SOURCES[identifier]
+        else:
+            attribute, expression = None, None
+        if attribute is None:
+            value = '-'
+        else:
+            name = f'_v{names}'
+            names += 1
+            source.append(f'    {name} = req.{attribute}')
+            source.append(f'    {name} = {expression.format(name)}')
+            value = f'{{{name}}}'
+        template.append(f'"{value}"' if '"' in element else value)
+    source.append(f"    return f{' '.join(template)!r}")
+    return compile('\n'.join(source), f'<format {log_format!r}>', 'exec')
+
+
+# Request attribute, and expression to give its value, for parser fields
+# written by `compile_format()`
+_FORMAT_SOURCES = {
+    'remote_host': ('ip', "'-' if {0} is None else _int2ip({0})"),
+    'remote_ip_address': ('ip', "'-' if {0} is None else _int2ip({0})"),
+    'time_received': (
+        'timestamp', "'-' if {0} is None else _epoch2date({0})"),
+    'request': (
+        'path', "'-' if {0} is None else 'GET ' + {0} + ' HTTP/1.1'"),
+    'request_path': ('path', "'-' if {0} is None else {0}"),
+    'status': ('status', "'-' if {0} is None else {0}"),
+    'response_size': ('size', "'-' if {0} is None else {0}"),
+    'request_header_referer': ('referrer', "'-' if {0} is None else {0}"),
+    'request_header_user_agent': (
+        'user_agent', "'-' if {0} is None else {0}"),
+    'request_header_host': ('domain', "'-' if {0} is None else {0}"),
+    'server_name': ('domain', "'-' if {0} is None else {0}"),
+    'canonical_server_name': ('domain', "'-' if {0} is None else {0}"),
+}
+
+
+def convert(
+        source, destination, output_format, input_format=None,
+        batch_size=DEFAULT_WRITE_BATCH, quarantine=None):
+    """
+    Convert a log file from one format to another, a batch at a time.
+
+    Either file may be compressed, as per `utils.magic_open()`.  Output lines
+    are joined and written a batch at a time, rather than one by one.  Lines
+    that cannot be parsed are skipped.
+
+    Args:
+        source (str): Path to input log file.
+        destination (str): Path to output log file, which is overwritten.
+        output_format: Format object to write lines with.
+        input_format: Format object to read lines with, or None to use
+            `detect_format()`.
+        batch_size (int): Number of lines to write at once.
+        quarantine: Optional path, or open file, to write bad lines to.
+
+    Returns:
+        The exhausted `parser.ParseStream`, for its counts of lines.
+    """
+    if input_format is None:
+        input_format = detect_format(source, binary=True)
+    mode = 'rb' if input_format.binary else 'rt'
+    format_ = output_format.format
+    with utils.magic_open(source, mode, errors='replace') as infile, \
+            utils.magic_open(destination, 'wt') as outfile:
+        stream = input_format.parse_stream(infile, quarantine)
+        write = outfile.write
+        batch = []
+        append = batch.append
+        try:
+            for req in stream:
+                append(format_(req))
+                if len(batch) >= batch_size:
+                    append('')
+                    write('\n'.join(batch))
+                    batch.clear()
+            if batch:
+                append('')
+                write('\n'.join(batch))
+        finally:
+            stream.close()
+    return stream
+
+
+# How to handle decoding errors in text fields, for binary mode parsing
+DECODE_ERRORS = {
+    'domain': 'replace',
+    'path': 'replace',
+    'referrer': 'replace',
+    'user_agent': 'replace',
+}
+
+
+# Request fields that may be given to an interner by `compile_parse()`
+_INTERNABLE_FIELDS = ('domain', 'path', 'referrer', 'user_agent')
+
+
+# Parser fields used by `ApacheCustom.cannonise()` for each request field
+_CANNONISE_FIELDS = {
+    'domain': ('request_header_host', 'server_name'),
+    'ip': ('remote_host',),
+    'host': (),
+    'timestamp': ('time_received',),
+    'path': ('request',),
+    'status': ('status',),
+    'size': ('response_size',),
+    'referrer': ('request_header_referer',),
+    'user_agent': ('request_header_user_agent',),
+}
+
+
 class ApacheCustom:
     """
     Parser for a custom Apache log file format.
     """
+    _domain = None
     _drop_query_regex = re.compile(r'\?.*$')
-    _format = r'"%{Host}i %h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\"'
+    _format = '%{Host}i %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"'
     _field_map = {
         '%a': 'remote_ip_address',
         '%A': 'local_ip_address',
@@ -58,16 +530,44 @@ class ApacheCustom:
         '%V': 'canonical_server_name',  # Server name from UseCanonicalName
     }
 
-    def __init__(self):
+    def __init__(self, binary=False, errors=None, fields=None, intern=True):
         """
         Initialiser.
 
-        Domain name of host is determined from log file, so so domain needs to
-        be passed.
+        Domain name of host is determined from log file, so no domain needs
+        to be passed.
+
+        binary
+            Parse lines of bytes rather than str.  See `compile_parse()`.
+        errors
+            Decoding error handling for binary mode, by request field.
+        fields
+            Only fill in these request fields, leaving the others as None.
+        intern
+            Share equal strings between requests, using the interners in the
+            `interners` attribute.  See the `interning` module.
         """
-        self._domain = None
+        self._options = dict(
+            binary=binary, errors=errors, fields=fields, intern=intern)
+        self.interners = interning.make_interners() if intern else None
+        self._parse = self._compile(compile_parse)
+        self._parse_batch = None
+        self._format_line = compile_format(self._format)
         super().__init__()
 
+    def __getstate__(self):
+        "Generated code cannot be pickled, so keep just enough to rebuild it"
+        return {'domain': self._domain, 'options': self._options}
+
+    def __setstate__(self, state):
+        self._domain = state['domain']
+        ApacheCustom.__init__(self, **state['options'])
+
+    @property
+    def binary(self):
+        "True if lines should be given as bytes, rather than str"
+        return self._options['binary']
+
     def alias(self, name):
         """
         Used by apachelog.parser to rename dictionary keys.
@@ -75,45 +575,108 @@ class ApacheCustom:
         name = name.lower()
         return self._field_map[name]
 
+    def _intern(self, field, value):
+        "Shared copy of value of text field, if interning"
+        if self.interners is None:
+            return value
+        return self.interners[field](value)
+
     def parse(self, line):
-        # Get dictionary of fields from apachelog.parser
-        try:
-            fields = self.parse(line)
-        except parser.ApacheLogParserError:
-            msg = "Bogus line found: '{}'".format(line)
-            raise ValueError(msg)
+        """
+        Create request object from a single line of the log file.
 
-        # Create request object from fields mapping
-        req = request.Request()
+        Uses a function generated specifically for this format, which does
+        the same job as running `cannonise()` over the parser's output.
 
-        # Standardise format, etc..
-        self.cannonise(fields, req)
+        Raises:
+            ValueError: If line could not be parsed.
+        """
+        return self._parse(line)
 
-        return req
+    def format(self, req):
+        """
+        Create a single line of the log file from a request object.
+
+        The line has no trailing newline.  See `compile_format()`.
+        """
+        return self._format_line(req)
+
+    def parse_stream(self, lines, quarantine=None, limit=1000):
+        """
+        Create request objects from many lines, skipping over bad ones.
+
+        Lines that do not match the format are found without raising an
+        exception, which is much faster when logs contain a lot of junk.
+
+        Args:
+            lines: Iterable of lines, eg. an open log file.
+            quarantine: Optional path, or open file, to write bad lines to.
+            limit (int): Maximum number of bad lines to write, or None to
+                write all of them.
+
+        Returns:
+            A `parser.ParseStream` of `request.Request` objects.
+        """
+        parse = self._compile(compile_parse, strict=False)
+        return parser.ParseStream(parse, lines, quarantine, limit)
+
+    def parse_batch(self, lines):
+        """
+        Create a batch of requests from many lines, skipping over bad ones.
+
+        Args:
+            lines: Iterable of lines, eg. 65,536 lines from a log file.
+
+        Returns:
+            A `request.RequestBatch` object.
+        """
+        if self._parse_batch is None:
+            self._parse_batch = self._compile(compile_parse_batch)
+        return self._parse_batch(lines)
+
+    def _compile(self, function, **kwargs):
+        "Build parse function for this format, using our options"
+        options = dict(self._options)
+        del options['intern']
+        return function(
+            self._format, self._domain, interners=self.interners, **options,
+            **kwargs)
 
     def cannonise(self, fields, req):
+        """
+        Populate request object with values from parsed fields.
+
+        This is the straight-forward, but slow, version of the code generated
+        by `compile_parse()`.
 
-        # Populate request object with values
+        Args:
+            fields: Line from a typed `parser.ApacheLogParser.parse()`
+            req: The `request.Request` object to update.
+
+        Returns:
+            The given request object.
+        """
+        fields = fields._asdict()
 
         # Domain name of website request is for, eg. 'lost.co.nz'
         if self._domain:
             domain = self._domain
         else:
             domain = (
-                fields['host'] if 'host' in fields else None) or (
-                fields['server_name'] if 'server_name' in fields else None)
+                fields.get('request_header_host') or
+                fields.get('server_name'))
             if domain == '-':
                 domain = None
             if domain:
                 domain = domain.lower()
                 domain = domain.replace('www.', '')
+            domain = self._intern('domain', domain)
         req.domain = domain
 
-        # IP address of remote host
+        # IP address of remote host, already an integer if valid
         ip = fields['remote_host']
-        if ip == '::1':
-            ip = '127.0.0.1'
-        ip = utils.ip4_quad2int(ip)
+        if isinstance(ip, str):
+            ip = utils.ip2int(ip)
         req.ip = ip
 
         # Hostname of remote host
@@ -121,51 +684,42 @@ class ApacheCustom:
         req.host = host
 
         # Timestamp of request (UTC POSIX timestamp)
-        timestamp = utils.date2epoch(fields['time_recieved'])
-        req.timestamp = timestamp
+        req.timestamp = fields['time_received']
 
         # Path of object requested
-        path = fields['request'].split()[1]
+        path = fields['request'].split()
+        path = path[1] if len(path) > 1 else ''
         path = self._drop_query_regex.sub('', path)
         if not path or path == '*':
             path = None
-        req.path = path
+        req.path = self._intern('path', path)
 
         # Status of response, eg. 200, 404
-        status = int(fields['last_status'])
-        req.status = status
+        req.status = fields['status']
 
         # Size of response, in bytes
-        size = fields['response_size']
-        size = None if size == '-' else int(size)
-        req.size = size
+        req.size = fields['response_size']
 
         # Referrer
-        if 'referrer' not in fields:
+        referrer = fields.get('request_header_referer')
+        if referrer == '-':
             referrer = None
-        else:
-            referrer = fields['referrer']
-            if referrer == '-':
-                referrer = None
-        req.referrer = referrer
+        req.referrer = self._intern('referrer', referrer)
 
         # User agent of remote client
-        if 'user_agent' not in fields:
+        user_agent = fields.get('request_header_user_agent')
+        if user_agent == '-':
             user_agent = None
-        else:
-            user_agent = fields['user_agent']
-            if user_agent == '-':
-                user_agent = None
-        req.user_agent = user_agent
+        req.user_agent = self._intern('user_agent', user_agent)
 
         # Return request object
         return req
 
 
 class ApacheCommon(ApacheCustom):
-    _format = r'%h %l %u %t \"%r\" %>s %b'
+    _format = '%h %l %u %t "%r" %>s %b'
 
-    def __init__(self, domain):
+    def __init__(self, domain, **kwargs):
         """
         Initilise object.
 
@@ -173,14 +727,14 @@ class ApacheCommon(ApacheCustom):
             Domain of website log file is for.
         """
         self._domain = domain
-        super().__init__()
+        super().__init__(**kwargs)
 
 
 class ApacheCombined(ApacheCommon):
     """
     Same as ApacheCommon with the addition of referrer and user-agent fields.
     """
-    _format = r'%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-agent}i\"'
+    _format = '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-agent}i"'
 
 
 class ApacheVCommon(ApacheCustom):
@@ -190,7 +744,7 @@ class ApacheVCommon(ApacheCustom):
     One field added.  The first field in log file gives the domain name of the
     virtual host serving the request, eg. 'www.example.com', or 'example.com'.
     """
-    _format = r'%v %h %l %u %t \"%r\" %>s %b'
+    _format = '%v %h %l %u %t "%r" %>s %b'
 
 
 class ApacheVCombined(ApacheCustom):
@@ -199,4 +753,85 @@ class ApacheVCombined(ApacheCustom):
 
     Virtual host field added, as per the ApacheVCommon class.
     """
-    _format = r'%v %h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-agent}i\"'
+    _format = '%v %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-agent}i"'
+
+
+class ApacheCustomTimeTaken(ApacheCustom):
+    """
+    Custom format, with the time taken to serve the request added.
+
+    The last field is the time taken in microseconds, from the '%D' directive.
+    """
+    _format = (
+        '%{Host}i %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i" %D')
+
+
+# Formats tried by `detect_format()`, most specific first
+DETECTABLE_FORMATS = (
+    ApacheCustomTimeTaken,
+    ApacheCustom,
+    ApacheVCombined,
+    ApacheCombined,
+    ApacheVCommon,
+    ApacheCommon,
+)
+
+
+def detect_format(path, domain=None, num_lines=100, **kwargs):
+    """
+    Guess the format of a log file from its first few lines.
+
+    Every format in `DETECTABLE_FORMATS` is tried against the sample of lines.
+    The one that parses the most lines wins, the most specific winning any
+    ties.  Junk lines amongst the sample do not matter, so long as at least one
+    line is good.  Results are cached by the contents of the sample, so
+    detecting the format of the same file again is cheap.
+
+    Args:
+        path (str): Path to plain or compressed log file.
+        domain (str): Passed to formats that need one, eg. `ApacheCommon`.
+        num_lines (int): Size of sample.
+        kwargs: Passed to the format class, eg. `binary=True`.
+
+    Raises:
+        ValueError: If no format matches any line of sample.
+
+    Returns:
+        Format object.
+    """
+    sample = []
+    with utils.magic_open(path, 'rb') as fp:
+        for line in fp:
+            sample.append(line)
+            if len(sample) >= num_lines:
+                break
+
+    class_ = _detect_format_class(tuple(sample))
+    if class_ is None:
+        raise ValueError(f"Unable to detect log file format: {path!r}")
+    if issubclass(class_, ApacheCommon):
+        return class_(domain, **kwargs)
+    return class_(**kwargs)
+
+
+@functools.lru_cache(maxsize=128)
+def _detect_format_class(sample):
+    """
+    Find the format class that matches the most lines of the sample.
+
+    Args:
+        sample (tuple): Lines of bytes.
+
+    Returns:
+        Class from `DETECTABLE_FORMATS`, or None if there were no matches.
+    """
+    best, best_count = None, 0
+    for class_ in DETECTABLE_FORMATS:
+        # Check every field, but extract none of them
+        line_parser = parser.ApacheLogParser(
+            class_._format, binary=True, fields=(), typed=True)
+        count = sum(
+            1 for line in sample if line_parser.match(line) is not None)
+        if count > best_count:
+            best, best_count = class_, count
+    return best
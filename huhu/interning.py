@@ -0,0 +1,134 @@
+"""
+Share equal strings between requests, and encode them as small integers.
+
+Log files repeat the same few thousand domains, referrers, and user agents
+hundreds of millions of times.  Passing every value through an `Interner`
+means that each request holds a reference to a single shared copy, rather
+than a copy of its own.  Paths have a long tail of values that are only
+ever seen once, so interners are bounded, forgetting the least recently
+used strings when full.
+
+Least recently used is approximated cheaply, using two generations: strings
+seen since the last clear-out, and those seen before.  Once the younger
+generation is full, the older is forgotten and replaced by the younger.
+Strings in constant use so survive, and a lookup of a recently seen string is
+no more than a single dictionary lookup.
+"""
+
+
+# Maximum number of strings kept by `make_interners()` for each request field
+DEFAULT_SIZES = {
+    'domain': 10_000,
+    'path': 100_000,
+    'referrer': 100_000,
+    'user_agent': 100_000,
+}
+
+
+class Interner:
+    """
+    Share equal strings, and give each a small integer code.
+
+    Call the object with a string to get the shared copy of it::
+
+        >>> interner = Interner()
+        >>> path = interner('/index.html')
+        >>> interner.code(path)
+        0
+        >>> interner.lookup(0)
+        '/index.html'
+
+    Codes are never reused, even once a string has been forgotten, so a code
+    always refers to the same string, or to nothing at all.
+
+    Generated code may call the `get` attribute first, which returns the
+    shared string if it was recently seen, or None, and only call the
+    object itself if that fails.
+    """
+    def __init__(self, maxsize=None):
+        """
+        Initialise object.
+
+        Args:
+            maxsize (int): Maximum number of strings to keep, or None for no
+                limit.
+        """
+        self.maxsize = maxsize
+        self._recent = {}
+        self._old = {}
+        self._codes = {}
+        self._lookup = {}
+        self._next_code = 0
+        self.get = self._recent.get
+
+    def __call__(self, string):
+        """
+        Shared copy of given string.  None is returned as None.
+        """
+        if string is None:
+            return None
+        recent = self._recent
+        shared = recent.get(string)
+        if shared is not None:
+            return shared
+        shared = self._old.pop(string, None)
+        if shared is None:
+            shared = string
+            code = self._next_code
+            self._next_code += 1
+            self._codes[string] = code
+            self._lookup[code] = string
+        if self.maxsize is not None and len(recent) >= self.maxsize // 2:
+            self._forget_old()
+        recent[shared] = shared
+        return shared
+
+    def __contains__(self, string):
+        return string in self._recent or string in self._old
+
+    def __len__(self):
+        return len(self._recent) + len(self._old)
+
+    def code(self, string):
+        """
+        Integer code for string, interning it if need be.
+
+        Returns:
+            Integer, or None if string is None.
+        """
+        string = self(string)
+        if string is None:
+            return None
+        return self._codes[string]
+
+    def lookup(self, code):
+        """
+        String for the given code.
+
+        Raises:
+            KeyError: If code is unknown, or its string has been forgotten.
+        """
+        return self._lookup[code]
+
+    def _forget_old(self):
+        "Forget older generation of strings, replacing it with the younger"
+        codes, lookup = self._codes, self._lookup
+        for string in self._old:
+            del lookup[codes.pop(string)]
+        self._old = dict(self._recent)
+        self._recent.clear()
+
+
+def make_interners(sizes=None):
+    """
+    Create an interner for each of the text fields of a request.
+
+    Args:
+        sizes (dict): Maximum number of strings to keep for each field,
+            overriding those in `DEFAULT_SIZES`.
+
+    Returns:
+        Dictionary of `Interner` objects, keyed by request field name.
+    """
+    sizes = {**DEFAULT_SIZES, **(sizes or {})}
+    return {field: Interner(maxsize) for field, maxsize in sizes.items()}
@@ -0,0 +1,344 @@
+"""
+Parse log files using more than one CPU core.
+
+A single large, uncompressed log file is split into byte ranges that begin and
+end on line boundaries.  Each range is parsed by a worker process using the
+usual `formats` classes, and the results sent back to be yielded in turn.
+
+Many log files, compressed or not, can be parsed at once and their requests
+merged into a single stream, in timestamp order.
+"""
+
+import collections
+import heapq
+import logging
+import multiprocessing
+import operator
+import os
+import time
+
+from . import formats
+from .utils import magic_open
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+ChunkStats = collections.namedtuple(
+    'ChunkStats', 'pid start end lines errors seconds')
+
+
+def chunk_ranges(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split file into byte ranges, each ending just after a newline.
+
+    Every range is at least `chunk_size` bytes long, save for the last.
+
+    Args:
+        path (str): Path to plain, uncompressed file.
+        chunk_size (int): Target size of each range, in bytes.
+
+    Returns:
+        List of (start, end) 2-tuples.
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as fp:
+        start = 0
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                fp.seek(end)
+                fp.readline()
+                end = fp.tell()
+            else:
+                end = size
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+class ParallelParser:
+    """
+    Parse a single, large, plain log file using a pool of worker processes.
+
+    The format object is sent to every worker, so must be picklable, as the
+    `formats` classes are.  Results are pickled on their way back, so parsing
+    into tuples is faster than into `request.Request` objects.  Lines that
+    fail to parse are counted, but are otherwise skipped.
+
+    Statistics for every chunk parsed are available from the `stats`
+    attribute, and summarised by worker from `worker_stats()`.
+    """
+    def __init__(self, format_, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Initialise parser.
+
+        Args:
+            format_: Format object, eg. `formats.ApacheCombined('lost.co.nz')`,
+                or None to use `formats.detect_format()` on the file.
+            processes (int): Number of worker processes.  Defaults to the
+                number of CPUs.
+            chunk_size (int): Size of each byte range given to workers.
+        """
+        self.format_ = format_
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.stats = []
+
+    def parse(self, path, ordered=False):
+        """
+        Parse every line of the given file.
+
+        Args:
+            path (str): Path to plain, uncompressed, log file.
+            ordered (bool): Yield results in the same order as the lines of
+                the file.  Otherwise results are yielded chunk by chunk as
+                soon as they are ready, which is faster.
+
+        Raises:
+            ValueError: If file is compressed.
+
+        Returns:
+            Generator of parsed results.
+        """
+        _, extension = os.path.splitext(path)
+        if extension.lower() in ('.bz2', '.gz', '.xz'):
+            raise ValueError(f"Compressed files cannot be split: {path!r}")
+
+        self.stats = []
+        format_ = self.format_
+        if format_ is None:
+            format_ = formats.detect_format(path)
+        tasks = [
+            (format_, path, start, end)
+            for start, end in chunk_ranges(path, self.chunk_size)]
+        logger.debug("Parsing %r in %s chunks", path, len(tasks))
+        with multiprocessing.Pool(self.processes) as pool:
+            mapper = pool.imap if ordered else pool.imap_unordered
+            for results, stats in mapper(_parse_chunk, tasks):
+                self.stats.append(stats)
+                yield from results
+
+    def worker_stats(self):
+        """
+        Summarise statistics from the last file parsed by worker process.
+
+        Returns:
+            Dictionary, keyed by process id, of dictionaries with the keys
+            'chunks', 'lines', 'errors', 'seconds', and 'lines_per_second'.
+        """
+        workers = {}
+        for stats in self.stats:
+            worker = workers.setdefault(stats.pid, {
+                'chunks': 0, 'lines': 0, 'errors': 0, 'seconds': 0.0})
+            worker['chunks'] += 1
+            worker['lines'] += stats.lines
+            worker['errors'] += stats.errors
+            worker['seconds'] += stats.seconds
+        for worker in workers.values():
+            seconds = worker['seconds']
+            worker['lines_per_second'] = (
+                worker['lines'] / seconds if seconds else 0.0)
+        return workers
+
+
+def _parse_chunk(task):
+    """
+    Parse lines from a byte range of a file.  Runs in worker process.
+
+    Returns:
+        2-tuple of list of results, and a `ChunkStats` object.
+    """
+    format_, path, start, end = task
+    started = time.perf_counter()
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+
+    if format_.binary:
+        lines = data.split(b'\n')
+    else:
+        lines = data.decode('utf-8', 'replace').split('\n')
+    del data
+    if not lines[-1]:
+        lines.pop()
+
+    # Bad lines are skipped by the stream, whatever the reason
+    stream = format_.parse_stream(lines)
+    results = list(stream)
+
+    seconds = time.perf_counter() - started
+    stats = ChunkStats(
+        os.getpid(), start, end, stream.lines, stream.failed, seconds)
+    return results, stats
+
+
+class MultiFileParser:
+    """
+    Parse many log files using a pool of worker processes.
+
+    Every file is read, decompressed if need be, and parsed by a worker
+    process, and the requests sent back in batches.  The requests from all the
+    files are merged into a single stream, ordered by timestamp.  Log files
+    are assumed to be in timestamp order already, as rotated log files are.
+
+    No more than two batches from each file are held in memory at any one time,
+    one being merged and one waiting, so memory use is bounded by the number
+    of files times the batch size, not by the size of the files.  Lines that
+    fail to parse are counted, but are otherwise skipped.
+
+    Counts of lines and errors for every file are available from the `stats`
+    attribute.
+    """
+    def __init__(self, format_, processes=None, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Initialise parser.
+
+        Args:
+            format_: Format object, eg. `formats.ApacheCombined('lost.co.nz')`,
+                or None to use `formats.detect_format()` on each file.
+            processes (int): Number of worker processes.  Defaults to the
+                number of CPUs.
+            batch_size (int): Number of requests sent from a worker at once.
+        """
+        self.format_ = format_
+        self.processes = processes
+        self.batch_size = batch_size
+        self.stats = {}
+
+    def parse(self, paths):
+        """
+        Parse every line of the given files, merging by timestamp.
+
+        Args:
+            paths: Iterable of paths to log files, plain or compressed.
+
+        Raises:
+            Any exception raised by a worker opening or reading a file.
+
+        Returns:
+            Generator of `request.Request` objects.
+        """
+        paths = list(paths)
+        self.stats = {path: {'lines': 0, 'errors': 0} for path in paths}
+        if not paths:
+            return
+
+        processes = min(self.processes or os.cpu_count() or 1, len(paths))
+        logger.debug(
+            "Parsing %s files using %s processes", len(paths), processes)
+        results = multiprocessing.Queue()
+        workers = []
+        for _ in range(processes):
+            tasks = multiprocessing.SimpleQueue()
+            process = multiprocessing.Process(
+                target=_file_worker,
+                args=(self.format_, self.batch_size, tasks, results),
+                daemon=True)
+            process.start()
+            workers.append((process, tasks))
+
+        buffers = [collections.deque() for _ in paths]
+
+        def fetch(index):
+            # Ask the worker responsible for the file for its next batch.
+            workers[index % processes][1].put((index, paths[index]))
+
+        def receive(index):
+            # Wait for the next batch of the given file, while buffering any
+            # batches of other files that arrive in the meantime.
+            while not buffers[index]:
+                received, batch, lines, errors, error = results.get()
+                if error is not None:
+                    raise error
+                stats = self.stats[paths[received]]
+                stats['lines'] += lines
+                stats['errors'] += errors
+                buffers[received].append(batch)
+            batch = buffers[index].popleft()
+            if batch is not None:
+                fetch(index)
+            return batch
+
+        def requests(index):
+            while True:
+                batch = receive(index)
+                if batch is None:
+                    return
+                yield from batch
+
+        finished = False
+        try:
+            for index in range(len(paths)):
+                fetch(index)
+            yield from heapq.merge(
+                *(requests(index) for index in range(len(paths))),
+                key=operator.attrgetter('timestamp'))
+            finished = True
+        finally:
+            for process, tasks in workers:
+                if finished:
+                    tasks.put(None)
+                    process.join()
+                else:
+                    process.terminate()
+                    process.join()
+            results.close()
+
+
+def _file_worker(format_, batch_size, tasks, results):
+    """
+    Send batches of requests from log files on demand.  Runs in worker process.
+
+    Every task is a 2-tuple of the index and path of a file.  The next batch of
+    requests from that file is put onto the results queue, or None if the
+    file is exhausted.  A task of None stops the worker.
+    """
+    readers = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, path = task
+        try:
+            reader = readers.get(index)
+            if reader is None:
+                reader = readers[index] = _read_batches(
+                    format_, path, batch_size)
+            batch, lines, errors = next(reader, (None, 0, 0))
+            if batch is None:
+                del readers[index]
+        except Exception as e:
+            results.put((index, None, 0, 0, e))
+            break
+        results.put((index, batch, lines, errors, None))
+
+
+def _read_batches(format_, path, batch_size):
+    """
+    Generate lists of parsed requests from the given file.
+
+    Yields:
+        3-tuples of list of requests, and counts of lines read and errors.
+    """
+    if format_ is None:
+        format_ = formats.detect_format(path)
+    mode = 'rb' if format_.binary else 'rt'
+    with magic_open(path, mode, errors='replace') as fp:
+        # Bad lines are skipped by the stream, whatever the reason
+        stream = format_.parse_stream(fp)
+        batch = []
+        lines = errors = 0
+        for req in stream:
+            batch.append(req)
+            if len(batch) >= batch_size:
+                yield batch, stream.lines - lines, stream.failed - errors
+                batch = []
+                lines, errors = stream.lines, stream.failed
+        if batch or stream.lines > lines:
+            yield batch, stream.lines - lines, stream.failed - errors
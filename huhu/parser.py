@@ -8,8 +8,16 @@ the system.
 """
 
 import collections
+import io
+import logging
+import os
 import re
 
+from . import utils
+
+
+logger = logging.getLogger(__name__)
+
 
 APACHE_LOG_DIRECTIVES = {
     '%a': 'remote_ip_address',      # IPv6 ([a-f0-9:]+:+)+[a-f0-9]+
@@ -42,6 +50,38 @@ APACHE_LOG_DIRECTIVES = {
 }
 
 
+# Directives whose values are converted by typed parsers
+TYPED_DIRECTIVES = {
+    '%b': 'number',                 # Integer, or None if '-'
+    '%B': 'number',
+    '%D': 'number',
+    '%h': 'host',                   # Integer if IP address, otherwise str
+    '%s': 'number',
+    '%>s': 'number',
+    '%t': 'time',                   # UTC epoch timestamp
+    '%T': 'number',
+}
+
+
+def _remote_host(host):
+    "Convert IP address to integer, leaving host names as they are"
+    try:
+        return utils.ip2int(host)
+    except OSError:
+        return host
+
+
+# Functions called by the source from `ApacheLogParser.typed_source()`
+CONVERTERS = {
+    '_date2epoch': utils.date2epoch,
+    '_remote_host': _remote_host,
+}
+
+
+# Characters other than space that '\s' matches in str, and are ASCII
+ASCII_WHITESPACE = '\t\n\v\f\r\x1c\x1d\x1e\x1f'
+
+
 class ApacheLogParserError(Exception):
     """
     Root exception class.
@@ -67,17 +107,42 @@ class ApacheLogParser:
     (peterhi@ntlworld.com), and the Python port, `apachelog` of the same
     by Harry Fuecks (hfuecks@gmail.com>.
     """
-    def __init__(self, log_format):
+    def __init__(
+            self, log_format, binary=False, lazy=False, fields=None,
+            typed=False):
         """
         Construct parser using Apache configuration directive.
 
         Args:
             log_format (str): Log format string, eg. "%h %l %u %t \"%r\" %>s %b"
+            binary (bool): Parse lines of bytes, rather than str, returning
+                undecoded bytes for every field.
+            lazy (bool): Return `LazyLine` objects from `parse()`, rather
+                than namedtuples.
+            fields (iterable): Names of the only fields to extract, eg.
+                ['status', 'time_received'].  Lines are still checked in
+                full, but other fields are skipped over.  Defaults to all.
+            typed (bool): Convert the values of the directives in
+                `TYPED_DIRECTIVES` from text, eg. status to an integer, and
+                time received to an epoch timestamp.  Numeric fields must
+                contain digits or '-', which is returned as None.
         """
         self.log_format = log_format.strip()
+        self.binary = binary
+        self.lazy = lazy
+        self.fields = None if fields is None else frozenset(fields)
+        self.typed = typed
         self.regex, labels = self.construct_regex()
-        identifiers = self.translate_directives(labels)
+        self.tokenize = self.construct_tokenizer()
+        self.convert = self.construct_converter()
+        identifiers = [
+            identifier for identifier in self.translate_directives(labels)
+            if self.keep(identifier)]
+        if self.fields is not None and self.fields != set(identifiers):
+            unknown = ', '.join(sorted(self.fields.difference(identifiers)))
+            raise ApacheLogParserError(f"Fields not in log format: {unknown}")
         self.namedtuple = collections.namedtuple('Line', identifiers)
+        self.lazy_line = self.construct_lazy_line(identifiers)
 
     def construct_regex(self):
         """
@@ -89,18 +154,26 @@ class ApacheLogParser:
         """
         labels = []
         subpatterns = []
-        for element in self.log_format.split():
+        elements = self.log_format.split()
+        identifiers = self.translate_directives(elements)
+        for element, identifier in zip(elements, identifiers):
             labels.append(element)
             if element == '%t':
                 subpattern = r'(\[[^\]]+\])'
+            elif self.value_type(element) == 'number':
+                subpattern = r'(\d+|-)'
             elif '"' in element:
                 subpattern = r'"([^"\\]*(?:\\.[^"\\]*)*)"'
             else:
                 subpattern = r'(\S+)'
+            if not self.keep(identifier):
+                subpattern = subpattern.replace('(', '(?:', 1)
             subpatterns.append(subpattern)
 
         # Build and compile
         pattern = f"^{' '.join(subpatterns)}$"
+        if self.binary:
+            pattern = pattern.encode('ascii')
         try:
             regex = re.compile(pattern)
         except re.error as e:
@@ -108,24 +181,356 @@ class ApacheLogParser:
 
         return regex, labels
 
+    def construct_tokenizer(self):
+        """
+        Generate and compile a function to split lines without a regex.
+
+        The function takes a stripped line and returns a tuple of field
+        values, exactly as the regex would, or None if the line is not one
+        that it can handle.  The caller should fall back to the regex in that
+        case.
+
+        Returns:
+            Function object.
+        """
+        statements, expressions = self.tokenizer_source()
+        source = ['def tokenize(line):']
+        source.extend(f'    {statement}' for statement in statements)
+        source.append('    if not _ok:')
+        source.append('        return None')
+        values = ''.join(
+            f'{expression}, ' for expression in self.typed_source(expressions))
+        source.append(f'    return ({values})')
+        return self._compile(source, '<tokenizer>', 'tokenize')
+
+    def construct_converter(self):
+        """
+        Generate and compile a function to convert the values of fields.
+
+        The function takes a tuple of field values from the regex and returns
+        a tuple of converted values, or the same tuple if the parser is not
+        typed.
+
+        Returns:
+            Function object.
+        """
+        if not self.typed:
+            return tuple
+        names = [f'_v{index}' for index in range(self.regex.groups)]
+        source = ['def convert(values):']
+        if names:
+            source.append(f"    {', '.join(names)}, = values")
+        values = ''.join(
+            f'{expression}, ' for expression in self.typed_source(names))
+        source.append(f'    return ({values})')
+        return self._compile(source, '<converter>', 'convert')
+
+    def _compile(self, source, filename, name):
+        "Compile function from lines of source code"
+        namespace = dict(CONVERTERS)
+        code = compile('\n'.join(source), filename, 'exec')
+        exec(code, namespace)
+        return namespace[name]
+
+    def keep(self, identifier):
+        """
+        Should the field with the given identifier be extracted?
+        """
+        return self.fields is None or identifier in self.fields
+
+    def value_type(self, element):
+        """
+        Type of value for log format element, if parser is typed.
+
+        Returns:
+            One of the values of `TYPED_DIRECTIVES`, or None if the value is
+            left as text.
+        """
+        if not self.typed:
+            return None
+        return TYPED_DIRECTIVES.get(element)
+
+    def typed_source(self, expressions):
+        """
+        Build Python source code to convert the values of extracted fields.
+
+        Args:
+            expressions (list): Source of expression for each extracted field.
+
+        Returns:
+            List of expressions for converted values.
+        """
+        elements = [
+            element for element, identifier in zip(
+                self.log_format.split(),
+                self.translate_directives(self.log_format.split()))
+            if self.keep(identifier)]
+        literal = self.literal
+        converted = []
+        for element, expression in zip(elements, expressions):
+            value_type = self.value_type(element)
+            if value_type == 'number':
+                expression = (
+                    f"(None if {expression} == {literal('-')} "
+                    f"else int({expression}))")
+            elif value_type is not None:
+                if self.binary:
+                    expression = f"{expression}.decode('latin-1')"
+                if value_type == 'time':
+                    expression = f"_date2epoch({expression})"
+                else:
+                    expression = f"_remote_host({expression})"
+            converted.append(expression)
+        return converted
+
+    def literal(self, text):
+        """
+        Source code for a literal to compare with, or search, a line.
+
+        Args:
+            text (str): Literal text.
+
+        Returns:
+            Repr of str, or of bytes if parser is in binary mode.
+        """
+        if self.binary:
+            return repr(text.encode('ascii'))
+        return repr(text)
+
+    def tokenizer_source(self):
+        """
+        Build Python source code to split a line into its fields.
+
+        Uses `str.split()`, or `bytes.split()` in binary mode, on the
+        delimiters implied by the log format rather than a regex.  The line
+        is first split on double-quotes, then each of the runs between quoted
+        fields is split on spaces.  The timestamp from '%t' is expected to
+        contain exactly one space.  Fields that are not to be extracted are
+        still checked, but are not part of the result.
+
+        Anything unusual is left for the regex: lines containing a backslash
+        (which may be escaping a double-quote), whitespace other than spaces
+        or any other unprintable character, or that do not split into exactly
+        the expected number of pieces.  Typed numeric fields must contain only
+        digits, or be '-'.
+
+        Returns:
+            A 2-tuple. A list of source lines for statements that leave the
+            local variable `_ok` true if the line was understood, and
+            a list of expressions giving the value of each extracted field,
+            valid only if `_ok` is true.
+        """
+        # Group elements into runs of unquoted elements between quoted ones
+        runs = [[]]
+        quoted = []
+        elements = self.log_format.split()
+        identifiers = self.translate_directives(elements)
+        for element, identifier in zip(elements, identifiers):
+            keep = self.keep(identifier)
+            if element == '%t':
+                runs[-1].append(('time', keep))
+            elif '"' in element:
+                quoted.append(keep)
+                runs.append([])
+            elif self.value_type(element) == 'number':
+                runs[-1].append(('number', keep))
+            else:
+                runs[-1].append(('plain', keep))
+        num_quoted = len(quoted)
+
+        # Split each run on spaces, checking number and content of pieces
+        splits = []
+        shape_checks = []
+        times = []
+        checks = []
+        expressions = []
+        literal = self.literal
+        space = literal(' ')
+        dash = literal('-')
+        # Same digits as '\\d' in a regex, for both str and bytes
+        isdigit = 'isdigit' if self.binary else 'isdecimal'
+        for index, run in enumerate(runs):
+            part = f'_parts[{2 * index}]'
+            if index > 0 and quoted[index - 1]:
+                expressions.append(f'_parts[{2 * index - 1}]')
+            if not run:
+                expected = literal(' ' if 0 < index < num_quoted else '')
+                shape_checks.append(f'{part} == {expected}')
+                continue
+
+            pieces = f'_r{index}'
+            splits.append(f"{pieces} = {part}.split({space})")
+            num_pieces = 0
+            if index > 0:
+                checks.append(f'not {pieces}[0]')
+                num_pieces += 1
+            for kind, keep in run:
+                first = f'{pieces}[{num_pieces}]'
+                if kind == 'time':
+                    second = f'{pieces}[{num_pieces + 1}]'
+                    time = f'_t{len(times)}'
+                    times.append(f"{time} = {first} + {space} + {second}")
+                    checks.append(f"{time}[:1] == {literal('[')}")
+                    checks.append(
+                        f"{time}.find({literal(']')}) == len({time}) - 1")
+                    if keep:
+                        expressions.append(time)
+                    num_pieces += 2
+                else:
+                    if kind == 'number':
+                        checks.append(
+                            f"({first}.{isdigit}() or {first} == {dash})")
+                    else:
+                        checks.append(first)
+                    if keep:
+                        expressions.append(first)
+                    num_pieces += 1
+            if index < num_quoted:
+                checks.append(f'not {pieces}[{num_pieces}]')
+                num_pieces += 1
+            shape_checks.append(f'len({pieces}) == {num_pieces}')
+
+        # Whitespace other than spaces, which '\\S' rejects, is looked for
+        # in the whole line, a character at a time, which is much faster than
+        # splitting on it.  Bytes are searched for as integers, for speed.
+        # Lines that are not ASCII are checked for being printable instead,
+        # as all other whitespace is unprintable.
+        if self.binary:
+            unusual = [ord('\\'), *map(ord, '\t\n\v\f\r')]
+            unusual = ' and '.join(f'{char} not in line' for char in unusual)
+        else:
+            spaces = ' and '.join(
+                f'{char!r} not in line' for char in ASCII_WHITESPACE)
+            unusual = (
+                f"'\\\\' not in line and "
+                f"(({spaces}) if line.isascii() else line.isprintable())")
+        quote = literal('"')
+        statements = [
+            "_ok = False",
+            f"_parts = line.split({quote})",
+            f"if len(_parts) == {2 * num_quoted + 1} and {unusual}:",
+        ]
+        statements.extend(f'    {split}' for split in splits)
+        statements.append(f"    if {' and '.join(shape_checks) or 'True'}:")
+        statements.extend(f'        {time}' for time in times)
+        statements.append(f"        _ok = {' and '.join(checks) or 'True'}")
+        return statements, expressions
+
+    def construct_lazy_line(self, identifiers):
+        """
+        Create `LazyLine` subclass with a property for every field.
+
+        Args:
+            identifiers (list): Field names, in order.
+
+        Returns:
+            New class.
+        """
+        namespace = {
+            '__slots__': (),
+            '_fields': tuple(identifiers),
+            '_split_line': staticmethod(self.split),
+        }
+        for index, identifier in enumerate(identifiers):
+            namespace[identifier] = _lazy_field(index)
+        return type('LazyLine', (LazyLine,), namespace)
+
     def parse(self, line):
         """
         Parses a single line from the log file and returns
         a dictionary of its contents.
 
-        Raises and exception if it couldn't parse the line
+        Raises and exception if it couldn't parse the line.  Lazy parsers
+        postpone all of the work, including raising any exception, until a
+        field is first accessed.
+
+        Args:
+            line (str): Raw line of data from log file.
+
+        Returns:
+            A `collections.namedtuple`, or `LazyLine`, object containing the
+            line's data.
+        """
+        if self.lazy:
+            return self.lazy_line(line)
+        return self.namedtuple._make(self.split(line))
+
+    def parse_stream(self, lines, quarantine=None, limit=1000):
+        """
+        Parse many lines, skipping over any that cannot be parsed.
+
+        Lines are always parsed eagerly, even by lazy parsers, so that they
+        can be checked.
+
+        Args:
+            lines: Iterable of lines, eg. an open log file.
+            quarantine: Optional path, or open file, to write bad lines to.
+            limit (int): Maximum number of bad lines to write, or None to
+                write all of them.
+
+        Returns:
+            A `ParseStream` of namedtuples.
+        """
+        make = self.namedtuple._make
+
+        def parse(line):
+            values = self.match(line)
+            return None if values is None else make(values)
+
+        return ParseStream(parse, lines, quarantine, limit)
+
+    def match(self, line):
+        """
+        Split a single line into a tuple of field values, if possible.
+
+        Like `split()`, but returns None rather than raising an exception if
+        the line does not match the log format.  Fields of typed parsers
+        that cannot be converted still raise their own exceptions.
+
+        Args:
+            line (str): Raw line of data from log file.
+
+        Returns:
+            Plain tuple of field values, or None.
+        """
+        line = line.strip()
+        values = self.tokenize(line)
+        if values is None:
+            match = self.regex.match(line)
+            if match is None:
+                return None
+            values = self.convert(match.groups())
+        return values
+
+    def split(self, line):
+        """
+        Split a single line from the log file into a tuple of field values.
+
+        The generated tokenizer is tried first, with the regex only
+        used for lines that it rejects.
+
+        Raises and exception if it couldn't parse the line, or convert the
+        values of its fields.
 
         Args:
             line (str): Raw line of data from log file.
 
         Returns:
-            A `collections.namedtuple` object containing the line's data.
+            Plain tuple of field values.
         """
         line = line.strip()
-        match = self.regex.match(line)
-        if not match:
-            raise ApacheLogParserError(f"Unable to parse line: {line!r}")
-        return self.namedtuple(*match.groups())
+        try:
+            values = self.tokenize(line)
+            if values is None:
+                match = self.regex.match(line)
+                if not match:
+                    raise ApacheLogParserError(
+                        f"Unable to parse line: {line!r}")
+                values = self.convert(match.groups())
+        except (IndexError, KeyError, ValueError):
+            raise ApacheLogParserError(
+                f"Unable to convert line: {line!r}") from None
+        return values
 
     def translate_directives(self, labels):
         """
@@ -157,3 +562,200 @@ class ApacheLogParser:
         if identifier is None:
             identifier = label
         return identifier
+
+
+class ParseStream:
+    """
+    Iterate over the results of parsing lines, never raising for bad ones.
+
+    Lines that fail to parse are counted by reason: 'unmatched' for lines
+    that do not match the log format, otherwise the name of the exception
+    raised converting a value, eg. 'KeyError'.  A sample of them, or all of
+    them, may be written to a quarantine file for later inspection.
+
+    Counts are updated as the stream is consumed, and are complete once it is
+    exhausted.  For example::
+
+        >>> with magic_open(path) as fp:
+        ...    stream = parser.parse_stream(fp, quarantine='bad.log')
+        ...    for data in stream:
+        ...        do_something(data)
+        >>> stream.lines, stream.parsed, stream.failures
+        (1000, 998, Counter({'unmatched': 2}))
+    """
+    def __init__(self, parse, lines, quarantine=None, limit=1000):
+        """
+        Initialiser.
+
+        Args:
+            parse: Function to parse a single line.  It should return None if
+                the line does not match, and may raise an exception if it
+                is otherwise bad.
+            lines: Iterable of lines of str or bytes.
+            quarantine: Optional path, or open file, to write bad lines to.
+                Paths are only opened if a bad line is found.
+            limit (int): Maximum number of bad lines to write, or None to
+                write all of them.
+        """
+        self.failures = collections.Counter()
+        self.limit = limit
+        self.parsed = 0
+        self.quarantined = 0
+        self._lines = lines
+        self._parse = parse
+        self._quarantine = quarantine
+        self._quarantine_file = None
+
+    def __iter__(self):
+        parse = self._parse
+        try:
+            for line in self._lines:
+                try:
+                    result = parse(line)
+                except Exception as e:
+                    reason = e.__class__.__name__
+                else:
+                    if result is not None:
+                        self.parsed += 1
+                        yield result
+                        continue
+                    reason = 'unmatched'
+                self.failures[reason] += 1
+                if self._quarantine is not None and (
+                        self.limit is None or self.quarantined < self.limit):
+                    self.write_quarantine(line)
+        finally:
+            self.close()
+
+    @property
+    def failed(self):
+        "Total number of lines that failed to parse"
+        return sum(self.failures.values())
+
+    @property
+    def lines(self):
+        "Total number of lines read"
+        return self.parsed + self.failed
+
+    def close(self):
+        """
+        Close quarantine file, if it was opened by us.
+        """
+        fp = self._quarantine_file
+        if fp is not None and fp is not self._quarantine:
+            fp.close()
+        self._quarantine_file = None
+
+    def totals(self):
+        """
+        Summarise counts as a dictionary.
+
+        Returns:
+            Dictionary with the keys 'lines', 'parsed', 'failed', and
+            'quarantined', and 'failures' with the count for each reason.
+        """
+        return {
+            'lines': self.lines,
+            'parsed': self.parsed,
+            'failed': self.failed,
+            'quarantined': self.quarantined,
+            'failures': dict(self.failures),
+        }
+
+    def write_quarantine(self, line):
+        """
+        Write a single bad line to the quarantine file, as it was read.
+
+        Lines read as bytes are decoded, replacing any bad characters, if the
+        quarantine is a text file, eg. `sys.stderr`.  Lines read as text are
+        encoded as UTF-8 for binary files.
+        """
+        fp = self._quarantine_file
+        if fp is None:
+            if isinstance(self._quarantine, (str, os.PathLike)):
+                logger.debug("Opening quarantine file: %r", self._quarantine)
+                if isinstance(line, bytes):
+                    fp = open(self._quarantine, 'wb')
+                else:
+                    fp = open(self._quarantine, 'wt', encoding='utf-8')
+            else:
+                fp = self._quarantine
+            self._quarantine_file = fp
+        if isinstance(fp, io.TextIOBase):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'replace')
+            fp.write(line.rstrip('\n') + '\n')
+        else:
+            if isinstance(line, str):
+                line = line.encode('utf-8', 'surrogateescape')
+            fp.write(line.rstrip(b'\n') + b'\n')
+        self.quarantined += 1
+
+
+class LazyLine:
+    """
+    Line from a log file whose fields are only extracted when first used.
+
+    Holds nothing but the raw line until one of its fields is accessed, when
+    the whole line is split in one go.  Lines that are never looked at, or
+    only partly used, cost little more than the allocation of this object.
+
+    Usable in place of the namedtuple from `ApacheLogParser.parse()`: fields
+    are available as attributes, by index, and by iteration, and `_fields`
+    and `_asdict()` are provided.  One subclass, with properties for its
+    fields, is created for each parser by `construct_lazy_line()`.
+    """
+    __slots__ = ('_line', '_values')
+    _fields = ()
+
+    def __init__(self, line):
+        self._line = line
+        self._values = None
+
+    def __eq__(self, other):
+        if isinstance(other, (LazyLine, tuple)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __getitem__(self, index):
+        values = self._values
+        if values is None:
+            values = self._split()
+        return values[index]
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __iter__(self):
+        values = self._values
+        if values is None:
+            values = self._split()
+        return iter(values)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        fields = ', '.join(
+            f'{name}={value!r}' for name, value in zip(self._fields, self))
+        return f'{self.__class__.__name__}({fields})'
+
+    def _asdict(self):
+        "Return a new dict which maps field names to their values."
+        return dict(zip(self._fields, self))
+
+    def _split(self):
+        "Split line into fields, keeping the result"
+        values = self._split_line(self._line)
+        self._values = values
+        return values
+
+
+def _lazy_field(index):
+    "Create property for field of LazyLine with given index"
+    def getter(self):
+        values = self._values
+        if values is None:
+            values = self._split()
+        return values[index]
+    return property(getter)
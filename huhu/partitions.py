@@ -0,0 +1,378 @@
+"""
+Database of requests split into one SQLite file per month.
+
+A single `request.RequestDB` holding years of traffic grows huge, is slow to
+vacuum, and dropping old requests means deleting millions of rows.  Here
+every calendar month, in UTC, is a complete `RequestDB` file of its own, with
+its own domains, paths, and user agents.  Reports only open the months in
+their time range, and old months are dropped by deleting their files.
+"""
+
+import calendar
+import collections
+import contextlib
+import itertools
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from .request import (
+    DEFAULT_FETCH_BATCH, DEFAULT_LOAD_CHUNK, RequestBatch, RequestDB)
+
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of partitions kept open at once
+DEFAULT_MAX_OPEN = 12
+
+# Columns of the 'requests' view of every partition
+COLUMNS = (
+    'id', 'domain', 'ip', 'host', 'timestamp', 'path', 'status', 'size',
+    'referrer', 'user_agent')
+
+
+def month_of(timestamp):
+    "The (year, month) 2-tuple of the given UTC timestamp"
+    tm = time.gmtime(timestamp)
+    return tm.tm_year, tm.tm_mon
+
+
+def month_range(month):
+    """
+    Time range of the given month.
+
+    Args:
+        month: 2-tuple of year and month, eg. (2019, 3).
+
+    Returns:
+        2-tuple of timestamps, the first of the month, and the first of the
+        month after.
+    """
+    year, month = month
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    if month == 12:
+        year, month = year + 1, 1
+    else:
+        month += 1
+    return start, calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+class PartitionedRequestDB:
+    """
+    Requests database kept in a folder of per-month `RequestDB` files.
+
+    Files are named after their month, eg. 'requests-2019-03.db', and are
+    ordinary `RequestDB` databases, which may be opened on their own.
+    Partitions are opened when first needed, and no more than `max_open` are
+    kept open at once.
+
+    Every request must have a timestamp, so that it can be given a month.
+    Ids are only unique within a partition.
+    """
+    def __init__(self, folder, prefix='requests-', max_open=DEFAULT_MAX_OPEN):
+        """
+        Initialise object.
+
+        Args:
+            folder (str): Folder of partition files, created if need be.
+            prefix (str): Start of the name of every partition file.
+            max_open (int): Maximum number of partitions kept open.
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.prefix = prefix
+        self.max_open = max_open
+        self._open = collections.OrderedDict()
+        self._bulk = None
+        self._pattern = re.compile(
+            re.escape(prefix) + r'(\d{4})-(\d{2})\.db$')
+
+    def path(self, month):
+        "Path of the file for the given (year, month)"
+        year, month = month
+        return os.path.join(
+            self.folder, f"{self.prefix}{year:04}-{month:02}.db")
+
+    def partitions(self, start=None, end=None):
+        """
+        Find the partitions holding requests within a time range.
+
+        Args:
+            start (int): Only partitions with requests at or after this
+                timestamp.
+            end (int): Only partitions with requests before this timestamp.
+
+        Returns:
+            Sorted list of (year, month) 2-tuples.
+        """
+        months = []
+        for name in os.listdir(self.folder):
+            match = self._pattern.match(name)
+            if match is None:
+                continue
+            month = int(match.group(1)), int(match.group(2))
+            first, last = month_range(month)
+            if start is not None and last <= start:
+                continue
+            if end is not None and first >= end:
+                continue
+            months.append(month)
+        months.sort()
+        return months
+
+    def partition(self, month):
+        """
+        The database for the given (year, month), created if need be.
+
+        No partition is closed to make room during `bulk_import()`, as doing
+        so rebuilds its indexes, only for them to be dropped again when it is
+        next opened.
+
+        Returns:
+            `RequestDB` object.
+        """
+        opened = self._open.get(month)
+        if opened is not None:
+            self._open.move_to_end(month)
+            return opened[0]
+
+        while self._bulk is None and len(self._open) >= self.max_open:
+            _, (_, stack) = self._open.popitem(last=False)
+            stack.close()
+        db = RequestDB(self.path(month))
+        stack = contextlib.ExitStack()
+        stack.callback(db.close)
+        if self._bulk is not None:
+            stack.enter_context(db.bulk_import(**self._bulk))
+        self._open[month] = (db, stack)
+        return db
+
+    def close(self):
+        "Close every open partition"
+        while self._open:
+            _, (_, stack) = self._open.popitem()
+            stack.close()
+
+    @contextlib.contextmanager
+    def bulk_import(self, drop_indexes=True, **kwargs):
+        """
+        Context manager to speed up adding lots of requests.
+
+        As per `RequestDB.bulk_import()`, for every partition opened within
+        it.  Open partitions are closed on exit, rebuilding their indexes.
+
+        Every partition opened stays open until then, whatever `max_open`,
+        each with its own file handle and page cache, so importing many
+        months at once may need a smaller `cache_size`.
+        """
+        self.close()
+        self._bulk = {'drop_indexes': drop_indexes, **kwargs}
+        try:
+            yield
+        finally:
+            self._bulk = None
+            self.close()
+
+    def load_requests(self, requests, chunk_size=DEFAULT_LOAD_CHUNK):
+        """
+        Add requests to the partitions for their months.
+
+        Requests are buffered for each month, and added using
+        `RequestDB.load_requests()` a chunk at a time, so if an exception is
+        raised the chunks before it are kept.
+
+        Args:
+            requests: Iterable of `Request` objects or 9-tuples, or a
+                `RequestBatch`.
+            chunk_size (int): Maximum number of requests in each transaction.
+
+        Raises:
+            ValueError: If a request has no timestamp.
+        """
+        if isinstance(requests, RequestBatch):
+            requests = requests.rows()
+        buffers = {}
+        first = last = 0
+        buffer = month = None
+        for row in requests:
+            timestamp = row[3]
+            if timestamp is None:
+                raise ValueError(
+                    f"Request without a timestamp cannot be added: {row}")
+            if not first <= timestamp < last:
+                month = month_of(timestamp)
+                first, last = month_range(month)
+                buffer = buffers.setdefault(month, [])
+            buffer.append(row)
+            if len(buffer) >= chunk_size:
+                self.partition(month).load_requests(buffer, chunk_size)
+                buffer.clear()
+        for month, buffer in sorted(buffers.items()):
+            if buffer:
+                self.partition(month).load_requests(buffer, chunk_size)
+
+    def expire(self, before):
+        """
+        Drop every partition whose month ends at or before the given time.
+
+        Whole files are deleted, so partitions with requests after the
+        given time are kept in full.
+
+        Args:
+            before (int): Timestamp.
+
+        Returns:
+            List of (year, month) 2-tuples of the partitions dropped.
+        """
+        expired = [
+            month for month in self.partitions(end=before)
+            if month_range(month)[1] <= before]
+        for month in expired:
+            opened = self._open.pop(month, None)
+            if opened is not None:
+                opened[1].close()
+            path = self.path(month)
+            for suffix in ('', '-journal', '-wal', '-shm'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path + suffix)
+            logger.info("Dropped partition %r", path)
+        return expired
+
+    @contextlib.contextmanager
+    def attach(self, start=None, end=None):
+        """
+        Connection to the partitions within a time range, for ad-hoc queries.
+
+        The partitions are attached to a new connection, which has a
+        temporary 'requests' view of all of their requests::
+
+            >>> with db.attach(start, end) as con:
+            ...     con.execute("SELECT count(*) FROM requests;").fetchone()
+
+        Raises:
+            ValueError: If there are more partitions than SQLite can attach
+                at once, ten by default.
+
+        Returns:
+            Context manager giving an `sqlite3.Connection`.
+        """
+        months = self.partitions(start, end)
+        con = sqlite3.connect(':memory:')
+        try:
+            limit = con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+            if len(months) > limit:
+                raise ValueError(
+                    f"Cannot attach {len(months)} partitions, SQLite is "
+                    f"limited to {limit}")
+            selects = []
+            for year, month in months:
+                schema = f"p{year:04}_{month:02}"
+                con.execute(
+                    f"ATTACH DATABASE ? AS {schema};",
+                    (self.path((year, month)),))
+                selects.append(f"SELECT * FROM {schema}.requests")
+            if not selects:
+                selects.append(
+                    f"SELECT {', '.join(f'NULL AS {c}' for c in COLUMNS)} "
+                    "WHERE 0")
+            con.execute(
+                f"CREATE TEMP VIEW requests AS {' UNION ALL '.join(selects)};")
+            yield con
+        finally:
+            con.close()
+
+    def count(self):
+        "Return number of requests in every partition"
+        return sum(db.count() for db, _, _ in self._databases())
+
+    def iter_requests(
+            self, domain=None, start=None, end=None, status=None,
+            output='requests', batch_size=DEFAULT_FETCH_BATCH):
+        """
+        Read requests back out of the partitions, a month at a time.
+
+        As per `RequestDB.iter_requests()`.  Batches never span partitions.
+        """
+        return itertools.chain.from_iterable(
+            db.iter_requests(domain, first, last, status, output, batch_size)
+            for db, first, last in self._databases(start, end))
+
+    def requests_per_period(
+            self, period='day', domain=None, start=None, end=None,
+            status=None):
+        """
+        Count requests, and bytes served, in every period of time.
+
+        As per `RequestDB.requests_per_period()`.
+        """
+        totals = {}
+        for db, first, last in self._databases(start, end):
+            for bucket, requests, size in db.requests_per_period(
+                    period, domain, first, last, status):
+                if bucket in totals:
+                    previous = totals[bucket]
+                    requests += previous[0]
+                    size += previous[1]
+                totals[bucket] = (requests, size)
+        return [(bucket, *totals[bucket]) for bucket in sorted(totals)]
+
+    def top_paths(
+            self, limit=10, domain=None, start=None, end=None, status=None):
+        """
+        Find the most requested paths.
+
+        As per `RequestDB.top_paths()`.  If more than one partition is in
+        the time range then every path is counted in each of them.
+        """
+        # Partitions are queried as they are opened, as opening more than
+        # `max_open` closes the earlier ones
+        if len(self.partitions(start, end)) == 1:
+            (db, first, last), = self._databases(start, end)
+            return db.top_paths(limit, domain, first, last, status)
+        hits = collections.Counter()
+        for db, first, last in self._databases(start, end):
+            hits.update(dict(db.top_paths(None, domain, first, last, status)))
+        top = sorted(hits.items(), key=lambda item: (-item[1], item[0]))
+        return top if limit is None else top[:limit]
+
+    def status_counts(self, domain=None, start=None, end=None):
+        """
+        Count requests by their status.
+
+        As per `RequestDB.status_counts()`.
+        """
+        counts = collections.Counter()
+        for db, first, last in self._databases(start, end):
+            counts.update(db.status_counts(domain, first, last))
+        return dict(counts)
+
+    def bytes_served(self, domain=None, start=None, end=None, status=None):
+        """
+        Total bytes served.
+
+        As per `RequestDB.bytes_served()`.
+        """
+        return sum(
+            db.bytes_served(domain, first, last, status)
+            for db, first, last in self._databases(start, end))
+
+    def _databases(self, start=None, end=None):
+        """
+        Generate the partitions within a time range, for reports.
+
+        The range is narrowed for each partition, leaving out the start or
+        end if the whole of its month is within it, so that its rollups can
+        be used.
+
+        Yields:
+            3-tuples of `RequestDB`, and start and end for it.
+        """
+        for month in self.partitions(start, end):
+            first, last = month_range(month)
+            yield (
+                self.partition(month),
+                None if start is None or start <= first else start,
+                None if end is None or end >= last else end)
@@ -2,7 +2,47 @@
 HTTP request object and database.
 """
 
+from array import array
+import contextlib
+import hashlib
+import itertools
+import logging
+import os
 import sqlite3
+import time
+
+from . import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+# Number of bytes at the start of a log file used to identify it
+HEAD_SIZE = 1024
+
+# Length of each period of time for `RequestDB.requests_per_period()`
+PERIODS = {
+    'hour': 3600,
+    'day': 86400,
+}
+
+# Rollup tables kept up to date by `RequestDB`: the length of their periods
+# in seconds, and the column they count requests by, along with domain
+ROLLUPS = {
+    'requests_daily': (86400, 'status'),
+    'requests_hourly': (3600, 'status'),
+    'requests_daily_paths': (86400, 'path_id'),
+    'requests_hourly_paths': (3600, 'path_id'),
+}
+
+# Number of requests added in each transaction by `RequestDB`
+DEFAULT_LOAD_CHUNK = 10_000
+
+# Number of rows fetched at once by `RequestDB.iter_requests()`
+DEFAULT_FETCH_BATCH = 10_000
+
+# Size of the SQLite page cache used by `bulk_import()`, in KiB
+BULK_CACHE_SIZE = 256 * 1024
 
 
 class Request:
@@ -14,8 +54,10 @@ class Request:
         normalised by dropping any 'www.' prefix, if present.
         one if not present.
     ip
-        IP address of the requesting host as an integer, eg. 3221226219
-        The local util module contains functions to convert the format
+        IP address of the requesting host as an integer, eg. 3221226219,
+        from `utils.ip2int()`.  IPv6 addresses are integers too, in memory,
+        but are stored in SQLite as 16-byte BLOBs, see `utils.ip2sql()`.
+        Use `utils.int2ip()` to convert either back to a string.
     host
         Hostname obtained by running a reverse DNS lookup on the host ip.
         If the lookup failed it is set to None
@@ -58,6 +100,11 @@ class Request:
     def __getitem__(self, index):
         return self.__getattribute__(self.__slots__[index])
 
+    def __reduce__(self):
+        "Pickle as a plain tuple of values, which is much faster"
+        values = tuple(getattr(self, key, None) for key in self.__slots__)
+        return (_request_from_values, (values,))
+
     def __str__(self):
         return '{} {} {} {} {} {} {} {} "{}"'.format(
             self.domain, self.ip, self.host,
@@ -65,6 +112,247 @@ class Request:
             self.referrer, self.user_agent)
 
 
+def _request_from_values(values):
+    "Recreate Request from the plain tuple of values used to pickle it"
+    req = Request()
+    for key, value in zip(Request.__slots__, values):
+        setattr(req, key, value)
+    return req
+
+
+class RequestBatch:
+    """
+    Many requests held as columns of values, rather than as `Request` objects.
+
+    There is an attribute for every field of `Request`, each holding a column
+    of values for every request in the batch.  The integer fields
+    'timestamp', 'status', and 'size' are `array.array('q')` columns, with
+    missing values stored as `NULL`.  The other fields are lists, with None
+    for missing values, including 'ip', as IPv6 addresses need 128 bits.
+
+    skipped
+        Number of lines skipped because they could not be parsed.
+    """
+    INTEGER_FIELDS = ('timestamp', 'status', 'size')
+    NULL = -1
+
+    __slots__ = Request.__slots__ + ('skipped',)
+
+    def __init__(self, columns=None, skipped=0):
+        """
+        Initialise object.
+
+        Args:
+            columns (dict): Column of values for each field, by name.  Missing
+                columns are filled with missing values.  Integer columns may
+                be given as lists, with None for missing values.
+            skipped (int): Number of bad lines skipped.
+        """
+        columns = columns or {}
+        length = max((len(column) for column in columns.values()), default=0)
+        for key in Request.__slots__:
+            column = columns.get(key)
+            integer = key in self.INTEGER_FIELDS
+            if column is None:
+                column = [self.NULL if integer else None] * length
+            if integer and not isinstance(column, array):
+                column = array('q', [
+                    self.NULL if value is None else value for value in column])
+            if len(column) != length:
+                raise ValueError(
+                    f"Column {key!r} has {len(column)} values, not {length}")
+            setattr(self, key, column)
+        self.skipped = skipped
+
+    @classmethod
+    def from_requests(cls, requests):
+        """
+        Create batch from an iterable of `Request` objects, or 9-tuples.
+        """
+        rows = list(requests)
+        columns = dict(zip(Request.__slots__, map(list, zip(*rows))))
+        if not rows:
+            columns = {key: [] for key in Request.__slots__}
+        return cls(columns)
+
+    def __iter__(self):
+        "Create a `Request` object for every row"
+        for values in self.rows():
+            yield _request_from_values(values)
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def rows(self):
+        """
+        Iterate over a plain 9-tuple for each request.
+
+        Values are in the same order as the fields of `Request`.  Missing
+        values in integer columns are returned as None.
+        """
+        null = self.NULL
+        columns = []
+        for key in Request.__slots__:
+            column = getattr(self, key)
+            if key in self.INTEGER_FIELDS:
+                column = [None if value == null else value for value in column]
+            columns.append(column)
+        return zip(*columns)
+
+
+def _sql_rows(requests):
+    "Convert rows of request values to be stored by SQLite"
+    ip4_max = utils.IP4_MAX
+    ip2sql = utils.ip2sql
+    for row in requests:
+        ip = row[1]
+        if ip is not None and ip > ip4_max:
+            row = list(row)
+            row[1] = ip2sql(ip)
+        yield row
+
+
+def _chunks(rows, chunk_size, seconds=None):
+    """
+    Split an iterable into lists, each to be added in a single transaction.
+
+    Args:
+        rows: Iterable of anything.
+        chunk_size (int): Maximum length of each list.
+        seconds (float): Maximum time spent filling each list, or None.
+
+    Yields:
+        Non-empty lists.
+    """
+    rows = iter(rows)
+    if seconds is None:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    monotonic = time.monotonic
+    while True:
+        chunk = []
+        append = chunk.append
+        deadline = monotonic() + seconds
+        for row in rows:
+            append(row)
+            if len(chunk) >= chunk_size or monotonic() >= deadline:
+                break
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Dimension:
+    """
+    The ids of the values in a dimension table, eg. 'requests_paths'.
+
+    Every id is kept in memory, and new values are given their ids here,
+    rather than by SQLite, so that the ids for a whole chunk of requests can
+    be found before anything is inserted.
+    """
+    def __init__(self, connection, table, column):
+        cur = connection.execute(f"SELECT {column}, id FROM {table};")
+        self.ids = dict(cur)
+        self.get = self.ids.get
+        self.new = []
+        self._next_id = max(self.ids.values(), default=0) + 1
+        self._insert = f"INSERT INTO {table} (id, {column}) VALUES (?, ?);"
+
+    def add(self, value):
+        "Give value a new id, to be inserted by `flush()`.  None stays None."
+        if value is None:
+            return None
+        id_ = self.ids[value] = self._next_id
+        self._next_id += 1
+        self.new.append((id_, value))
+        return id_
+
+    def flush(self, connection):
+        "Insert the values added since the last flush"
+        if self.new:
+            connection.executemany(self._insert, self.new)
+            self.new = []
+
+
+@contextlib.contextmanager
+def bulk_import(
+        connection, cache_size=BULK_CACHE_SIZE, page_size=None,
+        drop_indexes=False):
+    """
+    Tune an SQLite connection for loading lots of data, as context manager.
+
+    For example::
+
+        >>> with bulk_import(connection, drop_indexes=True):
+        ...    load_everything(connection)
+
+    Switches to write-ahead logging with synchronous=NORMAL, which syncs to
+    disk only at checkpoints, and enlarges the page cache.  A power failure
+    during the import may lose the last few transactions, but never corrupts
+    the database.  Every setting is restored afterwards, even if an exception
+    is raised.  Commit everything to be kept before leaving, as any open
+    transaction is rolled back.
+
+    Args:
+        connection: `sqlite3.Connection`, not in a transaction.
+        cache_size (int): Size of page cache, in KiB.
+        page_size (int): Page size in bytes, eg. 16384.  Changing it means
+            rewriting the database with VACUUM, so only give it for new, or
+            small, databases.
+        drop_indexes (bool): Drop every index created with CREATE INDEX
+            before the import, and rebuild them afterwards, which is faster
+            than updating them row by row.  Indexes that enforce UNIQUE or
+            PRIMARY KEY constraints are always kept.
+
+    Return:
+        List of the names of indexes dropped.
+    """
+    def pragma(name, value=None):
+        if value is not None:
+            connection.execute(f"PRAGMA {name} = {value};")
+        return connection.execute(f"PRAGMA {name};").fetchone()[0]
+
+    saved = {
+        name: pragma(name)
+        for name in (
+            'journal_mode', 'synchronous', 'cache_size', 'temp_store')}
+    if page_size is not None and page_size != pragma('page_size'):
+        if saved['journal_mode'].lower() == 'wal':
+            pragma('journal_mode', 'DELETE')
+        pragma('page_size', page_size)
+        connection.execute("VACUUM;")
+    pragma('journal_mode', 'WAL')
+    pragma('synchronous', 'NORMAL')
+    pragma('cache_size', -cache_size)
+    pragma('temp_store', 'MEMORY')
+
+    indexes = []
+    if drop_indexes:
+        with connection as con:
+            indexes = con.execute(
+                "SELECT name, sql FROM sqlite_master "
+                "WHERE type='index' AND sql IS NOT NULL;").fetchall()
+            for name, _ in indexes:
+                logger.debug("Dropping index %r for bulk import", name)
+                con.execute(f'DROP INDEX "{name}";')
+
+    try:
+        yield [name for name, _ in indexes]
+    finally:
+        connection.rollback()
+        if indexes:
+            with connection as con:
+                for name, sql in indexes:
+                    logger.debug("Rebuilding index %r", name)
+                    con.execute(sql)
+        for name, value in saved.items():
+            pragma(name, value)
+
+
 class RequestDB:
     """
     Database of webserver request records.
@@ -75,21 +363,383 @@ class RequestDB:
     """
     def __init__(self, path):
         self._connection = sqlite3.connect(path)
+        self._dimensions = None
         self._check_schema()
 
-    def add_requests(self, requests):
+    def add_requests(
+            self, requests, chunk_size=DEFAULT_LOAD_CHUNK, seconds=None):
         """
         Bulk adding of request tuples into database.
 
         Uses an SQLite view with triggers to simplify insertion logic.
+        Requests are committed a chunk at a time, so if an exception is
+        raised the chunks before it are kept.
+
+        Args:
+            requests: Iterable of `Request` objects or 9-tuples, or a
+                `RequestBatch`.
+            chunk_size (int): Maximum number of requests in each transaction.
+            seconds (float): Commit at least this often, if given.
         """
-        with self._connection as con:
-            query = (
-                "INSERT INTO requests"
-                "(domain, ip, host, timestamp, path, "
-                "status, size, referrer, user_agent) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);")
-            con.executemany(query, requests)
+        if isinstance(requests, RequestBatch):
+            requests = requests.rows()
+        # New ids are given out by SQLite, not `load_requests()`
+        self._dimensions = None
+        query = (
+            "INSERT INTO requests"
+            "(domain, ip, host, timestamp, path, "
+            "status, size, referrer, user_agent) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);")
+        for chunk in _chunks(_sql_rows(requests), chunk_size, seconds):
+            with self._connection as con:
+                last_id = self._last_id()
+                con.executemany(query, chunk)
+                self._update_rollups(last_id)
+
+    def load_requests(
+            self, requests, chunk_size=DEFAULT_LOAD_CHUNK, seconds=None):
+        """
+        Bulk adding of requests, bypassing the view and its trigger.
+
+        Much faster than `add_requests()`, which runs three inserts and four
+        lookups in SQLite for every request.  Here the ids of the domains,
+        paths, and user agents are kept in memory, and only new values are
+        inserted, before a plain insert into 'requests_base' a chunk at a
+        time.  Referrers are stored alongside the domains.  Foreign keys are
+        not checked while loading, as every id comes from memory.
+
+        The ids are read from the database on first use, then kept up to date
+        by this object, so no other connection should add requests at the same
+        time.
+
+        Every chunk is committed in its own transaction, as per
+        `add_requests()`.
+
+        Args:
+            requests: Iterable of `Request` objects or 9-tuples, or a
+                `RequestBatch`.
+            chunk_size (int): Maximum number of requests in each transaction.
+            seconds (float): Commit at least this often, if given.
+        """
+        if isinstance(requests, RequestBatch):
+            requests = requests.rows()
+        for chunk in _chunks(requests, chunk_size, seconds):
+            self._load_chunk(chunk)
+
+    def load_file(
+            self, path, format_, chunk_size=DEFAULT_LOAD_CHUNK, seconds=None,
+            quarantine=None):
+        """
+        Load only the requests from a log file that are not already loaded.
+
+        As per `load_requests()`, but a checkpoint is recorded with every
+        chunk, in the same transaction: the position in the file just after
+        the last line loaded.  Lines that cannot be parsed are skipped.
+
+        Checkpoints are kept in a ledger, keyed by the contents of the first
+        `HEAD_SIZE` bytes of the file, rather than by its path, so that:
+
+        * A file that was loaded to its end, and has not changed since, is
+          skipped after checking its device, inode, size, and modification
+          time, without even being opened.
+        * An interrupted load resumes where it stopped, and a file that has
+          grown has only its new lines loaded.  A last line without its
+          newline may be only half-written, so is left for the next load.
+        * Rotated files, renamed or compressed, are recognised as having been
+          loaded already, under their old name.
+        * A file truncated and written anew, in place, is loaded from the
+          start, as its first line differs.
+
+        Args:
+            path (str): Path to plain or compressed log file.
+            format_: Format object, eg. `formats.ApacheCombined('lost.co.nz')`.
+            chunk_size (int): Maximum number of requests in each transaction.
+            seconds (float): Commit at least this often, if given.
+            quarantine: Optional path, or open file, to write bad lines to.
+
+        Returns:
+            The exhausted `parser.ParseStream`, for its counts of lines.
+        """
+        stat = os.stat(path)
+        if self._loaded(stat):
+            logger.debug("Skipping %r, as already loaded", path)
+            return format_.parse_stream(())
+
+        source = os.path.abspath(path)
+        _, extension = os.path.splitext(path)
+        compressed = extension.lower() in ('.bz2', '.gz', '.xz')
+        with utils.magic_open(path, 'rb') as fp:
+            head = fp.read(HEAD_SIZE)
+            key, byte_offset, line_number = self._find_checkpoint(stat, head)
+            if byte_offset is None:
+                byte_offset = line_number = 0
+            elif not compressed and stat.st_size < byte_offset:
+                logger.warning("Reloading %r, as truncated", path)
+                byte_offset = line_number = 0
+            logger.debug("Loading %r from byte %s", path, byte_offset)
+            fp.seek(byte_offset)
+            unfinished = 0
+
+            def finished_lines():
+                # A last line without its newline may still be being
+                # written, so is left for the next load
+                nonlocal unfinished
+                for line in fp:
+                    if not compressed and not line.endswith(b'\n'):
+                        unfinished = len(line)
+                        return
+                    yield line
+
+            lines = finished_lines()
+            if not format_.binary:
+                # Bad bytes must not stop the load, only spoil their line
+                lines = (line.decode('utf-8', 'replace') for line in lines)
+            stream = format_.parse_stream(lines, quarantine)
+
+            identity = (*key, source, stat.st_dev, stat.st_ino)
+
+            def offset():
+                return fp.tell() - unfinished
+
+            def checkpoint(stat=None):
+                # Size and time of file are only kept once loaded to its end
+                size = mtime = None
+                if stat is not None:
+                    size, mtime = stat.st_size, stat.st_mtime_ns
+                return (
+                    *identity, size, mtime, offset(),
+                    line_number + stream.lines, int(time.time()))
+
+            last = None
+            for chunk in _chunks(stream, chunk_size, seconds):
+                last = checkpoint()
+                self._load_chunk(chunk, last)
+
+            # End of file reached, though any lines after the last request
+            # were bad.  File may have grown while being read.
+            stat = os.stat(path)
+            if compressed or stat.st_size == offset():
+                last = checkpoint(stat)
+            elif last is None or last[7] != offset():
+                last = checkpoint()
+            else:
+                last = None
+            if head and last is not None:
+                self._load_chunk([], last)
+        return stream
+
+    def load_files(self, paths, format_, quarantine=None, **kwargs):
+        """
+        Load only the requests not already loaded from many log files.
+
+        Files are loaded oldest first, by modification time.  See
+        `load_file()`, which is given the keyword arguments.
+
+        Args:
+            paths: Iterable of paths, eg. from `glob.glob('logs/*')`.
+            format_: Format object, eg. `formats.ApacheCombined('lost.co.nz')`.
+            quarantine: Optional path, or open file, to write the bad lines
+                of every file to.
+
+        Returns:
+            Dictionary of `parser.ParseStream` objects, keyed by path.
+        """
+        streams = {}
+        with contextlib.ExitStack() as stack:
+            if isinstance(quarantine, (str, os.PathLike)):
+                # Opened just once, as every stream would overwrite it
+                quarantine = stack.enter_context(open(quarantine, 'wb'))
+            for path in sorted(paths, key=os.path.getmtime):
+                streams[path] = self.load_file(
+                    path, format_, quarantine=quarantine, **kwargs)
+        return streams
+
+    def checkpoint(self, path):
+        """
+        Find where loading the given log file got to.
+
+        Returns:
+            2-tuple of the offset in bytes, and the number of lines, of the
+            end of the last line loaded, or None if the file was never loaded.
+        """
+        with utils.magic_open(path, 'rb') as fp:
+            head = fp.read(HEAD_SIZE)
+        _, byte_offset, line_number = self._find_checkpoint(
+            os.stat(path), head, update=False)
+        if byte_offset is None:
+            return None
+        return byte_offset, line_number
+
+    def _loaded(self, stat):
+        "True if file was loaded to its end, and has not changed since"
+        cur = self._connection.execute(
+            "SELECT 1 FROM requests_checkpoints WHERE device=? AND inode=? "
+            "AND size=? AND mtime=?;",
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return cur.fetchone() is not None
+
+    def _find_checkpoint(self, stat, head, update=True):
+        """
+        Find the checkpoint for a log file in the ledger.
+
+        Files are identified by the hash of their head.  Files shorter than
+        `HEAD_SIZE` bytes have short heads, which change as they grow, so
+        for these the device and inode must match instead.
+
+        Args:
+            stat: Result of `os.stat()` on file.
+            head (bytes): Up to `HEAD_SIZE` bytes from start of file.
+            update (bool): Update the key of a short file that has grown.
+
+        Returns:
+            3-tuple of the key of the file in the ledger, and the byte offset
+            and line number of its checkpoint, both None if not found.
+        """
+        con = self._connection
+        key = (hashlib.sha1(head).hexdigest(), len(head))
+        cur = con.execute(
+            "SELECT byte_offset, line_number FROM requests_checkpoints "
+            "WHERE head_hash=? AND head_length=?;", key)
+        row = cur.fetchone()
+        if row is not None:
+            return (key, *row)
+
+        cur = con.execute(
+            "SELECT head_hash, head_length, byte_offset, line_number "
+            "FROM requests_checkpoints "
+            "WHERE device=? AND inode=? AND head_length < ?;",
+            (stat.st_dev, stat.st_ino, len(head)))
+        for head_hash, head_length, byte_offset, line_number in cur.fetchall():
+            if hashlib.sha1(head[:head_length]).hexdigest() == head_hash:
+                if update:
+                    with con:
+                        con.execute(
+                            "UPDATE requests_checkpoints "
+                            "SET head_hash=?, head_length=? "
+                            "WHERE head_hash=? AND head_length=?;",
+                            (*key, head_hash, head_length))
+                return key, byte_offset, line_number
+        return key, None, None
+
+    def _load_chunk(self, requests, checkpoint=None):
+        """
+        Insert requests, and optionally a checkpoint, in a single transaction.
+
+        Args:
+            requests: List of `Request` objects or 9-tuples.
+            checkpoint: Tuple of values for a 'requests_checkpoints' row.
+        """
+        if self._dimensions is None:
+            self._dimensions = (
+                _Dimension(self._connection, 'requests_hostnames', 'hostname'),
+                _Dimension(self._connection, 'requests_paths', 'path'),
+                _Dimension(
+                    self._connection, 'requests_user_agents', 'user_agent'),
+            )
+        hostnames, paths, user_agents = self._dimensions
+        hostname_id, new_hostname = hostnames.get, hostnames.add
+        path_id, new_path = paths.get, paths.add
+        user_agent_id, new_user_agent = user_agents.get, user_agents.add
+        ip4_max = utils.IP4_MAX
+        ip2sql = utils.ip2sql
+        rows = []
+        append = rows.append
+        try:
+            for (domain, ip, host, timestamp, path, status, size, referrer,
+                    user_agent) in requests:
+                if ip is not None and ip > ip4_max:
+                    ip = ip2sql(ip)
+                append((
+                    hostname_id(domain) or new_hostname(domain),
+                    ip,
+                    host,
+                    timestamp,
+                    path_id(path) or new_path(path),
+                    status,
+                    size,
+                    hostname_id(referrer) or new_hostname(referrer),
+                    user_agent_id(user_agent) or new_user_agent(user_agent),
+                ))
+
+            # Every id comes from the dimensions, so no foreign key checks
+            self._connection.execute('PRAGMA foreign_keys = OFF;')
+            with self._connection as con:
+                for dimension in self._dimensions:
+                    dimension.flush(con)
+                last_id = self._last_id()
+                con.executemany(
+                    "INSERT INTO requests_base"
+                    "(domain_id, ip, host, timestamp, path_id, "
+                    "status, size, referrer_id, user_agent_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", rows)
+                self._update_rollups(last_id)
+                if checkpoint is not None:
+                    con.execute(
+                        "INSERT OR REPLACE INTO requests_checkpoints "
+                        "(head_hash, head_length, source, device, inode, "
+                        "size, mtime, byte_offset, line_number, updated) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", checkpoint)
+        except BaseException:
+            # Ids given out in memory were never stored in the database
+            self._dimensions = None
+            raise
+        finally:
+            self._connection.execute('PRAGMA foreign_keys = ON;')
+
+    def _last_id(self):
+        "Id of the last request added, or zero"
+        cur = self._connection.execute("SELECT max(id) FROM requests_base;")
+        return cur.fetchone()[0] or 0
+
+    def _update_rollups(self, last_id, tables=ROLLUPS):
+        """
+        Add requests to the rollup tables.  Call in the same transaction
+        that the requests were added in.
+
+        Requests without a timestamp are left out.  Missing domains,
+        statuses, and paths are counted under zero.
+
+        Args:
+            last_id (int): Add requests with a greater id than this.
+            tables: Names of the rollup tables to add to.
+        """
+        for table in tables:
+            seconds, column = ROLLUPS[table]
+            self._connection.execute(
+                f"INSERT INTO {table} "
+                f"(period, domain_id, {column}, requests, bytes) "
+                f"SELECT timestamp / {seconds} * {seconds}, "
+                f"coalesce(domain_id, 0), coalesce({column}, 0), count(*), "
+                "coalesce(sum(size), 0) "
+                "FROM requests_base WHERE id > ? AND timestamp IS NOT NULL "
+                "GROUP BY 1, 2, 3 "
+                f"ON CONFLICT (period, domain_id, {column}) DO UPDATE SET "
+                "requests = requests + excluded.requests, "
+                "bytes = bytes + excluded.bytes;", (last_id,))
+
+    def bulk_import(self, drop_indexes=True, **kwargs):
+        """
+        Context manager to speed up adding lots of requests.
+
+        For example::
+
+            >>> with db.bulk_import():
+            ...    db.load_requests(requests)
+
+        Args:
+            drop_indexes (bool): Drop secondary indexes, rebuilding them
+                on exit.
+            kwargs: Passed to `bulk_import()`, eg. `page_size=16384`.
+
+        Return:
+            Context manager.
+        """
+        return bulk_import(
+            self._connection, drop_indexes=drop_indexes, **kwargs)
+
+    def close(self):
+        "Close the database connection"
+        self._connection.close()
 
     def count(self):
         "Return number of requests in database"
@@ -99,6 +749,266 @@ class RequestDB:
             count, = cur.fetchone()
             return count
 
+    def iter_requests(
+            self, domain=None, start=None, end=None, status=None,
+            output='requests', batch_size=DEFAULT_FETCH_BATCH):
+        """
+        Read requests back out of the database, in the order they were added.
+
+        Rows are fetched a batch at a time, so memory use stays the same
+        however many requests are read.  Requests should not be added to the
+        database while iterating.
+
+        For example, every request for lost.co.nz in March 2019::
+
+            >>> for req in db.iter_requests(
+            ...         'lost.co.nz', 1551398400, 1554076800):
+            ...     print(req)
+
+        Args:
+            domain, start, end, status: Filters, as per
+                `requests_per_period()`.
+            output (str): What to yield, either 'requests' for `Request`
+                objects, 'tuples' for plain 9-tuples of their values, or
+                'batches' for a `RequestBatch` of each batch of rows.
+            batch_size (int): Number of rows fetched at once.
+
+        Raises:
+            ValueError: If output is not known.
+
+        Returns:
+            Generator.
+        """
+        if output not in ('requests', 'tuples', 'batches'):
+            raise ValueError(f"Unknown output: {output!r}")
+        batches = self._fetch_batches(domain, start, end, status, batch_size)
+        if output == 'tuples':
+            return itertools.chain.from_iterable(batches)
+        if output == 'batches':
+            return (RequestBatch.from_requests(rows) for rows in batches)
+        return (
+            _request_from_values(values)
+            for values in itertools.chain.from_iterable(batches))
+
+    def _fetch_batches(self, domain, start, end, status, batch_size):
+        "Generate lists of 9-tuples of request values, for `iter_requests()`"
+        where, params = self._where(domain, start, end, status, undated=True)
+        cur = self._connection.execute(
+            "SELECT h.hostname, r.ip, r.host, r.timestamp, p.path, r.status, "
+            "r.size, h2.hostname, u.user_agent FROM requests_base AS r "
+            "LEFT OUTER JOIN requests_hostnames AS h ON r.domain_id = h.id "
+            "LEFT OUTER JOIN requests_paths AS p ON r.path_id = p.id "
+            "LEFT OUTER JOIN requests_hostnames AS h2 "
+            "ON r.referrer_id = h2.id "
+            "LEFT OUTER JOIN requests_user_agents AS u "
+            f"ON r.user_agent_id = u.id {where} ORDER BY r.id;", params)
+        sql2ip = utils.sql2ip
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                # IPv6 addresses are stored as BLOBs
+                for index, row in enumerate(rows):
+                    if row[1].__class__ is bytes:
+                        rows[index] = (row[0], sql2ip(row[1]), *row[2:])
+                yield rows
+        finally:
+            cur.close()
+
+    def requests_per_period(
+            self, period='day', domain=None, start=None, end=None,
+            status=None):
+        """
+        Count requests, and bytes served, in every period of time.
+
+        Requests without a timestamp are not counted, by this or any other
+        report.  For example, requests for lost.co.nz in March 2019, day by
+        day::
+
+            >>> db.requests_per_period(
+            ...     'day', 'lost.co.nz', 1551398400, 1554076800)
+            [(1551398400, 1543, 20193432), (1551484800, 1322, 17329112), ...]
+
+        Args:
+            period: One of 'hour', 'day', or 'month', or a number of seconds.
+            domain (str): Only count requests for this domain.
+            start (int): Only count requests at or after this timestamp.
+            end (int): Only count requests before this timestamp.
+            status (int): Only count requests with this status.
+
+        Returns:
+            List of 3-tuples of the timestamp of the start of the period, the
+            number of requests, and the number of bytes served, in order.
+            Periods without requests are left out.
+        """
+        if period == 'month':
+            seconds = 86400
+            bucket = (
+                "CAST(strftime('%s', {}, 'unixepoch', 'start of month') "
+                "AS INTEGER)")
+        else:
+            seconds = PERIODS.get(period, period)
+            if not isinstance(seconds, int) or seconds <= 0:
+                raise ValueError(f"Unknown period: {period!r}")
+            bucket = f"{{}} / {seconds} * {seconds}"
+
+        table = self._rollup('status', start, end, seconds)
+        if table is not None:
+            where, params = self._where(domain, start, end, status, 'period')
+            sql = (
+                f"SELECT {bucket.format('period')} AS bucket, "
+                f"sum(requests), sum(bytes) FROM {table} {where} "
+                "GROUP BY bucket ORDER BY bucket;")
+        else:
+            where, params = self._where(domain, start, end, status)
+            sql = (
+                f"SELECT {bucket.format('timestamp')} AS bucket, count(*), "
+                f"coalesce(sum(size), 0) FROM requests_base {where} "
+                "GROUP BY bucket ORDER BY bucket;")
+        return self._connection.execute(sql, params).fetchall()
+
+    def top_paths(
+            self, limit=10, domain=None, start=None, end=None, status=None):
+        """
+        Find the most requested paths.
+
+        Args:
+            limit (int): Maximum number of paths to return, or None for
+                every path.
+            domain, start, end, status: Filters, as per
+                `requests_per_period()`.
+
+        Returns:
+            List of 2-tuples of path and number of requests, most first.
+            Requests without a path are left out.
+        """
+        table = None
+        if status is None:
+            table = self._rollup('path_id', start, end)
+        if table is not None:
+            where, params = self._where(domain, start, end, time='period')
+            hits = 'sum(requests)'
+        else:
+            where, params = self._where(domain, start, end, status)
+            table, hits = 'requests_base', 'count(*)'
+        # Missing paths are NULL in 'requests_base', and zero in the rollups
+        where = f"{where} AND path_id > 0" if where else "WHERE path_id > 0"
+        top = (
+            f"SELECT path_id, {hits} AS hits FROM {table} {where} "
+            "GROUP BY path_id ORDER BY hits DESC, path_id LIMIT ?")
+        return self._connection.execute(
+            f"SELECT path, hits FROM ({top}) AS top "
+            "LEFT OUTER JOIN requests_paths AS p ON top.path_id = p.id "
+            "ORDER BY hits DESC, path_id;",
+            (*params, -1 if limit is None else limit)).fetchall()
+
+    def status_counts(self, domain=None, start=None, end=None):
+        """
+        Count requests by status of response.
+
+        Args:
+            domain, start, end: Filters, as per `requests_per_period()`.
+
+        Returns:
+            Dictionary of number of requests, keyed by status, eg. 200.
+        """
+        table = self._rollup('status', start, end)
+        if table is None:
+            where, params = self._where(domain, start, end)
+            return dict(self._connection.execute(
+                f"SELECT status, count(*) FROM requests_base {where} "
+                "GROUP BY status ORDER BY status;", params))
+        where, params = self._where(domain, start, end, time='period')
+        rows = self._connection.execute(
+            f"SELECT status, sum(requests) FROM {table} {where} "
+            "GROUP BY status ORDER BY status;", params)
+        return {status or None: count for status, count in rows}
+
+    def bytes_served(self, domain=None, start=None, end=None, status=None):
+        """
+        Total size of responses, in bytes.
+
+        Args:
+            domain, start, end, status: Filters, as per
+                `requests_per_period()`.
+        """
+        table = self._rollup('status', start, end)
+        if table is None:
+            where, params = self._where(domain, start, end, status)
+            sql = f"SELECT total(size) FROM requests_base {where};"
+        else:
+            where, params = self._where(domain, start, end, status, 'period')
+            sql = f"SELECT total(bytes) FROM {table} {where};"
+        total, = self._connection.execute(sql, params).fetchone()
+        return int(total)
+
+    def _rollup(self, column, start=None, end=None, period=None):
+        """
+        Choose the rollup table to answer a report from, if any.
+
+        Rollups can be used if the time range, and the length of the
+        periods reported on, are whole numbers of their periods.  Requests
+        without a timestamp are not in the rollups, so no report counts
+        them, see `_where()`.
+
+        Args:
+            column (str): Column being grouped by, 'status' or 'path_id'.
+            start, end (int): Time range of report, or None.
+            period (int): Length of periods reported on, in seconds.
+
+        Returns:
+            Name of table, or None to use 'requests_base'.
+        """
+        for table, (seconds, grouped) in ROLLUPS.items():
+            if grouped != column:
+                continue
+            if all(value is None or value % seconds == 0
+                   for value in (start, end, period)):
+                return table
+        return None
+
+    def _where(
+            self, domain=None, start=None, end=None, status=None,
+            time='timestamp', undated=False):
+        """
+        Build WHERE clause to filter 'requests_base' for reports.
+
+        Domains are looked up first, so that their ids can be used with the
+        indexes.  The rollup tables can be filtered too, by giving the name
+        of their time column, 'period'.
+
+        Requests without a timestamp are left out, unless `undated` is true,
+        so that reports give the same answers from the rollups, which cannot
+        count them, as from 'requests_base'.
+
+        Returns:
+            2-tuple of SQL, and list of parameters.
+        """
+        terms = []
+        params = []
+        if domain is not None:
+            cur = self._connection.execute(
+                "SELECT id FROM requests_hostnames WHERE hostname=?;",
+                (domain,))
+            row = cur.fetchone()
+            terms.append("domain_id=?")
+            params.append(None if row is None else row[0])
+        if status is not None:
+            terms.append("status=?")
+            params.append(status)
+        if start is not None:
+            terms.append(f"{time}>=?")
+            params.append(start)
+        if end is not None:
+            terms.append(f"{time}<?")
+            params.append(end)
+        if start is None and end is None and not undated:
+            terms.append(f"{time} IS NOT NULL")
+        if not terms:
+            return '', params
+        return f"WHERE {' AND '.join(terms)}", params
+
     def _check_schema(self):
         """
         Create tables, views and triggers if required.
@@ -118,6 +1028,7 @@ class RequestDB:
                 "type='table' and name='requests_base';")
             name = cur.fetchone()
             if name is not None:
+                self._upgrade_schema()
                 return
 
             # Create it all!
@@ -184,11 +1095,70 @@ LEFT OUTER JOIN requests_paths AS p ON r.path_id = p.id
 LEFT OUTER JOIN requests_hostnames AS h2 ON r.referrer_id == h2.id
 LEFT OUTER JOIN requests_user_agents AS u ON r.user_agent_id == u.id;
 
+COMMIT;
+
+        """
+        con.executescript(schema)
+        self._upgrade_schema()
+
+    def _upgrade_schema(self):
+        """
+        Add tables, indexes, and triggers missing from databases created by
+        earlier versions.
+
+        The trigger for inserting into the requests view used to leave out
+        the referrer, and is replaced.
+        """
+        con = self._connection
+        cur = con.execute(
+            "SELECT sql FROM sqlite_master WHERE "
+            "type='trigger' and name='insert_requests_view';")
+        trigger = cur.fetchone()
+        if trigger is not None and 'VALUES (NEW.referrer)' not in trigger[0]:
+            with con:
+                con.execute("DROP TRIGGER insert_requests_view;")
+
+        con.executescript("""
+
+BEGIN;
+
+-- Ledger of where loading each log file got to.  Files are identified by
+-- the hash of their head.  Their size and modification time are set only
+-- once loaded to their end.
+-- ---------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS requests_checkpoints
+(
+    head_hash     TEXT NOT NULL,
+    head_length   INTEGER NOT NULL,
+    source        TEXT NOT NULL,
+    device        INTEGER,
+    inode         INTEGER,
+    size          INTEGER,
+    mtime         INTEGER,
+    byte_offset   INTEGER NOT NULL,
+    line_number   INTEGER NOT NULL,
+    updated       INTEGER NOT NULL,
+    PRIMARY KEY (head_hash, head_length)
+);
+
+CREATE INDEX IF NOT EXISTS requests_checkpoints_inode
+    ON requests_checkpoints(device, inode);
+
+-- Covering indexes for reports, filtered by time range, domain, and status
+-- -------------------------------------------------------------------------
+CREATE INDEX IF NOT EXISTS requests_base_timestamp
+    ON requests_base(timestamp, status, size, path_id);
+CREATE INDEX IF NOT EXISTS requests_base_domain
+    ON requests_base(domain_id, timestamp, status, size, path_id);
+CREATE INDEX IF NOT EXISTS requests_base_status
+    ON requests_base(status, timestamp, domain_id, size, path_id);
+
 -- Allow inserting into view of requests data using SQLite INSTEAD OF trigger
 -- --------------------------------------------------------------------------
-CREATE TRIGGER insert_requests_view INSTEAD OF INSERT ON requests
+CREATE TRIGGER IF NOT EXISTS insert_requests_view INSTEAD OF INSERT ON requests
 BEGIN
 INSERT OR IGNORE INTO requests_hostnames (hostname) VALUES (NEW.domain);
+INSERT OR IGNORE INTO requests_hostnames (hostname) VALUES (NEW.referrer);
 INSERT OR IGNORE INTO requests_paths (path) VALUES (NEW.path);
 INSERT OR IGNORE INTO requests_user_agents (user_agent) VALUES (NEW.user_agent);
 INSERT INTO requests_base (
@@ -217,5 +1187,27 @@ END;
 
 COMMIT;
 
-        """
-        con.executescript(schema)
+        """)
+
+        # Rollups are filled in from existing requests when first created
+        for table, (seconds, column) in ROLLUPS.items():
+            cur = con.execute(
+                "SELECT name FROM sqlite_master WHERE "
+                "type='table' and name=?;", (table,))
+            if cur.fetchone() is not None:
+                continue
+            with con:
+                con.execute(f"""
+CREATE TABLE {table}
+(
+    period        INTEGER NOT NULL,
+    domain_id     INTEGER NOT NULL,
+    {column:<13} INTEGER NOT NULL,
+    requests      INTEGER NOT NULL,
+    bytes         INTEGER NOT NULL,
+    PRIMARY KEY (period, domain_id, {column})
+) WITHOUT ROWID;
+                """)
+                if self._last_id():
+                    logger.info("Filling in rollup table %r", table)
+                    self._update_rollups(0, tables=[table])
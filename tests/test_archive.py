@@ -0,0 +1,183 @@
+
+import os
+from os.path import join
+import tempfile
+from unittest import TestCase
+
+from huhu import archive
+from huhu import formats
+from huhu import request
+from huhu import utils
+
+from . import DATA_FOLDER
+
+
+ROWS = [
+    ('lost.co.nz', 3221226219, None, 1234567890, '/', 200, 1400,
+     None, 'Mozilla/5.0'),
+    ('lost.co.nz', 42540766411282592856903984951653826561, 'example.com',
+     1234567891, '/favicon.ico', 404, None, 'https://lost.co.nz/',
+     'Mozilla/5.0'),
+    ('example.com', None, None, 1234567880, '/caf\xe9', None, 0, None, None),
+    ('lost.co.nz', 1, None, 1234567900, '/', 304, 0, None, 'Mozilla/5.0'),
+    ('example.com', 1, None, 1234567990, '/', 200, 10, None, None),
+]
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = join(self.folder.name, 'test.huhu')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, rows, **kwargs):
+        with archive.ArchiveWriter(self.path, **kwargs) as writer:
+            writer.write(rows)
+        return archive.ArchiveReader(self.path)
+
+
+class ArchiveTest(ArchiveTestCase):
+    def test_round_trip(self):
+        with self.write(ROWS, block_size=2) as reader:
+            self.assertEqual(len(reader), 5)
+            self.assertEqual(reader.blocks, [
+                archive.Block(2, 1234567890, 1234567891),
+                archive.Block(2, 1234567880, 1234567900),
+                archive.Block(1, 1234567990, 1234567990),
+            ])
+            self.assertEqual(
+                list(reader.iter_requests(output='tuples')), ROWS)
+            requests = list(reader.iter_requests())
+            self.assertIsInstance(requests[0], request.Request)
+            self.assertEqual([tuple(req) for req in requests], ROWS)
+            batches = list(reader.iter_requests(output='batches'))
+            self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+            self.assertEqual(
+                [row for batch in batches for row in batch.rows()], ROWS)
+
+    def test_columns(self):
+        with self.write(ROWS) as reader:
+            columns = reader.columns(0)
+            self.assertEqual(
+                columns['timestamp'].tolist(), [0, 1, -11, 20, 90])
+            self.assertEqual(
+                columns['status'].tolist(), [200, 404, -1, 304, 200])
+            self.assertEqual(
+                [reader.strings[code] for code in columns['path']],
+                [row[4] for row in ROWS])
+            self.assertEqual(columns['ip'][1], -2)
+            with self.assertRaises(BufferError):
+                reader.close()
+            for view in columns.values():
+                view.release()
+
+    def test_filters(self):
+        with self.write(ROWS, block_size=2) as reader:
+            def rows(**kwargs):
+                return list(reader.iter_requests(output='tuples', **kwargs))
+            self.assertEqual(rows(start=1234567891), [ROWS[1], *ROWS[3:]])
+            self.assertEqual(rows(end=1234567891), ROWS[:1] + ROWS[2:3])
+            self.assertEqual(rows(domain='example.com'), ROWS[2::2])
+            self.assertEqual(
+                rows(domain='lost.co.nz', status=200, end=1234567990),
+                ROWS[:1])
+            self.assertEqual(rows(domain='missing.com'), [])
+            self.assertEqual(rows(start=1234568000), [])
+
+    def test_far_apart(self):
+        rows = [ROWS[0], ROWS[0][:3] + (2 ** 40,) + ROWS[0][4:]]
+        with self.write(rows) as reader:
+            self.assertEqual(
+                list(reader.iter_requests(output='tuples')), rows)
+
+    def test_empty(self):
+        with self.write([]) as reader:
+            self.assertEqual(len(reader), 0)
+            self.assertEqual(list(reader.iter_requests()), [])
+
+    def test_no_timestamp(self):
+        row = ('lost.co.nz', 1, None, None, '/', 200, 1000, None, None)
+        with self.assertRaisesRegex(ValueError, '^Request without'):
+            self.write([row])
+
+    def test_exception(self):
+        """
+        Archive is deleted, rather than finished, if writing it fails.
+        """
+        with self.assertRaises(KeyError):
+            with archive.ArchiveWriter(self.path, block_size=2) as writer:
+                writer.write(ROWS)
+                raise KeyError('oops')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_not_archive(self):
+        with self.assertRaisesRegex(ValueError, '^Not a huhu archive'):
+            archive.ArchiveReader(join(DATA_FOLDER, 'access.log'))
+        with open(self.path, 'wb') as fp:
+            fp.write(archive.MAGIC + bytes(100))
+        with self.assertRaisesRegex(ValueError, '^Incomplete huhu archive'):
+            archive.ArchiveReader(self.path)
+
+    def test_unknown_output(self):
+        with self.write(ROWS) as reader:
+            with self.assertRaisesRegex(ValueError, "^Unknown output"):
+                reader.iter_requests(output='rows')
+
+
+class ConvertTest(ArchiveTestCase):
+    def test_archive_logs(self):
+        format_ = formats.ApacheCustom()
+        source = join(DATA_FOLDER, 'access.log.gz')
+        streams = archive.archive_logs([source], self.path, format_)
+        with utils.magic_open(source, 'rt') as fp:
+            expected = [tuple(req) for req in format_.parse_stream(fp)]
+        self.assertEqual(streams[source].parsed, len(expected))
+        with archive.ArchiveReader(self.path) as reader:
+            self.assertEqual(
+                list(reader.iter_requests(output='tuples')), expected)
+
+    def test_detect_format(self):
+        source = join(DATA_FOLDER, 'access.log')
+        streams = archive.archive_logs([source], self.path)
+        with archive.ArchiveReader(self.path) as reader:
+            self.assertEqual(len(reader), streams[source].parsed)
+
+    def test_quarantine(self):
+        """
+        Bad lines of every file end up in the one quarantine file.
+        """
+        with open(join(DATA_FOLDER, 'access.log'), 'rb') as fp:
+            lines = fp.readlines()[:10]
+        paths = []
+        for index in range(2):
+            path = join(self.folder.name, f'access.log.{index}')
+            with open(path, 'wb') as fp:
+                fp.writelines(lines)
+                fp.write(b'bad line %d\n' % index)
+            paths.append(path)
+        quarantine = join(self.folder.name, 'bad.log')
+        streams = archive.archive_logs(paths, self.path, quarantine=quarantine)
+        self.assertEqual([streams[path].failed for path in paths], [1, 1])
+        with open(quarantine, 'rb') as fp:
+            self.assertEqual(
+                fp.readlines(), [b'bad line 0\n', b'bad line 1\n'])
+
+    def test_bad_bytes(self):
+        with open(join(DATA_FOLDER, 'access.log'), 'rb') as fp:
+            lines = fp.readlines()[:10]
+        source = join(self.folder.name, 'access.log')
+        with open(source, 'wb') as fp:
+            fp.writelines([*lines, b'\xff junk\n'])
+        streams = archive.archive_logs(
+            [source], self.path, formats.ApacheCustomTimeTaken())
+        stream = streams[source]
+        self.assertEqual((stream.lines, stream.failed), (11, 1))
+
+    def test_load_archive(self):
+        self.write(ROWS).close()
+        db = request.RequestDB(':memory:')
+        archive.load_archive(db, self.path, start=1234567890)
+        self.assertEqual(
+            list(db.iter_requests(output='tuples')), ROWS[:2] + ROWS[3:])
@@ -0,0 +1,110 @@
+
+import os
+import tempfile
+from unittest import mock, skipIf, TestCase
+
+from huhu import columns
+from huhu import request
+
+
+ROWS = [
+    ('lost.co.nz', 3221226219, None, 864000, '/', 200, 1000, None, None),
+    ('lost.co.nz', 2 ** 100, None, 864001, '/', 200, 1000, None, None),
+    ('lost.co.nz', 1, None, 864000 + 3600, '/a', 404, None, None, None),
+    ('example.com', None, None, 950400, '/a', None, 5, None, None),
+    ('example.com', 1, None, None, None, 304, 0, None, None),
+]
+
+
+class NoNumpyTest(TestCase):
+    def test_import_error(self):
+        db = request.RequestDB(':memory:')
+        with mock.patch.object(columns, 'numpy', None):
+            with self.assertRaisesRegex(ImportError, '^NumPy is required'):
+                columns.export_columns(db)
+
+
+@skipIf(columns.numpy is None, "NumPy not installed")
+class ColumnsTest(TestCase):
+    def setUp(self):
+        self.db = request.RequestDB(':memory:')
+        self.db.load_requests(ROWS, chunk_size=2)
+        self.columns = columns.export_columns(self.db, chunk_size=2)
+
+    def test_export(self):
+        self.assertEqual(len(self.columns), 5)
+        self.assertEqual(self.columns.ip.tolist(), [3221226219, -1, 1, -1, 1])
+        self.assertEqual(self.columns.size.tolist(), [1000, 1000, -1, 5, 0])
+        self.assertEqual(
+            self.columns.paths[self.columns.path_id].tolist(),
+            [row[4] for row in ROWS])
+        self.assertEqual(
+            self.columns.domains[self.columns.domain_id].tolist(),
+            [row[0] for row in ROWS])
+
+    def test_empty(self):
+        empty = columns.export_columns(request.RequestDB(':memory:'))
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.top_paths(), [])
+
+    def test_reports(self):
+        # Same answers as SQL, which leaves out requests without a timestamp
+        for args in [(), ('lost.co.nz',), (None, 864001), ('missing.com',)]:
+            self.assertEqual(
+                self.columns.requests_per_period('hour', *args),
+                self.db.requests_per_period('hour', *args))
+            self.assertEqual(
+                self.columns.top_paths(10, *args),
+                self.db.top_paths(10, *args))
+            self.assertEqual(
+                self.columns.bytes_served(*args),
+                self.db.bytes_served(*args))
+        self.assertEqual(
+            self.columns.status_counts(), {None: 1, 200: 2, 404: 1})
+        self.assertEqual(
+            self.columns.status_counts('lost.co.nz', 864000, 864001),
+            {200: 1})
+        with self.assertRaisesRegex(ValueError, "^Unknown period: 'week'"):
+            self.columns.requests_per_period('week')
+
+    def test_requests_per_period(self):
+        # Calendar months, and the same default period, as per SQL
+        self.db.load_requests([
+            ('lost.co.nz', 1, None, 1551398400 - 1, '/', 200, 1, None, None),
+            ('lost.co.nz', 1, None, 1551398400, '/', 200, 10, None, None),
+            ('lost.co.nz', 1, None, 1554076800 - 1, '/', 404, 100, None,
+             None),
+        ])
+        self.columns = columns.export_columns(self.db)
+        for args in [(), ('month',), ('hour', 'lost.co.nz'),
+                     ('month', None, 864001, None, 200), (3600 * 7,)]:
+            self.assertEqual(
+                self.columns.requests_per_period(*args),
+                self.db.requests_per_period(*args), args)
+        self.assertEqual(self.columns.requests_per_period('month')[-2:], [
+            (1548979200, 1, 1), (1551398400, 2, 110)])
+
+    def test_missing_path(self):
+        self.db.load_requests(
+            [('lost.co.nz', 1, None, 864000, None, 200, 0, None, None)] * 3)
+        self.columns = columns.export_columns(self.db)
+        self.assertEqual(self.columns.top_paths(), [('/', 2), ('/a', 2)])
+        self.assertEqual(self.columns.top_paths(), self.db.top_paths())
+
+    def test_load_columns(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cached = columns.load_columns(self.db, folder)
+            self.assertEqual(
+                cached.status.tolist(), self.columns.status.tolist())
+            self.assertIn('timestamp.npy', os.listdir(folder))
+
+            # Memory-mapped from the cache
+            with mock.patch.object(columns, 'export_columns') as export:
+                cached = columns.load_columns(self.db, folder)
+            export.assert_not_called()
+            self.assertIsInstance(cached.status, columns.numpy.memmap)
+
+            # Exported again once more requests are added
+            self.db.load_requests(ROWS[:1])
+            cached = columns.load_columns(self.db, folder)
+            self.assertEqual(len(cached), 6)
@@ -1,5 +1,8 @@
 
+import os
 import socket
+import sqlite3
+import tempfile
 import time
 import unittest
 
@@ -67,3 +70,49 @@ class TestDNSCache(unittest.TestCase):
         age = now - utils.date2epoch('[01/Oct/2009:00:00:00 +0000]')
         db.flush_good(age)
         self.assertEqual(db.count(), 465)
+
+
+class TestDNSCacheIP6(unittest.TestCase):
+    def test_ip6(self):
+        db = dns.DNSCache(':memory:')
+        ip6 = utils.ip2int('2001:db8::1')
+        db.add_records([
+            dns.Record(ip6, 1242412860, 'six.example.com'),
+            dns.Record(3734635876, 1242412860, 'four.example.com'),
+        ])
+        self.assertEqual(db.ip2hostname('2001:db8::1'), 'six.example.com')
+        self.assertEqual(db.ip2hostname('222.154.5.100'), 'four.example.com')
+        self.assertEqual(
+            str(dns.Record(ip6, 1242412860, None)),
+            '2009-05-15 2001:db8::1     None')
+
+    def test_upgrade_schema(self):
+        """
+        Caches created before IPv6 was supported are upgraded.
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'dnscache.db')
+            con = sqlite3.connect(path)
+            con.executescript(
+                "CREATE TABLE dns_cache "
+                "(ip INTEGER PRIMARY KEY, timestamp INTEGER, hostname TEXT);"
+                "INSERT INTO dns_cache "
+                "VALUES (3734635876, 1242412860, 'four');")
+            con.close()
+
+            db = dns.DNSCache(path)
+            db.add_records([(utils.ip2int('2001:db8::1'), 1242412860, 'six')])
+            self.assertEqual(db.count(), 2)
+            self.assertEqual(db.ip2hostname('222.154.5.100'), 'four')
+            self.assertEqual(db.ip2hostname('2001:db8::1'), 'six')
+            db._connection.close()
+
+    def test_bulk_import(self):
+        with tempfile.TemporaryDirectory() as folder:
+            db = dns.DNSCache(os.path.join(folder, 'dnscache.db'))
+            with db.bulk_import():
+                db.add_records([(3734635876, 1242412860, 'four')])
+            self.assertEqual(db.ip2hostname('222.154.5.100'), 'four')
+            mode, = db._connection.execute("PRAGMA journal_mode;").fetchone()
+            self.assertEqual(mode, 'delete')
+            db._connection.close()
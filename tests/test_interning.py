@@ -0,0 +1,61 @@
+
+from unittest import TestCase
+
+from huhu import interning
+
+
+class InternerTest(TestCase):
+    def test_shared(self):
+        interner = interning.Interner()
+        first = interner(''.join(['/index', '.html']))
+        second = ''.join(['/index', '.html'])
+        self.assertIsNot(first, second)
+        self.assertIs(interner(second), first)
+        self.assertIs(interner.get(second), first)
+        self.assertIsNone(interner.get('/other.html'))
+        self.assertEqual(len(interner), 1)
+
+    def test_none(self):
+        interner = interning.Interner()
+        self.assertIsNone(interner(None))
+        self.assertIsNone(interner.code(None))
+        self.assertEqual(len(interner), 0)
+
+    def test_codes(self):
+        interner = interning.Interner()
+        self.assertEqual(interner.code('a'), 0)
+        self.assertEqual(interner.code('b'), 1)
+        self.assertEqual(interner.code('a'), 0)
+        self.assertEqual(interner.lookup(1), 'b')
+        with self.assertRaises(KeyError):
+            interner.lookup(2)
+
+    def test_bounded(self):
+        interner = interning.Interner(maxsize=4)
+        for string in 'abcdef':
+            interner(string)
+            self.assertLessEqual(len(interner), 4)
+
+        # Oldest forgotten, along with their codes
+        self.assertNotIn('a', interner)
+        with self.assertRaises(KeyError):
+            interner.lookup(0)
+
+        # Codes are never reused
+        self.assertEqual(interner.code('a'), 6)
+
+    def test_recently_used_kept(self):
+        interner = interning.Interner(maxsize=4)
+        for string in 'abcdefghij':
+            interner('keep')
+            interner(string)
+        self.assertIn('keep', interner)
+        self.assertEqual(interner.code('keep'), 0)
+
+    def test_make_interners(self):
+        interners = interning.make_interners({'path': 10})
+        self.assertEqual(
+            sorted(interners), ['domain', 'path', 'referrer', 'user_agent'])
+        self.assertEqual(interners['path'].maxsize, 10)
+        self.assertEqual(
+            interners['domain'].maxsize, interning.DEFAULT_SIZES['domain'])
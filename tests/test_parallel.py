@@ -0,0 +1,225 @@
+
+import os
+from os.path import join
+import tempfile
+from unittest import TestCase
+
+from huhu import formats
+from huhu import parallel
+from huhu import request
+
+from . import DATA_FOLDER
+
+
+class ParallelTestCase(TestCase):
+    """
+    Create plain log file in the vhost combined format.
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.log')
+        self.lines = []
+        with open(join(DATA_FOLDER, 'access.log'), encoding='utf-8') as fp:
+            for line in fp:
+                # Drop trailing '%D' field
+                self.lines.append(line.rsplit(' ', 1)[0] + '\n')
+        self.lines.insert(500, 'blah blah blah\n')
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            fp.writelines(self.lines)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+
+class ChunkRangesTest(ParallelTestCase):
+    def test_chunk_ranges(self):
+        ranges = parallel.chunk_ranges(self.path, chunk_size=10_000)
+        self.assertGreater(len(ranges), 10)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+            self.assertGreaterEqual(end - start, 10_000)
+            self.assertEqual(data[end - 1:end], b'\n')
+
+    def test_small_file(self):
+        ranges = parallel.chunk_ranges(self.path)
+        self.assertEqual(ranges, [(0, os.path.getsize(self.path))])
+
+
+class ParallelParserTest(ParallelTestCase):
+    def setUp(self):
+        super().setUp()
+        format_ = formats.ApacheVCombined()
+        self.expected = []
+        for line in self.lines:
+            try:
+                self.expected.append(list(format_.parse(line)))
+            except ValueError:
+                pass
+
+    def test_ordered(self):
+        parser = parallel.ParallelParser(
+            formats.ApacheVCombined(), processes=2, chunk_size=20_000)
+        results = [list(req) for req in parser.parse(self.path, ordered=True)]
+        self.assertEqual(results, self.expected)
+
+        # Statistics
+        self.assertEqual(sum(stats.lines for stats in parser.stats), 1001)
+        self.assertEqual(sum(stats.errors for stats in parser.stats), 1)
+        workers = parser.worker_stats()
+        self.assertLessEqual(len(workers), 2)
+        for worker in workers.values():
+            self.assertGreater(worker['lines_per_second'], 0)
+
+    def test_unordered_binary(self):
+        parser = parallel.ParallelParser(
+            formats.ApacheVCombined(binary=True), chunk_size=20_000)
+        results = [list(req) for req in parser.parse(self.path)]
+        self.assertIsInstance(results[0], list)
+
+        def key(values):
+            return [str(value) for value in values]
+        self.assertEqual(
+            sorted(results, key=key), sorted(self.expected, key=key))
+
+    def test_bad_bytes(self):
+        with open(self.path, 'ab') as fp:
+            fp.write(b'\xff bad bytes\n')
+        parser = parallel.ParallelParser(
+            formats.ApacheVCombined(), processes=2, chunk_size=20_000)
+        results = [list(req) for req in parser.parse(self.path, ordered=True)]
+        self.assertEqual(results, self.expected)
+        self.assertEqual(sum(stats.errors for stats in parser.stats), 2)
+
+    def test_bad_month(self):
+        with open(self.path, 'a', encoding='utf-8') as fp:
+            fp.write(self.lines[0].replace('/Mar/', '/Xyz/'))
+        parser = parallel.ParallelParser(
+            formats.ApacheVCombined(), processes=2, chunk_size=20_000)
+        results = [list(req) for req in parser.parse(self.path, ordered=True)]
+        self.assertEqual(results, self.expected)
+        self.assertEqual(sum(stats.errors for stats in parser.stats), 2)
+
+    def test_compressed(self):
+        parser = parallel.ParallelParser(formats.ApacheVCombined())
+        with self.assertRaisesRegex(ValueError, '^Compressed files cannot'):
+            list(parser.parse(join(DATA_FOLDER, 'access.log.gz')))
+
+
+class PickleTest(TestCase):
+    def test_pickle_request(self):
+        import pickle
+        req = request.Request({'domain': 'lost.co.nz', 'status': 200})
+        copy = pickle.loads(pickle.dumps(req))
+        self.assertEqual(copy.domain, 'lost.co.nz')
+        self.assertEqual(copy.status, 200)
+        self.assertIsNone(copy.path)
+
+    def test_pickle_format(self):
+        import pickle
+        format_ = formats.ApacheCommon('example.com', fields=['domain'])
+        copy = pickle.loads(pickle.dumps(format_))
+        req = copy.parse(
+            '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] '
+            '"GET /apache_pb.gif HTTP/1.0" 200 2326')
+        self.assertEqual(req.domain, 'example.com')
+        self.assertIsNone(req.status)
+
+
+class MultiFileParserTest(TestCase):
+    def setUp(self):
+        self.paths = [
+            join(DATA_FOLDER, name) for name in (
+                'access.log',
+                'access.log.bz2',
+                'access.log.gz',
+                'access.log.xz')]
+        with open(self.paths[0], encoding='utf-8') as fp:
+            self.lines = fp.readlines()
+
+    def test_merge(self):
+        parser = parallel.MultiFileParser(
+            formats.ApacheCustomTimeTaken(), processes=2, batch_size=100)
+        results = list(parser.parse(self.paths))
+        self.assertEqual(len(results), 4000)
+        self.assertIsInstance(results[0], request.Request)
+        timestamps = [req.timestamp for req in results]
+        self.assertEqual(timestamps, sorted(timestamps))
+        for path in self.paths:
+            self.assertEqual(parser.stats[path], {'lines': 1000, 'errors': 0})
+
+    def test_interleaved(self):
+        """
+        Files that overlap in time are merged into timestamp order.
+        """
+        format_ = formats.ApacheCustomTimeTaken()
+        expected = [format_.parse(line).timestamp for line in self.lines]
+        paths = []
+        try:
+            for offset in (0, 1, 2):
+                fd, path = tempfile.mkstemp(suffix='.log')
+                with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+                    fp.writelines(self.lines[offset::3])
+                    fp.write('blah blah blah\n')
+                paths.append(path)
+            parser = parallel.MultiFileParser(
+                formats.ApacheCustomTimeTaken(binary=True), batch_size=50)
+            timestamps = [req.timestamp for req in parser.parse(paths)]
+        finally:
+            for path in paths:
+                os.remove(path)
+        self.assertEqual(timestamps, expected)
+        self.assertEqual(parser.stats[paths[0]], {'lines': 335, 'errors': 1})
+
+    def test_bad_bytes(self):
+        fd, path = tempfile.mkstemp(suffix='.log')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(''.join(self.lines[:10]).encode('utf-8'))
+                fp.write(b'\xff bad bytes\n')
+            parser = parallel.MultiFileParser(
+                formats.ApacheCustomTimeTaken(), batch_size=5)
+            results = list(parser.parse([path]))
+        finally:
+            os.remove(path)
+        self.assertEqual(len(results), 10)
+        self.assertEqual(parser.stats[path], {'lines': 11, 'errors': 1})
+
+    def test_bad_month(self):
+        fd, path = tempfile.mkstemp(suffix='.log')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+                fp.writelines(self.lines[:10])
+                fp.write(self.lines[10].replace('/Mar/', '/Xyz/'))
+            parser = parallel.MultiFileParser(
+                formats.ApacheCustomTimeTaken(), batch_size=5)
+            results = list(parser.parse([path, self.paths[0]]))
+        finally:
+            os.remove(path)
+        self.assertEqual(len(results), 1010)
+        self.assertEqual(parser.stats[path], {'lines': 11, 'errors': 1})
+
+    def test_detect_format(self):
+        parser = parallel.MultiFileParser(None, batch_size=100)
+        results = list(parser.parse(self.paths[:2]))
+        self.assertEqual(len(results), 2000)
+        self.assertEqual(results[0].status, 200)
+
+    def test_stop_early(self):
+        parser = parallel.MultiFileParser(
+            formats.ApacheCustomTimeTaken(), batch_size=10)
+        results = parser.parse(self.paths)
+        self.assertIsInstance(next(results), request.Request)
+        results.close()
+
+    def test_no_files(self):
+        parser = parallel.MultiFileParser(formats.ApacheCustomTimeTaken())
+        self.assertEqual(list(parser.parse([])), [])
+
+    def test_missing_file(self):
+        parser = parallel.MultiFileParser(formats.ApacheCustomTimeTaken())
+        paths = [self.paths[0], join(DATA_FOLDER, 'no-such-file.log')]
+        with self.assertRaises(FileNotFoundError):
+            list(parser.parse(paths))
@@ -1,7 +1,13 @@
 
+import io
+from os.path import exists, join
+import tempfile
 from unittest import skip, TestCase
 
-from huhu.parser import ApacheLogParser
+from huhu.parser import ApacheLogParser, ApacheLogParserError
+from huhu.utils import magic_open
+
+from . import DATA_FOLDER
 
 
 class ApacheLogParserBasicsTest(TestCase):
@@ -149,3 +155,330 @@ class ApacheMyFavouriteLogFormatTest(TestCase):
             'usec_taken': '168',
         }
         self.assertEqual(dict(data._asdict()), expected)
+
+
+class ApacheLogParserTokenizerTest(TestCase):
+    """
+    Generated tokenizer must agree with the regex, which acts as the oracle.
+    """
+    my_format = ApacheMyFavouriteLogFormatTest.my_format
+
+    def test_agrees_with_regex(self):
+        parser = ApacheLogParser(self.my_format)
+        with magic_open(join(DATA_FOLDER, 'access.log')) as fp:
+            for line in fp:
+                line = line.strip()
+                values = parser.tokenize(line)
+                self.assertIsNotNone(values)
+                self.assertEqual(values, parser.regex.match(line).groups())
+
+    def test_common_log_format(self):
+        parser = ApacheLogParser(ApacheCommonLogFormatTest.common_format)
+        line = ApacheCommonLogFormatTest.line
+        self.assertEqual(
+            parser.tokenize(line), parser.regex.match(line).groups())
+
+    def test_rejects_escaped_quotes(self):
+        parser = ApacheLogParser(self.my_format)
+        line = ('- ::1 - - [04/Mar/2019:06:32:23 +0000] "GET / HTTP/1.0" '
+                '200 - "-" "Evil \\"quoted\\" agent" 168')
+        self.assertIsNone(parser.tokenize(line))
+        data = parser.parse(line)
+        self.assertEqual(
+            data.request_header_user_agent, 'Evil \\"quoted\\" agent')
+
+    def test_rejects_malformed(self):
+        parser = ApacheLogParser(self.my_format)
+        lines = (
+            '',
+            'blah blah blah',
+            '- ::1 - - [04/Mar/2019:06:32:23 +0000] "GET / HTTP/1.0" '
+            '200  "-" "-" 168',
+            '- ::1 - - [04/Mar/2019:06:32:23] +0000] "GET / HTTP/1.0" '
+            '200 - "-" "-" 168',
+            '- ::1 - - 04/Mar/2019:06:32:23 +0000 "GET / HTTP/1.0" '
+            '200 - "-" "-" 168',
+            '- ::1 - - [04/Mar/2019:06:32:23 +0000] "GET / HTTP/1.0" '
+            '200 - "-""-" 168',
+            '- ::1 -\t- [04/Mar/2019:06:32:23 +0000] "GET / HTTP/1.0" '
+            '200 - "-" "-" 168',
+        )
+        for line in lines:
+            self.assertIsNone(parser.tokenize(line))
+            self.assertIsNone(parser.regex.match(line))
+
+    def test_whitespace_agrees_with_regex(self):
+        line = ('- ::1 - - [04/Mar/2019:06:32:23 +0000] "GET / HTTP/1.0" '
+                '200 - "-" "Mozilla/5.0" 168')
+        for binary in (False, True):
+            parser = ApacheLogParser(self.my_format, binary=binary)
+            for char in '\t\n\x0b\x0c\r\x1c\x85\xa0\u2003':
+                if binary and ord(char) > 0xff:
+                    continue
+                for field in ('::1', '06:32:23', 'Mozilla/5.0', '200'):
+                    changed = line.replace(field, field[0] + char + field[1:])
+                    if binary:
+                        changed = changed.encode('latin-1')
+                    values = parser.tokenize(changed)
+                    match = parser.regex.match(changed)
+                    # The tokenizer may leave a line to the regex, but must
+                    # never accept one that the regex would not
+                    if values is not None or match is None:
+                        self.assertEqual(
+                            values, match and match.groups(), (char, field))
+
+        # Whitespace inside quoted fields is fine, but left to the regex
+        parser = ApacheLogParser(self.my_format)
+        line = line.replace('Mozilla/5.0', 'Mozilla/5.0\t\xa0')
+        self.assertIsNone(parser.tokenize(line))
+        self.assertEqual(
+            parser.parse(line).request_header_user_agent, 'Mozilla/5.0\t\xa0')
+
+    def test_binary_agrees_with_regex(self):
+        parser = ApacheLogParser(self.my_format, binary=True)
+        self.assertIsInstance(parser.regex.pattern, bytes)
+        with magic_open(join(DATA_FOLDER, 'access.log'), 'rb') as fp:
+            for line in fp:
+                line = line.strip()
+                values = parser.tokenize(line)
+                self.assertIsNotNone(values)
+                self.assertEqual(values, parser.regex.match(line).groups())
+
+    def test_binary_parse(self):
+        parser = ApacheLogParser(self.my_format, binary=True)
+        line = ('- ::1 - - [04/Mar/2019:06:32:23 +0000] "GET / HTTP/1.0" '
+                '200 - "-" "Evil \\"quoted\\" agent" 168').encode('ascii')
+        self.assertIsNone(parser.tokenize(line))
+        data = parser.parse(line)
+        self.assertEqual(data.time_received, b'[04/Mar/2019:06:32:23 +0000]')
+        self.assertEqual(
+            data.request_header_user_agent, b'Evil \\"quoted\\" agent')
+
+
+class LazyLineTest(TestCase):
+    """
+    Lazy lines must behave just like the namedtuples they replace.
+    """
+    my_format = ApacheMyFavouriteLogFormatTest.my_format
+    line = ApacheMyFavouriteLogFormatTest.line
+
+    def test_agrees_with_namedtuple(self):
+        eager = ApacheLogParser(self.my_format)
+        lazy = ApacheLogParser(self.my_format, lazy=True)
+        with magic_open(join(DATA_FOLDER, 'access.log')) as fp:
+            for line in fp:
+                expected = eager.parse(line)
+                data = lazy.parse(line)
+                self.assertEqual(data, expected)
+                self.assertEqual(data.status, expected.status)
+                self.assertEqual(data._asdict(), expected._asdict())
+
+    def test_sequence(self):
+        parser = ApacheLogParser(self.my_format, lazy=True)
+        data = parser.parse(self.line)
+        self.assertEqual(data._fields, parser.namedtuple._fields)
+        self.assertEqual(len(data), 11)
+        self.assertEqual(data[0], 'arg.co.nz')
+        self.assertEqual(data[-1], '184')
+        self.assertEqual(list(data)[6], '200')
+        self.assertTrue(repr(data).startswith(
+            "LazyLine(request_header_host='arg.co.nz', "))
+
+    def test_work_postponed(self):
+        parser = ApacheLogParser(self.my_format, lazy=True)
+        data = parser.parse('blah blah blah')
+        self.assertIsNone(data._values)
+        with self.assertRaisesRegex(ApacheLogParserError, '^Unable to parse'):
+            data.status
+
+    def test_binary(self):
+        parser = ApacheLogParser(self.my_format, binary=True, lazy=True)
+        data = parser.parse(self.line.encode('ascii'))
+        self.assertEqual(data.usec_taken, b'184')
+
+
+class ApacheLogParserFieldsTest(TestCase):
+    """
+    Only extract the fields asked for.
+    """
+    my_format = ApacheMyFavouriteLogFormatTest.my_format
+    line = ApacheMyFavouriteLogFormatTest.line
+
+    def test_projection(self):
+        parser = ApacheLogParser(
+            self.my_format, fields=['usec_taken', 'status', 'time_received'])
+        self.assertEqual(
+            parser.namedtuple._fields,
+            ('time_received', 'status', 'usec_taken'))
+        self.assertEqual(parser.regex.groups, 3)
+        expected = ('[04/Mar/2019:06:25:40 +0000]', '200', '184')
+        self.assertEqual(parser.tokenize(self.line), expected)
+        self.assertEqual(parser.regex.match(self.line).groups(), expected)
+        self.assertEqual(parser.parse(self.line), expected)
+
+    def test_still_checks_whole_line(self):
+        parser = ApacheLogParser(self.my_format, fields=['status'])
+        line = self.line.replace('[04/Mar/2019:06:25:40 +0000]', '-')
+        with self.assertRaises(ApacheLogParserError):
+            parser.parse(line)
+
+    def test_no_fields(self):
+        parser = ApacheLogParser(self.my_format, fields=[])
+        self.assertEqual(parser.parse(self.line), ())
+
+    def test_unknown_field(self):
+        message = '^Fields not in log format: referrer, size$'
+        with self.assertRaisesRegex(ApacheLogParserError, message):
+            ApacheLogParser(
+                self.my_format, fields=['status', 'size', 'referrer'])
+
+
+class ApacheLogParserTypedTest(TestCase):
+    """
+    Convert the values of numeric and time fields.
+    """
+    my_format = ApacheMyFavouriteLogFormatTest.my_format
+    line = ApacheMyFavouriteLogFormatTest.line
+
+    def test_typed(self):
+        parser = ApacheLogParser(self.my_format, typed=True)
+        data = parser.parse(self.line)
+        self.assertEqual(data.remote_host, 2050541001)
+        self.assertEqual(data.remote_logname, '-')
+        self.assertEqual(data.time_received, 1551680740)
+        self.assertEqual(data.status, 200)
+        self.assertEqual(data.response_size, 19380)
+        self.assertEqual(data.usec_taken, 184)
+
+    def test_missing_values(self):
+        line = ('- ::1 - - [04/Mar/2019:06:32:23 +0000] "OPTIONS * HTTP/1.0" '
+                '200 - "-" '
+                '"Apache/2.4.7 (Ubuntu) (internal dummy connection)" -')
+        parser = ApacheLogParser(self.my_format, typed=True)
+        data = parser.parse(line)
+        self.assertEqual(data.remote_host, 2130706433)
+        self.assertIsNone(data.response_size)
+        self.assertIsNone(data.usec_taken)
+        self.assertEqual(data.request_header_referer, '-')
+
+    def test_remote_host(self):
+        parser = ApacheLogParser(self.my_format, typed=True)
+        for host, expected in (
+                ('2001:db8::1', 42540766411282592856903984951653826561),
+                ('::ffff:122.56.197.201', 2050541001),
+                ('proxy.example.com', 'proxy.example.com')):
+            line = self.line.replace('122.56.197.201', host)
+            self.assertEqual(parser.parse(line).remote_host, expected)
+
+    def test_regex_converted(self):
+        """
+        Values are converted when falling back to the regex, too.
+        """
+        parser = ApacheLogParser(self.my_format, typed=True)
+        line = self.line.replace('ONE E1003', 'ONE \\"E1003')
+        self.assertIsNone(parser.tokenize(line))
+        data = parser.parse(line)
+        self.assertEqual(data.time_received, 1551680740)
+        self.assertEqual(data.status, 200)
+
+    def test_numbers_checked(self):
+        line = self.line.replace(' 200 ', ' OK ')
+        self.assertEqual(
+            ApacheLogParser(self.my_format).parse(line).status, 'OK')
+        parser = ApacheLogParser(self.my_format, typed=True)
+        self.assertIsNone(parser.tokenize(line))
+        self.assertIsNone(parser.regex.match(line))
+        with self.assertRaisesRegex(ApacheLogParserError, '^Unable to parse'):
+            parser.parse(line)
+
+    def test_bad_time(self):
+        line = self.line.replace('Mar', 'Bar')
+        parser = ApacheLogParser(self.my_format, typed=True)
+        message = '^Unable to convert'
+        with self.assertRaisesRegex(ApacheLogParserError, message):
+            parser.parse(line)
+
+    def test_binary(self):
+        text = ApacheLogParser(self.my_format, typed=True)
+        binary = ApacheLogParser(self.my_format, binary=True, typed=True)
+        data = binary.parse(self.line.encode('utf-8'))
+        self.assertEqual(
+            data.request,
+            b'GET /s/common/images/logo.847646ee69b7.png HTTP/1.1')
+        for name in ('remote_host', 'time_received', 'status', 'usec_taken'):
+            self.assertEqual(
+                getattr(data, name), getattr(text.parse(self.line), name))
+
+    def test_projection(self):
+        parser = ApacheLogParser(
+            self.my_format, fields=['usec_taken', 'time_received'], typed=True)
+        self.assertEqual(parser.parse(self.line), (1551680740, 184))
+        with self.assertRaises(ApacheLogParserError):
+            parser.parse(self.line.replace(' 200 ', ' OK '))
+
+
+class ParseStreamTest(TestCase):
+    """
+    Skip over bad lines, counting and quarantining them.
+    """
+    my_format = ApacheMyFavouriteLogFormatTest.my_format
+    line = ApacheMyFavouriteLogFormatTest.line
+
+    def setUp(self):
+        self.lines = [
+            self.line + '\n',
+            'GET /wp-login.php HTTP/1.1\n',
+            self.line.replace('Mar', 'Bar') + '\n',
+            self.line + '\n',
+            '\n',
+        ]
+
+    def test_parse_stream(self):
+        parser = ApacheLogParser(self.my_format, typed=True)
+        stream = parser.parse_stream(self.lines)
+        results = list(stream)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0], parser.parse(self.line))
+        self.assertEqual(stream.lines, 5)
+        self.assertEqual(stream.parsed, 2)
+        self.assertEqual(stream.failed, 3)
+        self.assertEqual(stream.failures, {'unmatched': 2, 'KeyError': 1})
+        self.assertEqual(stream.quarantined, 0)
+
+    def test_quarantine(self):
+        parser = ApacheLogParser(self.my_format, typed=True, lazy=True)
+        with tempfile.TemporaryDirectory() as folder:
+            path = join(folder, 'quarantine.log')
+            stream = parser.parse_stream(self.lines, quarantine=path, limit=2)
+            self.assertEqual(len(list(stream)), 2)
+            with open(path, encoding='utf-8') as fp:
+                quarantined = fp.readlines()
+        self.assertEqual(quarantined, self.lines[1:3])
+        self.assertEqual(stream.quarantined, 2)
+        self.assertEqual(stream.failed, 3)
+
+    def test_quarantine_file_object(self):
+        parser = ApacheLogParser(self.my_format, binary=True)
+        lines = [line.encode('utf-8') for line in self.lines]
+        fp = io.BytesIO()
+        stream = parser.parse_stream(lines, quarantine=fp, limit=None)
+        self.assertEqual(len(list(stream)), 3)
+        self.assertFalse(fp.closed)
+        self.assertEqual(fp.getvalue(), b'GET /wp-login.php HTTP/1.1\n\n')
+
+    def test_quarantine_binary_to_text(self):
+        # Binary lines to a text file, eg. sys.stderr
+        parser = ApacheLogParser(self.my_format, binary=True)
+        lines = [b'bad \xff line\n', self.line.encode('utf-8')]
+        fp = io.StringIO()
+        stream = parser.parse_stream(lines, quarantine=fp)
+        self.assertEqual(len(list(stream)), 1)
+        self.assertEqual(fp.getvalue(), 'bad \ufffd line\n')
+
+    def test_no_bad_lines(self):
+        parser = ApacheLogParser(self.my_format)
+        with tempfile.TemporaryDirectory() as folder:
+            path = join(folder, 'quarantine.log')
+            stream = parser.parse_stream([self.line], quarantine=path)
+            self.assertEqual(len(list(stream)), 1)
+            self.assertFalse(exists(path))
@@ -0,0 +1,172 @@
+
+import os
+import tempfile
+from unittest import TestCase
+
+from huhu import partitions
+from huhu import request
+
+
+DAY = 86400
+MARCH = 1551398400          # 2019-03-01 00:00:00 UTC
+APRIL = MARCH + 31 * DAY
+MAY = APRIL + 30 * DAY
+
+
+class MonthTest(TestCase):
+    def test_month_of(self):
+        self.assertEqual(partitions.month_of(MARCH), (2019, 3))
+        self.assertEqual(partitions.month_of(APRIL - 1), (2019, 3))
+
+    def test_month_range(self):
+        self.assertEqual(partitions.month_range((2019, 3)), (MARCH, APRIL))
+        self.assertEqual(
+            partitions.month_range((2019, 12)), (1575158400, 1577836800))
+
+
+class PartitionedRequestDBTest(TestCase):
+    rows = [
+        ('lost.co.nz', 1, None, MARCH - 1, '/', 200, 1000, None, None),
+        ('lost.co.nz', 1, None, MARCH, '/', 200, 100, None, None),
+        ('lost.co.nz', 1, None, MARCH + DAY + 1, '/a', 404, 10, None, None),
+        ('example.com', 1, None, APRIL - 1, '/a', 200, 1, None, None),
+        ('lost.co.nz', 1, None, APRIL + 3600, '/a', 200, 5, None, None),
+        ('lost.co.nz', 1, None, MAY, '/b', 304, 0, None, None),
+    ]
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.db = partitions.PartitionedRequestDB(self.folder.name)
+        self.db.load_requests(self.rows, chunk_size=2)
+        self.single = request.RequestDB(':memory:')
+        self.single.load_requests(self.rows)
+
+    def tearDown(self):
+        self.db.close()
+        self.single.close()
+        self.folder.cleanup()
+
+    def test_load_requests(self):
+        self.assertEqual(sorted(os.listdir(self.folder.name)), [
+            'requests-2019-02.db', 'requests-2019-03.db',
+            'requests-2019-04.db', 'requests-2019-05.db'])
+        self.assertEqual(self.db.count(), 6)
+        self.assertEqual(self.db.partition((2019, 3)).count(), 3)
+
+    def test_no_timestamp(self):
+        row = ('lost.co.nz', 1, None, None, '/', 200, 1000, None, None)
+        with self.assertRaisesRegex(ValueError, '^Request without'):
+            self.db.load_requests([row])
+
+    def test_partitions(self):
+        self.assertEqual(
+            self.db.partitions(MARCH, APRIL + 1), [(2019, 3), (2019, 4)])
+        self.assertEqual(self.db.partitions(end=MARCH), [(2019, 2)])
+        self.assertEqual(len(self.db.partitions()), 4)
+
+    def test_max_open(self):
+        db = partitions.PartitionedRequestDB(self.folder.name, max_open=2)
+        self.assertEqual(db.count(), 6)
+        self.assertEqual(list(db._open), [(2019, 4), (2019, 5)])
+        db.close()
+        self.assertEqual(len(db._open), 0)
+
+    def test_max_open_reports(self):
+        # More months in the range than may be open at once
+        db = partitions.PartitionedRequestDB(self.folder.name, max_open=2)
+        self.assertEqual(
+            db.top_paths(2, 'lost.co.nz'),
+            self.single.top_paths(2, 'lost.co.nz'))
+        self.assertEqual(
+            list(db.iter_requests(output='tuples')), self.rows)
+        self.assertEqual(db.status_counts(), self.single.status_counts())
+        db.close()
+
+    def test_reports(self):
+        # Same answers as a single database
+        ranges = [
+            (None, None), (MARCH, None), (MARCH + 1, APRIL + 3600),
+            (MARCH, MAY)]
+        for start, end in ranges:
+            for period in ('hour', 'day', 'month', 7 * DAY):
+                self.assertEqual(
+                    self.db.requests_per_period(period, start=start, end=end),
+                    self.single.requests_per_period(
+                        period, start=start, end=end))
+            self.assertEqual(
+                self.db.top_paths(2, 'lost.co.nz', start, end),
+                self.single.top_paths(2, 'lost.co.nz', start, end))
+            self.assertEqual(
+                self.db.status_counts(start=start, end=end),
+                self.single.status_counts(start=start, end=end))
+            self.assertEqual(
+                self.db.bytes_served(start=start, end=end, status=200),
+                self.single.bytes_served(start=start, end=end, status=200))
+
+    def test_iter_requests(self):
+        self.assertEqual(
+            list(self.db.iter_requests(output='tuples')), self.rows)
+        self.assertEqual(
+            list(self.db.iter_requests(
+                'lost.co.nz', MARCH, APRIL + 3600, output='tuples')),
+            self.rows[1:3])
+
+    def test_expire(self):
+        self.assertEqual(self.db.expire(APRIL + 1), [(2019, 2), (2019, 3)])
+        self.assertEqual(self.db.count(), 2)
+        self.assertEqual(self.db.expire(APRIL + 1), [])
+        self.assertEqual(
+            sorted(os.listdir(self.folder.name)),
+            ['requests-2019-04.db', 'requests-2019-05.db'])
+
+    def test_attach(self):
+        with self.db.attach(MARCH, MAY) as con:
+            rows = con.execute(
+                "SELECT domain, timestamp, path FROM requests "
+                "ORDER BY timestamp;").fetchall()
+        self.assertEqual(
+            rows, [(row[0], row[3], row[4]) for row in self.rows[1:5]])
+
+        with self.db.attach(end=0) as con:
+            rows = con.execute("SELECT * FROM requests;").fetchall()
+        self.assertEqual(rows, [])
+
+    def test_attach_limit(self):
+        year = [
+            ('lost.co.nz', 1, None, MAY + month * 31 * DAY, '/', 200, 1,
+             None, None)
+            for month in range(8)]
+        self.db.load_requests(year)
+        with self.assertRaisesRegex(ValueError, '^Cannot attach 11 part'):
+            with self.db.attach():
+                pass
+
+    def test_bulk_import_max_open(self):
+        # Partitions stay open, without their indexes, until the end
+        db = partitions.PartitionedRequestDB(self.folder.name, max_open=1)
+        with db.bulk_import():
+            db.load_requests(self.rows)
+            self.assertEqual(len(db._open), 4)
+            index = db.partition((2019, 3))._connection.execute(
+                "SELECT name FROM sqlite_master WHERE "
+                "name='requests_base_timestamp';").fetchone()
+            self.assertIsNone(index)
+        self.assertEqual(len(db._open), 0)
+        self.assertEqual(db.count(), 12)
+        self.assertEqual(len(db._open), 1)
+        db.close()
+
+    def test_bulk_import(self):
+        with self.db.bulk_import():
+            self.db.load_requests(self.rows)
+            db = self.db.partition((2019, 3))
+            index = db._connection.execute(
+                "SELECT name FROM sqlite_master WHERE "
+                "name='requests_base_timestamp';").fetchone()
+            self.assertIsNone(index)
+        self.assertEqual(self.db.count(), 12)
+        db = self.db.partition((2019, 3))
+        index = db._connection.execute(
+            "SELECT name FROM sqlite_master WHERE "
+            "name='requests_base_timestamp';").fetchone()
+        self.assertIsNotNone(index)
@@ -1,9 +1,16 @@
 
+import gzip
+import itertools
 import os
+import sqlite3
 import tempfile
-from unittest import skip, TestCase
+from unittest import mock, skip, TestCase
 
+from huhu import formats
 from huhu import request
+from huhu import utils
+
+from . import DATA_FOLDER
 
 
 @skip('Being re-developed')
@@ -143,3 +150,545 @@ class RequestDBTester(TestCase):
             cur = con.execute("SELECT count(*) FROM requests_base;")
             count, = cur.fetchone()
             self.assertEqual(count, 1000)
+
+
+class RequestBatchTest(TestCase):
+    def setUp(self):
+        self.rows = [
+            ('lost.co.nz', 3221226219, None, 1234567890, '/', 200, 1400,
+             None, 'Mozilla/5.0'),
+            ('lost.co.nz', 3221226220, None, 1234567891, '/favicon.ico', 404,
+             None, 'https://lost.co.nz/', 'Mozilla/5.0'),
+        ]
+
+    def test_from_requests(self):
+        batch = request.RequestBatch.from_requests(self.rows)
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.status.typecode, 'q')
+        self.assertEqual(list(batch.size), [1400, request.RequestBatch.NULL])
+        self.assertEqual(batch.path, ['/', '/favicon.ico'])
+        self.assertEqual(list(batch.rows()), self.rows)
+
+    def test_iter(self):
+        batch = request.RequestBatch.from_requests(self.rows)
+        requests = list(batch)
+        self.assertIsInstance(requests[1], request.Request)
+        self.assertEqual(tuple(requests[1]), self.rows[1])
+
+    def test_missing_columns(self):
+        batch = request.RequestBatch({'status': [200, None, 404]}, skipped=2)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.skipped, 2)
+        self.assertEqual(batch.path, [None, None, None])
+        self.assertEqual(batch.ip, [None, None, None])
+        self.assertEqual(list(batch.size), [-1, -1, -1])
+        self.assertEqual(
+            [row[5] for row in batch.rows()], [200, None, 404])
+
+    def test_empty(self):
+        batch = request.RequestBatch.from_requests([])
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(list(batch.rows()), [])
+
+    def test_bad_lengths(self):
+        with self.assertRaisesRegex(ValueError, "^Column 'path' has 1 values"):
+            request.RequestBatch({'status': [200, 404], 'path': ['/']})
+
+    def test_add_requests(self):
+        db = request.RequestDB(':memory:')
+        db.add_requests(request.RequestBatch.from_requests(self.rows))
+        self.assertEqual(db.count(), 2)
+
+
+class RequestDBIPTest(TestCase):
+    def test_ip6(self):
+        ip6 = 42540766411282592856903984951653826561
+        db = request.RequestDB(':memory:')
+        db.add_requests([
+            ('lost.co.nz', ip6, None, 1234567890, '/', 200, 0, None, None),
+            ('lost.co.nz', 3221226219, None, 1234567890, '/', 200, 0, None,
+             None),
+        ])
+        rows = db._connection.execute(
+            "SELECT ip FROM requests_base ORDER BY id;").fetchall()
+        self.assertEqual(
+            [utils.sql2ip(ip) for ip, in rows], [ip6, 3221226219])
+
+
+class LoadRequestsTest(TestCase):
+    rows = [
+        ('lost.co.nz', 3221226219, None, 1234567890, '/', 200, 1400,
+         None, 'Mozilla/5.0'),
+        ('lost.co.nz', 42540766411282592856903984951653826561, None,
+         1234567891, '/favicon.ico', 404, None, 'https://lost.co.nz/',
+         'Mozilla/5.0'),
+        (None, None, None, 1234567892, None, None, None, None, None),
+    ]
+
+    def setUp(self):
+        self.db = request.RequestDB(':memory:')
+
+    def select(self):
+        rows = self.db._connection.execute(
+            "SELECT domain, ip, host, timestamp, path, status, size, "
+            "referrer, user_agent FROM requests ORDER BY id;").fetchall()
+        return [(row[0], utils.sql2ip(row[1]), *row[2:]) for row in rows]
+
+    def test_load_requests(self):
+        self.db.load_requests(self.rows, chunk_size=2)
+        self.assertEqual(self.db.count(), 3)
+        self.assertEqual(self.select(), self.rows)
+
+    def test_same_as_view(self):
+        self.db.add_requests(self.rows)
+        self.db.load_requests(request.RequestBatch.from_requests(self.rows))
+        self.assertEqual(self.select(), self.rows * 2)
+        con = self.db._connection
+        expected = {
+            'requests_hostnames': 2,
+            'requests_paths': 2,
+            'requests_user_agents': 1,
+        }
+        for table, expected_count in expected.items():
+            count, = con.execute(f"SELECT count(*) FROM {table};").fetchone()
+            self.assertEqual(count, expected_count)
+        self.assertEqual(
+            con.execute("PRAGMA foreign_key_check;").fetchall(), [])
+        foreign_keys, = con.execute("PRAGMA foreign_keys;").fetchone()
+        self.assertEqual(foreign_keys, 1)
+
+    def test_ids_kept(self):
+        self.db.load_requests(self.rows)
+        self.db.load_requests(self.rows)
+        self.db.add_requests(self.rows)
+        self.db.load_requests(self.rows)
+        self.assertEqual(self.select(), self.rows * 4)
+
+    def test_rollback(self):
+        # Chunks before the bad one are kept
+        self.db.load_requests(self.rows[:1])
+        rows = self.rows + [('lost.co.nz', 'bogus')]
+        with self.assertRaises(ValueError):
+            self.db.load_requests(rows, chunk_size=2)
+        self.assertEqual(self.db.count(), 3)
+        rows = [('example.com', None, None, 0, '/new', [], 0, None, None)]
+        with self.assertRaises(sqlite3.Error):
+            self.db.load_requests(rows)
+        self.db.load_requests(self.rows)
+        self.assertEqual(
+            self.select(), self.rows[:1] + self.rows[:2] + self.rows)
+
+    def test_seconds(self):
+        chunks = list(request._chunks(range(5), 2))
+        self.assertEqual(chunks, [[0, 1], [2, 3], [4]])
+        chunks = list(request._chunks(range(5), 10, seconds=0))
+        self.assertEqual(chunks, [[0], [1], [2], [3], [4]])
+        self.db.load_requests(self.rows, seconds=60)
+        self.assertEqual(self.db.count(), 3)
+
+
+class IterRequestsTest(TestCase):
+    rows = LoadRequestsTest.rows
+
+    def setUp(self):
+        self.db = request.RequestDB(':memory:')
+        self.db.load_requests(self.rows)
+
+    def test_tuples(self):
+        self.assertEqual(
+            list(self.db.iter_requests(output='tuples')), self.rows)
+
+    def test_requests(self):
+        requests = list(self.db.iter_requests(batch_size=2))
+        self.assertIsInstance(requests[0], request.Request)
+        self.assertEqual([tuple(req) for req in requests], self.rows)
+
+    def test_batches(self):
+        batches = list(self.db.iter_requests(output='batches', batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        self.assertIsInstance(batches[0], request.RequestBatch)
+        self.assertEqual(
+            [row for batch in batches for row in batch.rows()], self.rows)
+
+    def test_filters(self):
+        self.assertEqual(
+            list(self.db.iter_requests('lost.co.nz', output='tuples')),
+            self.rows[:2])
+        self.assertEqual(list(self.db.iter_requests(
+            start=1234567891, status=404, output='tuples')), self.rows[1:2])
+        self.assertEqual(list(self.db.iter_requests('missing.com')), [])
+
+    def test_unknown_output(self):
+        with self.assertRaisesRegex(ValueError, "^Unknown output: 'rows'"):
+            self.db.iter_requests(output='rows')
+
+
+class BulkImportTest(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.db = request.RequestDB(os.path.join(self.folder.name, 'test.db'))
+        self.con = self.db._connection
+        self.con.execute(
+            "CREATE INDEX requests_base_ip ON requests_base(ip);")
+        self.rows = LoadRequestsTest.rows
+
+    def tearDown(self):
+        self.con.close()
+        self.folder.cleanup()
+
+    def pragmas(self):
+        return [
+            self.con.execute(f"PRAGMA {name};").fetchone()[0]
+            for name in ('journal_mode', 'synchronous', 'cache_size')]
+
+    def indexes(self):
+        return {name for name, in self.con.execute(
+            "SELECT name FROM sqlite_master WHERE type='index';")}
+
+    def test_bulk_import(self):
+        before = self.pragmas()
+        indexes = self.indexes()
+        with self.db.bulk_import(page_size=16384) as dropped:
+            self.assertIn('requests_base_ip', dropped)
+            self.assertIn('requests_base_domain', dropped)
+            self.assertEqual(self.pragmas()[:2], ['wal', 1])
+            self.assertEqual(self.indexes(), indexes - set(dropped))
+            self.db.load_requests(self.rows)
+        self.assertEqual(self.pragmas(), before)
+        self.assertEqual(self.indexes(), indexes)
+        page_size, = self.con.execute("PRAGMA page_size;").fetchone()
+        self.assertEqual(page_size, 16384)
+        self.assertEqual(self.db.count(), 3)
+
+    def test_exception(self):
+        before = self.pragmas()
+        with self.assertRaises(ValueError):
+            with self.db.bulk_import():
+                self.db.load_requests(self.rows + [('lost.co.nz', 'bogus')])
+        self.assertEqual(self.pragmas(), before)
+        self.assertIn('requests_base_ip', self.indexes())
+        self.assertEqual(self.db.count(), 0)
+
+    def test_keep_indexes(self):
+        with self.db.bulk_import(drop_indexes=False) as dropped:
+            self.assertEqual(dropped, [])
+            self.assertIn('requests_base_ip', self.indexes())
+
+
+class LoadFileTest(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.db = request.RequestDB(':memory:')
+        self.format = formats.ApacheCustomTimeTaken(binary=True)
+        with open(os.path.join(DATA_FOLDER, 'access.log'), 'rb') as fp:
+            self.lines = fp.readlines()
+        self.timestamps = [
+            self.format.parse(line).timestamp for line in self.lines]
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, lines, mode='wb'):
+        path = os.path.join(self.folder.name, 'access.log')
+        with open(path, mode) as fp:
+            fp.writelines(lines)
+        return path
+
+    def loaded(self):
+        return [timestamp for timestamp, in self.db._connection.execute(
+            "SELECT timestamp FROM requests_base ORDER BY id;")]
+
+    def test_load_file(self):
+        path = os.path.join(DATA_FOLDER, 'access.log.gz')
+        stream = self.db.load_file(path, self.format, chunk_size=300)
+        self.assertEqual(stream.lines, 1000)
+        self.assertEqual(self.loaded(), self.timestamps)
+        size = sum(len(line) for line in self.lines)
+        self.assertEqual(self.db.checkpoint(path), (size, 1000))
+
+        # Nothing new
+        stream = self.db.load_file(path, self.format)
+        self.assertEqual(stream.lines, 0)
+        self.assertEqual(self.db.count(), 1000)
+
+    def test_text_format(self):
+        path = self.write(self.lines[:10])
+        self.db.load_file(path, formats.ApacheCustomTimeTaken())
+        self.assertEqual(self.loaded(), self.timestamps[:10])
+
+    def test_text_format_bad_bytes(self):
+        lines = self.lines[:10]
+        lines[1] = lines[1].replace(b'GET /', b'GET /\xff', 1)
+        path = self.write([*lines, b'\xff junk\n'])
+        stream = self.db.load_file(path, formats.ApacheCustomTimeTaken())
+        self.assertEqual(self.loaded(), self.timestamps[:10])
+        self.assertEqual(stream.failures, {'unmatched': 1})
+        path, = self.db._connection.execute(
+            "SELECT path FROM requests WHERE id=2;").fetchone()
+        self.assertTrue(path.startswith('/\ufffd'))
+
+    def test_growing_file(self):
+        path = self.write(self.lines[:500])
+        self.db.load_file(path, self.format)
+        self.write(self.lines[500:] + [b'junk\n'], mode='ab')
+        stream = self.db.load_file(path, self.format)
+        self.assertEqual((stream.lines, stream.failed), (501, 1))
+        self.assertEqual(self.loaded(), self.timestamps)
+        self.assertEqual(self.db.checkpoint(path)[1], 1001)
+
+    def test_half_written_line(self):
+        path = self.write([*self.lines[:2], self.lines[2][:50]])
+        stream = self.db.load_file(path, self.format)
+        self.assertEqual((stream.lines, stream.failed), (2, 0))
+        self.assertEqual(self.db.checkpoint(path)[1], 2)
+        self.write([self.lines[2][50:], *self.lines[3:10]], mode='ab')
+        self.db.load_file(path, self.format)
+        self.assertEqual(self.loaded(), self.timestamps[:10])
+        self.assertEqual(self.db.checkpoint(path)[1], 10)
+
+    def test_resume(self):
+        # Interrupt parsing of line 651
+        interrupted = formats.ApacheCustomTimeTaken(binary=True)
+        lines = itertools.count(1)
+
+        def parse(line):
+            if next(lines) > 650:
+                raise KeyboardInterrupt()
+            return self.format.parse(line)
+
+        interrupted._compile = lambda function, **kwargs: parse
+        path = self.write(self.lines)
+        with self.assertRaises(KeyboardInterrupt):
+            self.db.load_file(path, interrupted, chunk_size=300)
+        self.assertEqual(self.db.count(), 600)
+        self.assertEqual(self.db.checkpoint(path)[1], 600)
+        self.db.load_file(path, self.format, chunk_size=300)
+        self.assertEqual(self.loaded(), self.timestamps)
+
+    def test_skip_loaded(self):
+        path = self.write(self.lines)
+        self.db.load_file(path, self.format)
+        with mock.patch('huhu.utils.magic_open', side_effect=AssertionError):
+            stream = self.db.load_file(path, self.format)
+        self.assertEqual(stream.lines, 0)
+        self.assertEqual(self.db.count(), 1000)
+
+    def test_short_file_grows(self):
+        path = self.write(self.lines[:2])
+        self.db.load_file(path, self.format)
+        self.assertEqual(self.db.checkpoint(path)[1], 2)
+        self.write(self.lines[2:], mode='ab')
+        self.assertEqual(self.db.checkpoint(path)[1], 2)
+        self.db.load_file(path, self.format)
+        self.assertEqual(self.loaded(), self.timestamps)
+        rows = self.db._connection.execute(
+            "SELECT head_length FROM requests_checkpoints;").fetchall()
+        self.assertEqual(rows, [(request.HEAD_SIZE,)])
+
+    def test_rotated(self):
+        # Rename, then compress, the old log, and start a new one
+        path = self.write(self.lines[:600])
+        self.db.load_file(path, self.format)
+        self.write(self.lines[600:700], mode='ab')
+        os.rename(path, path + '.1')
+        with open(path + '.1', 'rb') as fp, \
+                gzip.open(path + '.2.gz', 'wb') as out:
+            out.write(fp.read())
+        self.write(self.lines[700:])
+        paths = [path + '.2.gz', path + '.1', path]
+        streams = self.db.load_files(paths, self.format)
+        self.assertEqual(self.loaded(), self.timestamps)
+        self.assertEqual(list(streams), [path + '.1', path + '.2.gz', path])
+        self.assertEqual(streams[path + '.1'].lines, 100)
+        self.assertEqual(streams[path + '.2.gz'].lines, 0)
+        self.assertEqual(streams[path].lines, 300)
+
+    def test_quarantine(self):
+        """
+        Bad lines of every file end up in the one quarantine file.
+        """
+        paths = []
+        for index in range(2):
+            path = os.path.join(self.folder.name, f'access.log.{index}')
+            with open(path, 'wb') as fp:
+                fp.writelines(self.lines[index::2])
+                fp.write(b'bad line %d\n' % index)
+            paths.append(path)
+        quarantine = os.path.join(self.folder.name, 'bad.log')
+        streams = self.db.load_files(
+            paths, self.format, quarantine=quarantine)
+        self.assertEqual(
+            [stream.failed for stream in streams.values()], [1, 1])
+        with open(quarantine, 'rb') as fp:
+            self.assertEqual(
+                sorted(fp.readlines()), [b'bad line 0\n', b'bad line 1\n'])
+
+    def test_truncated(self):
+        path = self.write(self.lines[:600])
+        self.db.load_file(path, self.format)
+        path = self.write(self.lines[600:])
+        self.db.load_file(path, self.format)
+        self.assertEqual(self.loaded(), self.timestamps)
+
+    def test_upgrade_trigger(self):
+        # Trigger used to leave out the referrer
+        db_path = os.path.join(self.folder.name, 'test.db')
+        with request.RequestDB(db_path)._connection as con:
+            sql, = con.execute(
+                "SELECT sql FROM sqlite_master WHERE type='trigger' "
+                "AND name='insert_requests_view';").fetchone()
+            con.execute("DROP TRIGGER insert_requests_view;")
+            con.execute(sql.replace(
+                "INSERT OR IGNORE INTO requests_hostnames (hostname) "
+                "VALUES (NEW.referrer);", ""))
+        db = request.RequestDB(db_path)
+        db.add_requests(LoadRequestsTest.rows[1:2])
+        referrer, = db._connection.execute(
+            "SELECT referrer FROM requests;").fetchone()
+        self.assertEqual(referrer, 'https://lost.co.nz/')
+
+
+class ReportTest(TestCase):
+    def setUp(self):
+        day = 86400
+        self.db = request.RequestDB(':memory:')
+        self.db.load_requests([
+            ('lost.co.nz', 1, None, 10 * day, '/', 200, 1000, None, None),
+            ('lost.co.nz', 1, None, 10 * day + 1, '/', 200, 1000, None, None),
+            ('lost.co.nz', 1, None, 10 * day + 3600, '/a', 404, 10, None,
+             None),
+            ('lost.co.nz', 1, None, 11 * day, '/a', 200, None, None, None),
+            ('example.com', 1, None, 11 * day, '/', 304, 0, None, None),
+            ('example.com', 1, None, 40 * day, '/b', 200, 5, None, None),
+        ])
+
+    def test_requests_per_period(self):
+        day = 86400
+        self.assertEqual(self.db.requests_per_period('day'), [
+            (10 * day, 3, 2010), (11 * day, 2, 0), (40 * day, 1, 5)])
+        self.assertEqual(self.db.requests_per_period('hour', 'lost.co.nz'), [
+            (10 * day, 2, 2000), (10 * day + 3600, 1, 10), (11 * day, 1, 0)])
+        self.assertEqual(
+            self.db.requests_per_period('month', start=11 * day, status=200),
+            [(0, 1, 0), (31 * day, 1, 5)])
+        self.assertEqual(
+            self.db.requests_per_period(7 * day, end=11 * day),
+            [(7 * day, 3, 2010)])
+        with self.assertRaisesRegex(ValueError, "^Unknown period: 'week'"):
+            self.db.requests_per_period('week')
+
+    def test_top_paths(self):
+        self.assertEqual(
+            self.db.top_paths(), [('/', 3), ('/a', 2), ('/b', 1)])
+        self.assertEqual(
+            self.db.top_paths(1, domain='example.com'), [('/', 1)])
+        self.assertEqual(self.db.top_paths(status=404), [('/a', 1)])
+        self.assertEqual(self.db.top_paths(domain='missing.com'), [])
+
+        # Requests without a path are left out, with rollups or without
+        row = ('lost.co.nz', 1, None, 10 * 86400, None, 404, 0, None, None)
+        self.db.load_requests([row] * 4)
+        self.assertEqual(self.db.top_paths(1), [('/', 3)])
+        self.assertEqual(self.db.top_paths(status=404), [('/a', 1)])
+
+    def test_status_counts(self):
+        self.assertEqual(
+            self.db.status_counts(), {200: 4, 304: 1, 404: 1})
+        self.assertEqual(
+            self.db.status_counts('lost.co.nz', end=86400 * 11),
+            {200: 2, 404: 1})
+
+    def test_bytes_served(self):
+        self.assertEqual(self.db.bytes_served(), 2015)
+        self.assertEqual(self.db.bytes_served(status=200), 2005)
+        self.assertEqual(self.db.bytes_served(start=86400 * 11), 5)
+        self.assertEqual(self.db.bytes_served('missing.com'), 0)
+
+    def test_covering_indexes(self):
+        where, params = self.db._where('lost.co.nz', 0, 86400)
+        plan = self.db._connection.execute(
+            "EXPLAIN QUERY PLAN SELECT status, count(*) FROM requests_base "
+            f"{where} GROUP BY status;", params).fetchall()
+        self.assertIn('USING COVERING INDEX requests_base_domain', plan[0][3])
+
+    def test_unaligned(self):
+        # Ranges that are not whole hours are answered from the requests
+        self.assertIsNone(self.db._rollup('status', 10 * 86400 + 1))
+        self.assertEqual(
+            self.db.requests_per_period('day', start=10 * 86400 + 1),
+            [(10 * 86400, 2, 1010), (11 * 86400, 2, 0), (40 * 86400, 1, 5)])
+        self.assertEqual(
+            self.db.status_counts(start=10 * 86400 + 1),
+            {200: 3, 304: 1, 404: 1})
+
+
+class RollupTest(TestCase):
+    rows = [
+        ('lost.co.nz', 1, None, 86400, '/', 200, 1000, None, None),
+        ('lost.co.nz', 1, None, 86400 + 3599, '/', 200, 10, None, None),
+        ('lost.co.nz', 1, None, 86400 + 3600, '/a', None, None, None, None),
+        (None, 1, None, 2 * 86400, None, 500, 1, None, None),
+        ('lost.co.nz', 1, None, None, '/', 200, 1000, None, None),
+    ]
+
+    def rollup(self, db, table):
+        return db._connection.execute(
+            f"SELECT * FROM {table} ORDER BY 1, 2, 3;").fetchall()
+
+    def check(self, db):
+        domain_id, = db._connection.execute(
+            "SELECT id FROM requests_hostnames WHERE "
+            "hostname='lost.co.nz';").fetchone()
+        path_id, = db._connection.execute(
+            "SELECT id FROM requests_paths WHERE path='/';").fetchone()
+        self.assertEqual(self.rollup(db, 'requests_daily'), [
+            (86400, domain_id, 0, 1, 0),
+            (86400, domain_id, 200, 2, 1010),
+            (2 * 86400, 0, 500, 1, 1),
+        ])
+        self.assertEqual(self.rollup(db, 'requests_hourly_paths')[0], (
+            86400, domain_id, path_id, 2, 1010))
+        self.assertEqual(len(self.rollup(db, 'requests_hourly')), 3)
+
+    def test_load_requests(self):
+        db = request.RequestDB(':memory:')
+        db.load_requests(self.rows[:2])
+        db.load_requests(self.rows[2:], chunk_size=1)
+        self.check(db)
+
+    def test_add_requests(self):
+        db = request.RequestDB(':memory:')
+        db.add_requests(self.rows)
+        self.check(db)
+
+    def test_backfill(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'test.db')
+            request.RequestDB(path).load_requests(self.rows)
+            with sqlite3.connect(path) as con:
+                for table in request.ROLLUPS:
+                    con.execute(f"DROP TABLE {table};")
+            db = request.RequestDB(path)
+            self.check(db)
+            db._connection.close()
+
+    def test_same_as_requests_base(self):
+        """
+        Reports give the same answers from the rollups as without them.
+        """
+        db = request.RequestDB(':memory:')
+        db.load_requests(self.rows)
+        reports = [
+            ('requests_per_period', 'day'),
+            ('requests_per_period', 'hour', 'lost.co.nz'),
+            ('top_paths', None),
+            ('top_paths', 10, 'lost.co.nz', 0, 3 * 86400),
+            ('status_counts',),
+            ('status_counts', 'lost.co.nz'),
+            ('bytes_served',),
+            ('bytes_served', None, 86400, 2 * 86400, 200),
+        ]
+        for method, *args in reports:
+            expected = getattr(db, method)(*args)
+            with mock.patch.object(db, '_rollup', return_value=None):
+                self.assertEqual(getattr(db, method)(*args), expected, method)
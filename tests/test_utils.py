@@ -1,8 +1,11 @@
 
 from os.path import join
+import time
 from unittest import TestCase
 
-from huhu.utils import date2epoch, epoch2date, ip4_int2quad, ip4_quad2int, magic_open
+from huhu.utils import (
+    date2epoch, dates2epochs, epoch2date, int2ip, ip2int, ip2sql,
+    ip4_int2quad, ip4_quad2int, magic_open, sql2ip)
 
 from . import DATA_FOLDER
 
@@ -52,6 +55,39 @@ class Date2EpochTest(TestCase):
         with self.assertRaises(ValueError):
             date2epoch(date)
 
+    def test_date2epoch_same_minute(self):
+        cases = {
+            '[09/Sep/2001:01:46:40 +0000]': 1_000_000_000,
+            '[09/Sep/2001:01:46:59 +0000]': 1_000_000_019,
+            '[09/Sep/2001:01:46:00 +0000]': 999_999_960,
+            '[09/Sep/2001:01:46:40 +0100]': 999_996_400,
+            '[09/Sep/2001:01:45:40 +0000]': 999_999_940,
+        }
+        for date, expected in cases.items():
+            self.assertEqual(date2epoch(date), expected)
+
+    def test_date2epoch_errors_not_cached(self):
+        date = '[09/Sep/2001:01:46:4x +0000]'
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                date2epoch(date)
+
+    def test_dates2epochs(self):
+        dates = [
+            '[09/Sep/2001:01:46:40 +0000]',
+            '[09/Sep/2001:01:46:41 +0000]',
+            '[08/Sep/2001:21:46:40 -0400]',
+            '[09/Sep/2001:01:46:39 +0000]',
+            '[09/Sep/2001:01:47:00 +0000]',
+        ]
+        expected = [
+            1_000_000_000, 1_000_000_001, 1_000_000_000, 999_999_999,
+            1_000_000_020]
+        self.assertEqual(dates2epochs(dates), expected)
+        self.assertEqual(
+            dates2epochs(dates), [date2epoch(date) for date in dates])
+        self.assertEqual(dates2epochs([]), [])
+
 
 class Epoch2DateTest(TestCase):
     """
@@ -94,6 +130,18 @@ class Epoch2DateTest(TestCase):
         date = epoch2date(epoch)
         self.assertEqual(date, '[30/May/2514:01:53:04 +0000]')
 
+    def test_epoch2date_every_second(self):
+        # Each minute's date is cached, but seconds must still be right
+        start = 1551680700
+        for epoch in range(start - 61, start + 121):
+            expected = time.strftime(
+                '[%d/%b/%Y:%H:%M:%S +0000]', time.gmtime(epoch))
+            self.assertEqual(epoch2date(epoch), expected)
+
+    def test_epoch2date_float(self):
+        self.assertEqual(
+            epoch2date(1234567890.75), '[13/Feb/2009:23:31:30 +0000]')
+
 
 class IP4Int2QuadTest(TestCase):
     def test_ip4_int2quad(self):
@@ -115,6 +163,38 @@ class IP4Quad2IntTest(TestCase):
         self.assertEqual(ip4_quad2int('255.255.255.255'), 4294967295)
 
 
+class IP2IntTest(TestCase):
+    """
+    Convert IPv4 and IPv6 addresses to and from integers.
+    """
+    def test_ip2int(self):
+        self.assertEqual(ip2int('192.0.2.235'), 3221226219)
+        self.assertEqual(ip2int('2001:db8::1'), 0x2001_0db8 << 96 | 1)
+        self.assertEqual(ip2int('2001:DB8:0:0:0:0:0:1'), 0x2001_0db8 << 96 | 1)
+        self.assertEqual(ip2int('::ffff:192.0.2.235'), 3221226219)
+        self.assertEqual(ip2int('::1'), ip2int('127.0.0.1'))
+
+    def test_ip2int_invalid(self):
+        for ip in ('damn.silly.ip.address', '2001:db8::1::1', ''):
+            with self.assertRaises(OSError):
+                ip2int(ip)
+
+    def test_int2ip(self):
+        for ip in ('0.0.0.0', '192.0.2.235', '255.255.255.255', '2001:db8::1',
+                   'fe80::1:2:3:4'):
+            self.assertEqual(int2ip(ip2int(ip)), ip)
+
+    def test_ip2sql(self):
+        self.assertIsNone(ip2sql(None))
+        self.assertEqual(ip2sql(3221226219), 3221226219)
+        ip6 = ip2int('2001:db8::1')
+        value = ip2sql(ip6)
+        self.assertIsInstance(value, bytes)
+        self.assertEqual(len(value), 16)
+        self.assertEqual(sql2ip(value), ip6)
+        self.assertEqual(sql2ip(3221226219), 3221226219)
+
+
 class MagicOpenTest(TestCase):
     def test_magic_open_plain_text(self):
         self._check_file(join(DATA_FOLDER, 'access.log'))
@@ -128,6 +208,13 @@ class MagicOpenTest(TestCase):
     def test_magic_open_xz_compressed(self):
         self._check_file(join(DATA_FOLDER, 'access.log.xz'))
 
+    def test_magic_open_binary(self):
+        for name in ('access.log', 'access.log.gz'):
+            with magic_open(join(DATA_FOLDER, name), 'rb') as fp:
+                lines = list(fp)
+            self.assertEqual(len(lines), 1000)
+            self.assertTrue(isinstance(lines[0], bytes))
+
     def _check_file(self, path):
         "Check that the contents given input file looks right"
         with magic_open(path) as fp: